@@ -0,0 +1,86 @@
+"""Fixtures for the benchmark suite, which is run with pytest-benchmark, e.g.
+
+    pytest benchmarks --benchmark-autosave
+
+The size of the generated DICOM sessions and output directories is set by the
+'DCM2NIIX_BENCH_SCALE' environment variable ("small", "medium" or "large").
+"""
+
+import gzip
+import os
+from pathlib import Path
+import sys
+import pytest
+from pydra.tasks.dcm2niix.tests.stub_dcm2niix import nifti_image
+from pydra.tasks.dcm2niix.tests.synthetic import write_session
+
+STUB = [
+    sys.executable,
+    str(
+        Path(__file__).parent.parent
+        / "pydra"
+        / "tasks"
+        / "dcm2niix"
+        / "tests"
+        / "stub_dcm2niix.py"
+    ),
+]
+
+SCALES = {
+    # number of sessions, series per session, slices per series, files in out_dir
+    "small": {"sessions": 4, "series": 4, "instances": 8, "crowd": 2_000},
+    "medium": {"sessions": 16, "series": 8, "instances": 32, "crowd": 20_000},
+    "large": {"sessions": 64, "series": 16, "instances": 64, "crowd": 100_000},
+}
+
+
+@pytest.fixture(scope="session")
+def scale():
+    return SCALES[os.environ.get("DCM2NIIX_BENCH_SCALE", "small")]
+
+
+@pytest.fixture(scope="session")
+def stub():
+    return STUB
+
+
+@pytest.fixture(scope="session")
+def sessions(tmp_path_factory, scale):
+    """Synthetic sessions, each written flat into its own directory"""
+    root = tmp_path_factory.mktemp("sessions")
+    dirs = []
+    for i in range(scale["sessions"]):
+        write_session(
+            root / f"sub{i:04d}",
+            num_series=scale["series"],
+            num_instances=scale["instances"],
+        )
+        dirs.append(root / f"sub{i:04d}")
+    return dirs
+
+
+@pytest.fixture(scope="session")
+def crowded_out_dir(tmp_path_factory, scale):
+    """An output directory holding the outputs of a multi-echo conversion among a
+    large number of unrelated files, and the stdout of the conversion"""
+    out_dir = tmp_path_factory.mktemp("crowded")
+    for i in range(scale["crowd"]):
+        (out_dir / f"other{i:06d}.nii.gz").touch()
+    stdout = ""
+    image = gzip.compress(nifti_image(4, 4, 4))
+    for echo in range(1, 4):
+        (out_dir / f"out_file_e{echo}.nii.gz").write_bytes(image)
+        (out_dir / f"out_file_e{echo}.json").write_text("{}")
+        stdout += f"Convert 32 DICOM as {out_dir / f'out_file_e{echo}'} (64x64x32x1)\n"
+    return out_dir, stdout
+
+
+@pytest.fixture(scope="session")
+def split_out_dir(tmp_path_factory, scale):
+    """An output directory holding a series split into one file per volume"""
+    out_dir = tmp_path_factory.mktemp("split")
+    image = nifti_image(4, 4, 4)
+    for i in range(1, scale["crowd"] + 1):
+        (out_dir / f"out_file_{i:05d}.nii").write_bytes(image)
+    (out_dir / "out_file.json").write_text("{}")
+    return out_dir
@@ -0,0 +1,54 @@
+"""Benchmarks of the Python-side compression stage and of reading single volumes from
+indexed and plain gzipped 4D images"""
+
+import gzip
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from pydra.tasks.dcm2niix.compression import IndexedGzipReader, gzip_file
+from pydra.tasks.dcm2niix.tests.stub_dcm2niix import nifti_image
+
+NUM_VOLUMES = 300
+
+
+@pytest.fixture(scope="module")
+def fmri(tmp_path_factory):
+    """A 64x64x40 x 300 volume 16-bit fMRI run, with random-ish noise in each volume"""
+    tmp_dir = tmp_path_factory.mktemp("fmri")
+    image = bytearray(nifti_image(64, 64, 40, NUM_VOLUMES))
+    noise = bytes(range(256)) * 16
+    for i in range(352, len(image), len(noise) * 7):
+        image[i : i + len(noise)] = noise[: len(image) - i]
+    (tmp_dir / "func.nii").write_bytes(image)
+    shutil.copy(tmp_dir / "func.nii", tmp_dir / "plain.nii")
+    gzip_file(tmp_dir / "func.nii", indexed=True)
+    gzip_file(tmp_dir / "plain.nii")
+    return tmp_dir
+
+
+def test_gzip_parallel(benchmark, fmri, tmp_path):
+    def setup():
+        shutil.copy(fmri / "plain.nii.gz", tmp_path / "func.nii.gz")
+        with gzip.open(tmp_path / "func.nii.gz") as fin:
+            (tmp_path / "func.nii").write_bytes(fin.read())
+
+    with ThreadPoolExecutor() as pool:
+        benchmark.pedantic(
+            lambda: gzip_file(tmp_path / "func.nii", pool=pool),
+            setup=setup,
+            rounds=3,
+        )
+
+
+def test_read_volume_indexed(benchmark, fmri):
+    with IndexedGzipReader(fmri / "func.nii.gz") as reader:
+        benchmark(reader.read_volume, 200)
+
+
+def test_read_volume_plain(benchmark, fmri):
+    def read_volume():
+        with gzip.open(fmri / "plain.nii.gz") as f:
+            f.seek(352 + 200 * 64 * 64 * 40 * 2)
+            return f.read(64 * 64 * 40 * 2)
+
+    benchmark(read_volume)
@@ -0,0 +1,60 @@
+"""Benchmarks of the cost of defining Dcm2Niix tasks and rendering their command lines"""
+
+from pydra.tasks.dcm2niix import Dcm2Niix, TaskTemplate
+
+
+def test_construct(benchmark, sessions, tmp_path):
+    benchmark(Dcm2Niix, in_dir=sessions[0], out_dir=tmp_path, compress="y")
+
+
+def test_construct_no_in_dir(benchmark, tmp_path):
+    benchmark(Dcm2Niix, out_dir=tmp_path, compress="y", bids="y", ignore_derived="y")
+
+
+def test_cmdline(benchmark, sessions, tmp_path):
+    task = Dcm2Niix(in_dir=sessions[0], out_dir=tmp_path, compress="y")
+    benchmark(lambda: task.cmdline)
+
+
+def test_construct_many(benchmark, sessions, tmp_path):
+    """Constructing the tasks of a large split directly"""
+    benchmark(
+        lambda: [
+            Dcm2Niix(in_dir=s, out_dir=tmp_path / str(i), compress="y")
+            for _ in range(50)
+            for i, s in enumerate(sessions)
+        ]
+    )
+
+
+def test_construct_many_template(benchmark, sessions, tmp_path):
+    """Constructing the tasks of a large split from a shared template"""
+    tasks = TaskTemplate(Dcm2Niix(compress="y"))
+    benchmark(
+        lambda: [
+            tasks.task(s, tmp_path / str(i))
+            for _ in range(50)
+            for i, s in enumerate(sessions)
+        ]
+    )
+
+
+def test_hash_many(benchmark, sessions, tmp_path):
+    tasks = TaskTemplate(Dcm2Niix(compress="y"))
+    split = [
+        tasks.task(s, tmp_path / str(i))
+        for _ in range(50)
+        for i, s in enumerate(sessions)
+    ]
+    benchmark(lambda: [t._hash for t in split])
+
+
+def test_argv_many(benchmark, sessions, tmp_path):
+    tasks = TaskTemplate(Dcm2Niix(compress="y"))
+    benchmark(
+        lambda: [
+            tasks.argv(s, tmp_path / str(i))
+            for _ in range(50)
+            for i, s in enumerate(sessions)
+        ]
+    )
@@ -0,0 +1,56 @@
+"""Benchmarks of collecting the outputs of a conversion from the output directory"""
+
+from pydra.tasks.dcm2niix import outputs
+from pydra.tasks.dcm2niix.outputs import OutputFiles, OutputIndex
+from pydra.tasks.dcm2niix.utils import (
+    Dcm2Niix,
+    collect_outputs,
+    dcm2niix_out_file,
+    dcm2niix_out_files,
+)
+
+
+def clear_caches():
+    outputs.parse_manifest.cache_clear()
+    outputs._cached_index.cache_clear()
+    outputs._cached_manifest_index.cache_clear()
+
+
+def test_out_files_crowded_scan(benchmark, crowded_out_dir, tmp_path):
+    out_dir, _ = crowded_out_dir
+    benchmark.pedantic(
+        dcm2niix_out_files,
+        args=(out_dir, "out_file", tmp_path, ""),
+        setup=clear_caches,
+        rounds=20,
+    )
+
+
+def test_out_files_crowded_manifest(benchmark, crowded_out_dir, tmp_path):
+    out_dir, stdout = crowded_out_dir
+    benchmark.pedantic(
+        dcm2niix_out_files,
+        args=(out_dir, "out_file", tmp_path, stdout),
+        setup=clear_caches,
+        rounds=20,
+    )
+
+
+def test_out_file_crowded(benchmark, crowded_out_dir, tmp_path):
+    out_dir, stdout = crowded_out_dir
+    benchmark.pedantic(
+        dcm2niix_out_file,
+        args=(out_dir, "out_file", "_e1", "y", tmp_path, stdout),
+        setup=clear_caches,
+        rounds=20,
+    )
+
+
+def test_collect_outputs_split(benchmark, split_out_dir):
+    task = Dcm2Niix(out_dir=split_out_dir, file_postfix="_00001", compress="n")
+    benchmark(lambda: collect_outputs(task, OutputIndex.scan(split_out_dir)))
+
+
+def test_out_files_split(benchmark, split_out_dir):
+    names = [p.name for p in split_out_dir.iterdir()]
+    benchmark(OutputFiles, split_out_dir, names)
@@ -0,0 +1,51 @@
+"""End-to-end throughput of converting the synthetic sessions with the stub dcm2niix,
+which measures the overhead of the Python side of the package"""
+
+import shutil
+from pydra.tasks.dcm2niix import (
+    Dcm2Niix,
+    Dcm2NiixBatch,
+    convert,
+    convert_series_parallel,
+)
+
+
+def test_convert(benchmark, sessions, stub, tmp_path):
+    def run():
+        shutil.rmtree(tmp_path / "out", ignore_errors=True)
+        for i, session in enumerate(sessions):
+            convert(
+                Dcm2Niix(
+                    in_dir=session,
+                    out_dir=tmp_path / "out" / str(i),
+                    executable=stub,
+                )
+            )
+
+    benchmark.pedantic(run, rounds=3)
+
+
+def test_batch(benchmark, sessions, stub, tmp_path):
+    batch = Dcm2NiixBatch(Dcm2Niix(executable=stub))
+
+    def run():
+        shutil.rmtree(tmp_path / "out", ignore_errors=True)
+        jobs = [(s, tmp_path / "out" / str(i)) for i, s in enumerate(sessions)]
+        results = list(batch.run(jobs))
+        assert all(r.ok for r in results)
+
+    benchmark.pedantic(run, rounds=3)
+
+
+def test_convert_series_parallel(benchmark, sessions, stub, tmp_path):
+    def run():
+        shutil.rmtree(tmp_path / "out", ignore_errors=True)
+        convert_series_parallel(
+            Dcm2Niix(
+                in_dir=sessions[0],
+                out_dir=tmp_path / "out",
+                executable=stub,
+            )
+        )
+
+    benchmark.pedantic(run, rounds=3)
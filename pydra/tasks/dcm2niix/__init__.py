@@ -8,9 +8,48 @@ imported.
 
 from ._version import __version__
 from .utils import Dcm2Niix
+from .cache import ConversionCache
+from .compression import IndexedGzipReader, ParallelGzip
+from .catalog import DicomCatalog, load_catalog
+from .convert import convert
+from .hashing import set_hashing_mode
+from .parallel import convert_series_parallel
+from .archive import convert_archive
+from .batch import Dcm2NiixBatch
+from .construction import TaskTemplate
+from .tuning import CompressionTuner
+from .staging import Staging
+from .prefilter import DicomFilter
+from .sidecars import SidecarExtractor
+from .planning import plan_outputs
+from .aio import convert_many
+from .watch import SeriesWatcher
+from .receiver import StorageReceiver
+from .state import ConversionState, convert_incremental
 
 
 __all__ = [
     "__version__",
     "Dcm2Niix",
+    "ConversionCache",
+    "ParallelGzip",
+    "IndexedGzipReader",
+    "DicomCatalog",
+    "load_catalog",
+    "convert",
+    "set_hashing_mode",
+    "convert_series_parallel",
+    "convert_archive",
+    "Dcm2NiixBatch",
+    "TaskTemplate",
+    "CompressionTuner",
+    "Staging",
+    "DicomFilter",
+    "SidecarExtractor",
+    "plan_outputs",
+    "convert_many",
+    "SeriesWatcher",
+    "StorageReceiver",
+    "ConversionState",
+    "convert_incremental",
 ]
@@ -0,0 +1,285 @@
+"""Running many Dcm2Niix conversions concurrently from asyncio.
+
+The runners in :mod:`pydra.tasks.dcm2niix.convert` and :mod:`pydra.tasks.dcm2niix.batch`
+block a thread on each dcm2niix process, so an asyncio service using them needs a
+thread per in-flight conversion. :func:`convert_many` instead launches dcm2niix with
+``asyncio.create_subprocess_exec``, bounding the number of concurrent processes with a
+semaphore, and yields the result of each conversion (including its collected outputs)
+as soon as it completes. The blocking steps around the process (rendering the command
+line, hashing and materialising cached conversions, and indexing and collecting the
+outputs) are run on the event loop's default executor.
+
+NB: as asyncio reaps the dcm2niix processes itself, their resource usage isn't
+recorded in the metrics of the runs (i.e. 'child' is None).
+"""
+
+import asyncio
+from collections.abc import AsyncIterable, AsyncIterator, Iterable
+import logging
+import os
+from pathlib import Path
+import shlex
+import subprocess
+import time
+import typing as ty
+import attrs
+from .cache import ConversionCache
+from .convert import ConversionRun, check_return_code, index_outputs
+from .metrics import RunMetrics, record_metrics
+from .outputs import OutputIndex
+from .utils import Dcm2Niix
+
+logger = logging.getLogger("pydra.tasks.dcm2niix")
+
+
+@attrs.define
+class ConversionResult:
+    """The result of a conversion run by :func:`convert_many`
+
+    Parameters
+    ----------
+    task : Dcm2Niix
+        the task that was run
+    outputs : Dcm2Niix.Outputs or None
+        the outputs of the conversion, if it succeeded
+    error : Exception or None
+        the error raised by the conversion, if it failed (including
+        subprocess.TimeoutExpired if it timed out)
+    duration : float
+        the wall time the conversion took in seconds, including waiting for a slot
+    metrics : RunMetrics, optional
+        the timings of the conversion
+    """
+
+    task: Dcm2Niix
+    outputs: Dcm2Niix.Outputs | None = None
+    error: Exception | None = None
+    duration: float = 0.0
+    metrics: RunMetrics | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+async def run_process_async(
+    argv: list[str], timeout: float | None = None
+) -> tuple[int, bytes, bytes]:
+    """Runs a process to completion without blocking the event loop, capturing its
+    output
+
+    Parameters
+    ----------
+    argv : list[str]
+        the command line to run
+    timeout : float, optional
+        the number of seconds after which to kill the process
+
+    Returns
+    -------
+    return_code : int
+        the exit code of the process
+    stdout : bytes
+        the captured stdout
+    stderr : bytes
+        the captured stderr
+
+    Raises
+    ------
+    subprocess.TimeoutExpired
+        if the process doesn't complete within the timeout
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *argv, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise subprocess.TimeoutExpired(argv, ty.cast(float, timeout)) from None
+    except asyncio.CancelledError:
+        # Don't leave the process running if the caller stops waiting for it
+        proc.kill()
+        await proc.wait()
+        raise
+    return ty.cast(int, proc.returncode), stdout, stderr
+
+
+async def run_async(
+    task: Dcm2Niix,
+    cache: ConversionCache | None = None,
+    timeout: float | None = None,
+    metrics: RunMetrics | None = None,
+) -> ConversionRun:
+    """Runs a Dcm2Niix task in a subprocess without blocking the event loop, and
+    indexes the produced files without resolving its outputs
+
+    Parameters
+    ----------
+    task : Dcm2Niix
+        the task to run, which must have 'out_dir' set
+    cache : ConversionCache, optional
+        a cache to look up the conversion in before running it, and to store its
+        outputs in afterwards
+    timeout : float, optional
+        the number of seconds after which to kill the dcm2niix process
+    metrics : RunMetrics, optional
+        the metrics to record the phases of the run in, so they are available to the
+        caller even if the run fails
+
+    Returns
+    -------
+    ConversionRun
+        the files produced by the run
+
+    Raises
+    ------
+    ValueError
+        if the 'out_dir' of the task isn't set
+    RuntimeError
+        if dcm2niix exits with a non-zero return code
+    subprocess.TimeoutExpired
+        if dcm2niix doesn't complete within the timeout
+    """
+    if task.out_dir is None:
+        raise ValueError(f"'out_dir' needs to be set to run {task} outside of pydra")
+    out_dir = Path(task.out_dir).absolute()
+    if metrics is None:
+        metrics = RunMetrics(in_dir=str(task.in_dir), out_dir=str(out_dir))
+    with metrics.phase("command"):
+        argv = await asyncio.to_thread(_prepare, task, out_dir)
+    if cache is not None:
+        with metrics.phase("hash"):
+            key = await asyncio.to_thread(cache.key, task)
+        with metrics.phase("cache"):
+            names = await asyncio.to_thread(
+                cache.materialize, key, out_dir, task.filename, task.name_conflicts
+            )
+        if names is not None:
+            logger.info("Found conversion of %s in cache", task.in_dir)
+            metrics.cached = True
+            return ConversionRun(task, OutputIndex(out_dir, names), metrics=metrics)
+    with metrics.phase("dcm2niix"):
+        return_code, stdout_bytes, stderr_bytes = await run_process_async(
+            argv, timeout=timeout
+        )
+    stdout = stdout_bytes.decode(errors="replace")
+    stderr = stderr_bytes.decode(errors="replace")
+    check_return_code(return_code, task.in_dir, stderr)
+    with metrics.phase("index"):
+        index = await asyncio.to_thread(index_outputs, out_dir, stdout)
+    result = ConversionRun(task, index, return_code, stdout, stderr, metrics)
+    if cache is not None:
+        with metrics.phase("cache"):
+            await asyncio.to_thread(
+                cache.store, key, out_dir, result.names, task.filename
+            )
+    return result
+
+
+async def convert_many(
+    tasks: Iterable[Dcm2Niix] | AsyncIterable[Dcm2Niix],
+    max_concurrency: int | None = None,
+    timeout: float | None = None,
+    cache: ConversionCache | None = None,
+    metrics_file: str | Path | None = None,
+) -> AsyncIterator[ConversionResult]:
+    """Runs many Dcm2Niix tasks concurrently, yielding their results in the order they
+    complete
+
+    Tasks are drawn from the iterable lazily, so that it can be a (possibly
+    asynchronous) generator over a very large number of sessions. If the caller stops
+    iterating, the conversions still in flight are cancelled and their processes
+    killed.
+
+    Parameters
+    ----------
+    tasks : iterable[Dcm2Niix] or async iterable[Dcm2Niix]
+        the tasks to run, each of which must have 'out_dir' set
+    max_concurrency : int, optional
+        the maximum number of concurrent dcm2niix processes, by default the number of
+        CPUs
+    timeout : float, optional
+        the number of seconds after which a dcm2niix process is killed and its
+        conversion failed
+    cache : ConversionCache, optional
+        a cache to look up each conversion in
+    metrics_file : str or Path, optional
+        a JSONL file to append the metrics of each conversion to, by default the file
+        set by the 'PYDRA_DCM2NIIX_METRICS' environment variable, if any
+
+    Yields
+    ------
+    ConversionResult
+        the result of each conversion
+    """
+    max_concurrency = max_concurrency or os.cpu_count() or 1
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def convert(task: Dcm2Niix) -> ConversionResult:
+        start = time.monotonic()
+        metrics = RunMetrics(in_dir=str(task.in_dir), out_dir=str(task.out_dir))
+        outputs = error = None
+        try:
+            async with semaphore:
+                result = await run_async(
+                    task, cache=cache, timeout=timeout, metrics=metrics
+                )
+            outputs = await asyncio.to_thread(result.outputs)
+        except Exception as e:
+            logger.warning("Failed to convert %s: %s", task.in_dir, e)
+            metrics.error = f"{type(e).__name__}: {e}"
+            error = e
+        # Appending to the metrics file blocks (e.g. on network storage), so isn't
+        # done on the event loop
+        await asyncio.to_thread(record_metrics, metrics, metrics_file)
+        return ConversionResult(
+            task,
+            outputs=outputs,
+            error=error,
+            duration=time.monotonic() - start,
+            metrics=metrics,
+        )
+
+    pending: set[asyncio.Task[ConversionResult]] = set()
+    try:
+        async for task in _aiter(tasks):
+            # Keep enough conversions queued to keep the processes busy, without
+            # drawing the whole of the iterable into memory
+            if len(pending) >= 2 * max_concurrency:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield future.result()
+            pending.add(asyncio.create_task(convert(task)))
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+
+def _prepare(task: Dcm2Niix, out_dir: Path) -> list[str]:
+    """Renders the command line of a task and creates its output directory"""
+    argv = shlex.split(task.cmdline)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    return argv
+
+
+async def _aiter(
+    items: Iterable[Dcm2Niix] | AsyncIterable[Dcm2Niix],
+) -> AsyncIterator[Dcm2Niix]:
+    if isinstance(items, AsyncIterable):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
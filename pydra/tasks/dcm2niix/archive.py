@@ -0,0 +1,282 @@
+"""Converting DICOMs directly from zip/tar archives.
+
+Rather than extracting the whole archive to disk before converting it,
+:func:`convert_archive` first reads the headers of the members of the archive (see
+:func:`index_archive`) to find out which are DICOMs, which series they belong to and so
+how many instances each series has. It then streams the DICOMs out of the archive, in
+bounded chunks, into a staging directory (on tmpfs where available), and as soon as the
+last instance of a series has been extracted, the series is handed to a pool of workers
+to be converted while extraction continues. Its staging directory is removed once the
+conversion finishes. Each series is therefore converted exactly once, however its
+members are ordered in the archive.
+
+Zip archives can be read in any order, so their members are extracted series by series.
+The members of a tar archive are extracted in archive order, so series whose members are
+interleaved with those of other series are held in staging until they are complete (NB:
+reading the headers of a compressed tar archive decompresses it, so it is decompressed
+twice).
+"""
+
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import contextlib
+import logging
+import os
+from pathlib import Path
+import shutil
+import tarfile
+import tempfile
+import typing as ty
+import zipfile
+import attrs
+import pydicom
+from pydicom.errors import InvalidDicomError
+from .cache import ConversionCache
+from .convert import ConversionRun, run
+from .outputs import OutputIndex, merge_outputs
+from .utils import Dcm2Niix, collect_outputs
+
+logger = logging.getLogger("pydra.tasks.dcm2niix")
+
+# Bytes copied out of the archive at a time
+CHUNK_SIZE = 1024**2
+
+# Bytes of extracted but not yet converted DICOMs to stage before waiting for
+# conversions to complete
+MAX_STAGED_BYTES = 4 * 1024**3
+
+Member = tuple[str, int, Callable[[], ty.IO[bytes]]]
+
+
+def default_staging_root() -> Path:
+    """Returns /dev/shm if it is available, so that staged DICOMs are held in memory,
+    otherwise the default temporary directory"""
+    shm = Path("/dev/shm")
+    if shm.is_dir() and os.access(shm, os.W_OK):
+        return shm
+    return Path(tempfile.gettempdir())
+
+
+@contextlib.contextmanager
+def open_members(archive: str | Path) -> Iterator[Iterator[Member]]:
+    """Opens a zip or tar archive (optionally compressed) and iterates over the files
+    in it in archive order
+
+    Parameters
+    ----------
+    archive : str or Path
+        path to the archive
+
+    Yields
+    ------
+    Iterator[tuple[str, int, Callable[[], IO[bytes]]]]
+        the name, size and a function to open each file in the archive
+    """
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+
+            def iter_zip() -> Iterator[Member]:
+                for info in zf.infolist():
+                    if not info.is_dir():
+                        yield info.filename, info.file_size, (
+                            lambda info=info: zf.open(info)
+                        )
+
+            yield iter_zip()
+    elif tarfile.is_tarfile(archive):
+        with tarfile.open(archive, "r:*") as tf:
+
+            def iter_tar() -> Iterator[Member]:
+                for member in tf:
+                    if member.isfile():
+                        yield member.name, member.size, (
+                            lambda member=member: tf.extractfile(member)
+                        )
+
+            yield iter_tar()
+    else:
+        raise ValueError(f"{archive} is not a zip or tar archive")
+
+
+def index_archive(archive: str | Path) -> list[str | None]:
+    """Reads the headers of the members of an archive to determine which are DICOMs
+    and which series they belong to
+
+    Parameters
+    ----------
+    archive : str or Path
+        path to the archive
+
+    Returns
+    -------
+    list[str or None]
+        the series instance UID of each file in the archive, in archive order (as
+        iterated by :func:`open_members`), or None for files that aren't DICOMs
+    """
+    series: list[str | None] = []
+    names = set()
+    with open_members(archive) as members:
+        for name, _, opener in members:
+            if _ignored(name):
+                series.append(None)
+                continue
+            with opener() as f:
+                series.append(read_series_uid(f))
+            if series[-1] is not None:
+                if name in names:
+                    logger.warning(
+                        "%s contains more than one member named %s, both of which are "
+                        "converted",
+                        archive,
+                        name,
+                    )
+                names.add(name)
+    return series
+
+
+def read_series_uid(f: str | Path | ty.IO[bytes]) -> str | None:
+    """Reads the series instance UID from the header of a DICOM file
+
+    Parameters
+    ----------
+    f : str or Path or IO[bytes]
+        the file to read
+
+    Returns
+    -------
+    str or None
+        the series instance UID, or None if the file isn't a DICOM
+    """
+    try:
+        header = pydicom.dcmread(
+            f, stop_before_pixels=True, specific_tags=["SeriesInstanceUID"]
+        )
+    except (InvalidDicomError, EOFError):
+        return None
+    if "SeriesInstanceUID" not in header:
+        return None
+    return str(header.SeriesInstanceUID)
+
+
+def convert_archive(
+    archive: str | Path,
+    task: Dcm2Niix,
+    max_workers: int | None = None,
+    staging_root: str | Path | None = None,
+    max_staged_bytes: int = MAX_STAGED_BYTES,
+    cache: ConversionCache | None = None,
+) -> Dcm2Niix.Outputs:
+    """Converts the DICOMs in a zip or tar archive without extracting it in full first
+
+    Parameters
+    ----------
+    archive : str or Path
+        path to the archive
+    task : Dcm2Niix
+        the task to run on each series in the archive, the 'in_dir' of which is
+        ignored and 'out_dir' must be set
+    max_workers : int, optional
+        the maximum number of concurrent dcm2niix processes, by default the number of
+        CPUs
+    staging_root : str or Path, optional
+        the directory to extract the series into, by default /dev/shm if available
+    max_staged_bytes : int
+        the number of bytes of extracted DICOMs to stage before waiting for series to
+        be converted (exceeded if a single series is larger, or while the interleaved
+        series of a tar archive are incomplete)
+    cache : ConversionCache, optional
+        a cache to look up each series conversion in
+
+    Returns
+    -------
+    Dcm2Niix.Outputs
+        the outputs of all the series conversions combined
+    """
+    if task.out_dir is None:
+        raise ValueError(f"'out_dir' needs to be set to convert {archive}")
+    out_dir = Path(task.out_dir).absolute()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if staging_root is None:
+        staging_root = default_staging_root()
+    Path(staging_root).mkdir(parents=True, exist_ok=True)
+    series_uids = index_archive(archive)
+    # The number of instances of each series still to be extracted, in the order the
+    # series first appear in the archive
+    remaining: dict[str, int] = {}
+    for series_uid in series_uids:
+        if series_uid is not None:
+            remaining[series_uid] = remaining.get(series_uid, 0) + 1
+    order = {uid: i for i, uid in enumerate(remaining)}
+    staging_dir = Path(tempfile.mkdtemp(prefix="dcm2niix-archive-", dir=staging_root))
+    out_staging_dir = Path(tempfile.mkdtemp(prefix=".dcm2niix-", dir=out_dir))
+    staged_bytes: dict[str, int] = {}
+    pending: dict[Future[ConversionRun], str] = {}
+    runs: dict[str, ConversionRun] = {}
+
+    def convert_series(series_uid: str) -> ConversionRun:
+        in_dir = staging_dir / str(order[series_uid])
+        try:
+            return run(
+                attrs.evolve(
+                    task,
+                    in_dir=in_dir,
+                    out_dir=out_staging_dir / in_dir.name,
+                    search_depth=0,
+                ),
+                cache=cache,
+            )
+        finally:
+            shutil.rmtree(in_dir, ignore_errors=True)
+
+    def collect(done: ty.Iterable[Future[ConversionRun]]) -> None:
+        for future in done:
+            series_uid = pending.pop(future)
+            runs[series_uid] = future.result()
+            del staged_bytes[series_uid]
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+            with open_members(archive) as members:
+                dicoms: ty.Iterable[tuple[int, Member]] = (
+                    (i, m) for i, m in enumerate(members) if series_uids[i] is not None
+                )
+                if zipfile.is_zipfile(archive):
+                    # Extract the members of random-access archives series by series
+                    dicoms = sorted(dicoms, key=lambda d: order[series_uids[d[0]]])
+                for i, (name, size, opener) in dicoms:
+                    series_uid = ty.cast(str, series_uids[i])
+                    # Apply back-pressure if too much has been staged, as long as
+                    # there are conversions in flight that will free it up
+                    while pending and sum(staged_bytes.values()) >= max_staged_bytes:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    series_dir = staging_dir / str(order[series_uid])
+                    series_dir.mkdir(exist_ok=True)
+                    path = series_dir / f"{i:06d}_{Path(name).name}"
+                    with opener() as src, open(path, "wb") as dest:
+                        shutil.copyfileobj(src, dest, CHUNK_SIZE)
+                    staged_bytes[series_uid] = staged_bytes.get(series_uid, 0) + size
+                    remaining[series_uid] -= 1
+                    if not remaining[series_uid]:
+                        logger.debug("Extracted series %s from %s", series_uid, archive)
+                        pending[pool.submit(convert_series, series_uid)] = series_uid
+            collect(wait(pending).done)
+        ordered = [runs[uid] for uid in order]
+        names = merge_outputs(
+            [(r.index.out_dir, r.names) for r in ordered], out_dir, task.name_conflicts
+        )
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        shutil.rmtree(out_staging_dir, ignore_errors=True)
+    return collect_outputs(
+        task,
+        OutputIndex(out_dir, names),
+        stdout="".join(r.stdout for r in ordered),
+        stderr="".join(r.stderr for r in ordered),
+    )
+
+
+def _ignored(name: str) -> bool:
+    """Whether an archive member is skipped without reading it, i.e. hidden files and
+    DICOMDIR indices"""
+    return Path(name).name.startswith(".") or Path(name).name == "DICOMDIR"
@@ -0,0 +1,216 @@
+"""Converting large numbers of DICOM directories with a bounded pool of workers.
+
+Constructing a :class:`~pydra.tasks.dcm2niix.Dcm2Niix` task validates every one of its
+arguments (including sniffing the DICOMs in 'in_dir') and rendering its command line
+goes through pydra's argstr templating, which adds up when converting tens of
+thousands of sessions. :class:`Dcm2NiixBatch` instead renders the command line of a
+template task once per distinct set of overrides (see
+:class:`~pydra.tasks.dcm2niix.construction.TaskTemplate`) and substitutes the input and
+output directories of each job into it, running the jobs over a pool of threads (each of
+which waits on a dcm2niix process) and streaming the results back as they complete.
+No pydra hashing is performed for the jobs.
+"""
+
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import logging
+import os
+from pathlib import Path
+import time
+import typing as ty
+import attrs
+from .cache import ConversionCache
+from .compression import ParallelGzip
+from .construction import TaskTemplate
+from .convert import run_command
+from .metrics import RunMetrics, record_metrics
+from .staging import Staging
+from .tuning import TUNABLE_MODES, CompressionTuner
+from .utils import Dcm2Niix
+
+logger = logging.getLogger("pydra.tasks.dcm2niix")
+
+
+@attrs.define
+class BatchJob:
+    """A single conversion in a batch
+
+    Parameters
+    ----------
+    in_dir : Path
+        the directory containing the DICOMs to convert
+    out_dir : Path
+        the directory to write the outputs to
+    overrides : dict[str, Any]
+        arguments of the template task to override for this job
+    """
+
+    in_dir: Path = attrs.field(converter=Path)
+    out_dir: Path = attrs.field(converter=Path)
+    overrides: dict[str, ty.Any] = attrs.field(factory=dict)
+
+
+@attrs.define
+class BatchResult:
+    """The result of a job in a batch
+
+    Parameters
+    ----------
+    job : BatchJob
+        the job that was run
+    outputs : Dcm2Niix.Outputs or None
+        the outputs of the conversion, if it succeeded
+    error : Exception or None
+        the error raised by the conversion, if it failed (including
+        subprocess.TimeoutExpired if it timed out)
+    duration : float
+        the wall time the job took in seconds
+    metrics : RunMetrics, optional
+        the timings and resource usage of the job
+    """
+
+    job: BatchJob
+    outputs: Dcm2Niix.Outputs | None = None
+    error: Exception | None = None
+    duration: float = 0.0
+    metrics: RunMetrics | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@attrs.define
+class Dcm2NiixBatch:
+    """Runs many conversions with the same (or mostly the same) arguments over a pool
+    of workers
+
+    Parameters
+    ----------
+    template : Dcm2Niix
+        the task providing the arguments of the conversions, the 'in_dir' and 'out_dir'
+        of which are ignored
+    max_workers : int, optional
+        the maximum number of concurrent dcm2niix processes, by default the number of
+        CPUs
+    timeout : float, optional
+        the number of seconds after which a dcm2niix process is killed and its job
+        failed
+    cache : ConversionCache, optional
+        a cache to look up each conversion in
+    metrics_file : str or Path, optional
+        a JSONL file to append the metrics of each job to, by default the file set by
+        the 'PYDRA_DCM2NIIX_METRICS' environment variable, if any
+    compressor : ParallelGzip, optional
+        a stage shared by the jobs to compress their NIfTI images with instead of
+        dcm2niix, if the template compresses them
+    tuner : CompressionTuner, optional
+        a tuner to choose the compression mode and level of each job with, in place
+        of the 'compress' and 'compression_level' arguments of the template
+    staging : Staging, optional
+        stage each job on local scratch, committing its outputs to its output
+        directory once it has finished
+    """
+
+    template: Dcm2Niix = attrs.field(factory=Dcm2Niix)
+    max_workers: int | None = None
+    timeout: float | None = None
+    cache: ConversionCache | None = None
+    metrics_file: str | Path | None = None
+    compressor: ParallelGzip | None = None
+    tuner: CompressionTuner | None = None
+    staging: Staging | None = None
+    _tasks: TaskTemplate = attrs.field(
+        default=attrs.Factory(
+            lambda self: TaskTemplate(self.template), takes_self=True
+        ),
+        init=False,
+        repr=False,
+    )
+
+    def run(
+        self,
+        jobs: Iterable[
+            BatchJob
+            | tuple[str | Path, str | Path]
+            | tuple[str | Path, str | Path, dict[str, ty.Any]]
+        ],
+    ) -> Iterator[BatchResult]:
+        """Runs the jobs, yielding their results in the order they complete
+
+        Jobs are drawn from the iterable lazily, so that it can be a generator over a
+        very large number of directories.
+
+        Parameters
+        ----------
+        jobs : iterable[BatchJob or tuple]
+            the jobs to run, either as BatchJob objects or (in_dir, out_dir) or
+            (in_dir, out_dir, overrides) tuples
+
+        Yields
+        ------
+        BatchResult
+            the result of each job
+        """
+        max_workers = self.max_workers or os.cpu_count() or 1
+        pending: dict[Future[BatchResult], BatchJob] = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for job in jobs:
+                if not isinstance(job, BatchJob):
+                    job = BatchJob(*job)
+                # Keep enough jobs queued to keep the workers busy, without drawing
+                # the whole of the iterable into memory
+                if len(pending) >= 2 * max_workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        del pending[future]
+                        yield future.result()
+                pending[pool.submit(self._run_job, job)] = job
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del pending[future]
+                    yield future.result()
+
+    def _run_job(self, job: BatchJob) -> BatchResult:
+        start = time.monotonic()
+        out_dir = job.out_dir.absolute()
+        metrics = RunMetrics(in_dir=str(job.in_dir), out_dir=str(out_dir))
+        outputs = error = None
+        try:
+            compress = job.overrides.get("compress", self.template.compress)
+            if self.tuner is not None and compress in TUNABLE_MODES:
+                with metrics.phase("tune"):
+                    metrics.compression = self.tuner.choose(out_dir)
+                job = attrs.evolve(
+                    job, overrides={**job.overrides, **metrics.compression.overrides()}
+                )
+            with metrics.phase("command"):
+                # The input directory of the first job is used to render the
+                # command-line template of its overrides
+                command = self._tasks.command(job.in_dir, **job.overrides)
+                argv = command.render(job.in_dir.absolute(), out_dir)
+            result = run_command(
+                command.task,
+                argv,
+                job.in_dir,
+                out_dir,
+                cache=self.cache,
+                timeout=self.timeout,
+                metrics=metrics,
+                compressor=self.compressor,
+                staging=self.staging,
+            )
+            outputs = result.outputs()
+        except Exception as e:
+            logger.warning("Failed to convert %s: %s", job.in_dir, e)
+            metrics.error = f"{type(e).__name__}: {e}"
+            error = e
+        record_metrics(metrics, self.metrics_file)
+        return BatchResult(
+            job,
+            outputs=outputs,
+            error=error,
+            duration=time.monotonic() - start,
+            metrics=metrics,
+        )
@@ -0,0 +1,350 @@
+"""A content-addressed cache of dcm2niix conversions.
+
+Conversions are keyed by the identity of the DICOM series being converted (their study,
+series and SOP instance UIDs), the version of dcm2niix and the arguments that affect the
+conversion (including any separate compression stage), rather than by the paths of the
+inputs, so that the same series converted from a different location (e.g. an
+overlapping project export) is still a cache hit. Cached outputs are materialised into
+a hidden staging directory within the output directory by hard-link, or reflink where
+hard-links aren't possible, falling back to a copy, and then merged into the output
+directory in the same way as the outputs of a conversion split by series, honouring
+its 'name_conflicts' argument.
+
+NB: outputs materialised by hard-link share their storage with the cache, so should be
+treated as read-only.
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import typing as ty
+import uuid
+from pydra.utils.general import attrs_values
+from .dicom import series_identity
+from .outputs import merge_outputs
+from .utils import dcm2niix_version
+
+if ty.TYPE_CHECKING:
+    from .compression import ParallelGzip
+    from .utils import Dcm2Niix
+
+logger = logging.getLogger("pydra.tasks.dcm2niix")
+
+# Inputs that don't affect the content of the outputs of a conversion
+NON_CONVERSION_ARGS = (
+    "in_dir",
+    "out_dir",
+    "file_postfix",
+    "verbose",
+    "progress",
+    "executable",
+)
+
+LINK_METHODS = ("hardlink", "reflink", "copy")
+
+# ioctl request to clone a file's extents (Linux)
+FICLONE = 0x40049409
+
+ENTRY_FILE = "entry.json"
+
+
+def conversion_args(task: "Dcm2Niix") -> dict[str, ty.Any]:
+    """Returns the arguments of a task that affect the content of its outputs"""
+    return {n: v for n, v in attrs_values(task).items() if n not in NON_CONVERSION_ARGS}
+
+
+def compression_stage(
+    task: "Dcm2Niix", compressor: "ParallelGzip | None"
+) -> dict[str, ty.Any] | None:
+    """Returns the settings of the compression stage that compresses the outputs of a
+    task in place of dcm2niix, or None if dcm2niix compresses them itself"""
+    if compressor is None or not compressor.compresses(task):
+        return None
+    return {
+        "level": compressor.level,
+        "block_size": compressor.block_size,
+        "indexed": compressor.indexed,
+    }
+
+
+def link_or_copy(src: Path, dest: Path, method: str = "hardlink") -> None:
+    """Materialises 'src' at 'dest', by hard-link, reflink or copy. Methods fall
+    through to the next in the list if they aren't supported by the file-system(s)
+
+    Parameters
+    ----------
+    src : Path
+        the file to materialise
+    dest : Path
+        the path to materialise it at
+    method : str
+        the preferred method, one of 'hardlink', 'reflink' or 'copy'
+    """
+    if method not in LINK_METHODS:
+        raise ValueError(f"Unrecognised link method {method!r}, not in {LINK_METHODS}")
+    # Replace rather than write through existing files, which may themselves be
+    # linked to other copies
+    dest.unlink(missing_ok=True)
+    if method == "hardlink":
+        try:
+            os.link(src, dest)
+            return
+        except OSError:
+            pass
+    if method in ("hardlink", "reflink"):
+        try:
+            import fcntl
+
+            with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+                fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+            return
+        except (OSError, ImportError):
+            pass
+    shutil.copyfile(src, dest)
+
+
+class ConversionCache:
+    """A size-capped cache of conversion outputs with least-recently-used eviction,
+    which can be shared between concurrent processes (e.g. on scratch space)
+
+    Parameters
+    ----------
+    root : str or Path
+        the directory to store the cache in
+    max_bytes : int, optional
+        the maximum total size of the cached outputs, beyond which the least recently
+        used entries are evicted. Unlimited by default
+    link_method : str
+        how cached files are materialised into the output directory and vice versa,
+        one of 'hardlink', 'reflink' or 'copy'
+    """
+
+    def __init__(
+        self,
+        root: str | Path,
+        max_bytes: int | None = None,
+        link_method: str = "hardlink",
+    ):
+        if link_method not in LINK_METHODS:
+            raise ValueError(
+                f"Unrecognised link method {link_method!r}, not in {LINK_METHODS}"
+            )
+        self.root = Path(root).absolute()
+        self.max_bytes = max_bytes
+        self.link_method = link_method
+        self.entries_dir.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def entries_dir(self) -> Path:
+        return self.root / "entries"
+
+    @property
+    def tmp_dir(self) -> Path:
+        return self.root / "tmp"
+
+    def key(
+        self,
+        task: "Dcm2Niix",
+        in_dir: str | Path | None = None,
+        compressor: "ParallelGzip | None" = None,
+        max_workers: int | None = None,
+    ) -> str:
+        """Computes the cache key of a conversion
+
+        Parameters
+        ----------
+        task : Dcm2Niix
+            the conversion task
+        in_dir : str or Path, optional
+            the directory the task converts, if different from its 'in_dir'
+        compressor : ParallelGzip, optional
+            the stage the images are compressed with instead of dcm2niix, if any
+        max_workers : int, optional
+            the number of threads to read the DICOM headers with
+
+        Returns
+        -------
+        str
+            the hex digest identifying the conversion
+        """
+        args = conversion_args(task)
+        # Outputs are renamed when they are materialised, so a literal filename
+        # doesn't need to be included in the key, only templated ones do
+        if "%" not in task.filename:
+            del args["filename"]
+        payload = {
+            "identity": series_identity(
+                task.in_dir if in_dir is None else in_dir,
+                task.search_depth,
+                max_workers=max_workers,
+            ),
+            "version": dcm2niix_version(task.executable),
+            "args": args,
+            "compression_stage": compression_stage(task, compressor),
+        }
+        return hashlib.sha256(
+            json.dumps(payload, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def entry_dir(self, key: str) -> Path:
+        return self.entries_dir / key
+
+    def materialize(
+        self,
+        key: str,
+        out_dir: str | Path,
+        filename: str,
+        name_conflicts: int | None = None,
+    ) -> list[str] | None:
+        """Materialises the cached outputs of a conversion into the output directory
+
+        Parameters
+        ----------
+        key : str
+            the cache key of the conversion
+        out_dir : str or Path
+            the directory to materialise the outputs in
+        filename : str
+            the filename the conversion was requested with, which replaces the one the
+            outputs were cached under
+        name_conflicts : int, optional
+            how outputs that clash with existing files are handled, following
+            dcm2niix's 'name_conflicts' (-w) argument (see
+            :func:`~pydra.tasks.dcm2niix.outputs.merge_outputs`)
+
+        Returns
+        -------
+        list[str] or None
+            the names of the materialised files relative to the output directory, or
+            None if the conversion isn't in the cache
+        """
+        entry_dir = self.entry_dir(key)
+        try:
+            entry = json.loads((entry_dir / ENTRY_FILE).read_text())
+        except FileNotFoundError:
+            return None
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        # Materialise the outputs alongside the output directory first, so that they
+        # can be merged into it like the outputs of a conversion
+        staging_dir = Path(tempfile.mkdtemp(prefix=".dcm2niix-", dir=out_dir))
+        try:
+            staged = []
+            for cached_name in entry["files"]:
+                name = self._rename(cached_name, entry["filename"], filename)
+                dest = staging_dir / name
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    link_or_copy(entry_dir / cached_name, dest, self.link_method)
+                except FileNotFoundError:
+                    # The entry was evicted by another process while we were
+                    # reading it
+                    return None
+                staged.append(name)
+            names = merge_outputs([(staging_dir, staged)], out_dir, name_conflicts)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        # Touch the entry to mark it as recently used
+        try:
+            os.utime(entry_dir / ENTRY_FILE)
+        except FileNotFoundError:
+            pass  # Evicted since, but the materialised links are still valid
+        logger.debug("Materialised cached conversion %s into %s", key, out_dir)
+        return names
+
+    def store(
+        self, key: str, out_dir: str | Path, names: ty.Sequence[str], filename: str
+    ) -> None:
+        """Stores the outputs of a conversion in the cache, then evicts the least
+        recently used entries if the cache has grown beyond its size cap
+
+        Parameters
+        ----------
+        key : str
+            the cache key of the conversion
+        out_dir : str or Path
+            the directory the outputs were written to
+        names : sequence[str]
+            the names of the output files relative to the output directory
+        filename : str
+            the filename the conversion was run with
+        """
+        if self.entry_dir(key).exists():
+            return
+        out_dir = Path(out_dir)
+        tmp_dir = self.tmp_dir / uuid.uuid4().hex
+        tmp_dir.mkdir()
+        size = 0
+        for name in names:
+            dest = tmp_dir / name
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(out_dir / name, dest, self.link_method)
+            size += dest.stat().st_size
+        (tmp_dir / ENTRY_FILE).write_text(
+            json.dumps({"filename": filename, "files": list(names), "size": size})
+        )
+        try:
+            tmp_dir.rename(self.entry_dir(key))
+        except OSError as e:
+            # Another process stored the same conversion first
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            shutil.rmtree(tmp_dir)
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def evict(self, max_bytes: int) -> None:
+        """Evicts the least recently used entries until the total size of the cache is
+        no more than 'max_bytes'
+
+        Parameters
+        ----------
+        max_bytes : int
+            the size to reduce the cache to
+        """
+        entries = []
+        for entry_dir in self.entries_dir.iterdir():
+            try:
+                entry_file = entry_dir / ENTRY_FILE
+                last_used = entry_file.stat().st_mtime_ns
+                size = json.loads(entry_file.read_text())["size"]
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            entries.append((last_used, size, entry_dir))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= max_bytes:
+                break
+            # Move the entry out of the way before deleting it, so concurrent readers
+            # never see it in a partially deleted state
+            tmp_dir = self.tmp_dir / uuid.uuid4().hex
+            try:
+                entry_dir.rename(tmp_dir)
+            except FileNotFoundError:
+                continue  # Already evicted by another process
+            shutil.rmtree(tmp_dir)
+            total -= size
+            logger.debug("Evicted %s from conversion cache", entry_dir.name)
+
+    @property
+    def size(self) -> int:
+        """The total size of the cached outputs in bytes"""
+        total = 0
+        for entry_file in self.entries_dir.glob(f"*/{ENTRY_FILE}"):
+            try:
+                total += json.loads(entry_file.read_text())["size"]
+            except FileNotFoundError:
+                continue
+        return total
+
+    @staticmethod
+    def _rename(name: str, cached_filename: str, filename: str) -> str:
+        if "%" not in filename and name.startswith(cached_filename):
+            return filename + name[len(cached_filename) :]
+        return name
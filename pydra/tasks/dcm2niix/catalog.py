@@ -0,0 +1,304 @@
+"""Header-only catalog of the DICOM series in an input directory.
+
+The directory is walked in the same way as dcm2niix (honouring its search depth) and the
+header of each file is read up to, but not including, its pixel data, over a pool of
+threads. The headers are then summarised per series into a compact
+:class:`DicomCatalog`, which is cached on disk keyed by the state of the directory (the
+paths, sizes and modification times of its files), so that repeat scans of an unchanged
+directory only need to stat its files.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import tempfile
+import typing as ty
+import attrs
+from pydicom.multival import MultiValue
+from .dicom import DEFAULT_SEARCH_DEPTH, iter_dicom_files, read_headers
+from .utils import cache_root
+
+logger = logging.getLogger("pydra.tasks.dcm2niix")
+
+# Incremented when the format of the catalog changes to invalidate cached catalogs
+CATALOG_VERSION = 1
+
+CATALOG_TAGS = (
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "SeriesNumber",
+    "SeriesDescription",
+    "ProtocolName",
+    "Modality",
+    "SOPClassUID",
+    "ImageType",
+    "EchoNumbers",
+    "NumberOfFrames",
+)
+
+
+@attrs.define
+class SeriesInfo:
+    """Summary of the headers of the instances of a DICOM series
+
+    Parameters
+    ----------
+    series_uid : str
+        the series instance UID
+    study_uid : str
+        the study instance UID
+    series_number : int or None
+        the series number
+    series_description : str
+        the series description
+    protocol_name : str
+        the protocol name
+    modality : str
+        the modality, e.g. 'MR'
+    sop_class_uids : list[str]
+        the SOP classes of the instances in the series
+    transfer_syntaxes : list[str]
+        the transfer syntaxes the instances are encoded with
+    image_types : list[list[str]]
+        the distinct image types of the instances
+    echo_numbers : list[int]
+        the distinct echo numbers of the instances
+    num_frames : int
+        the total number of frames across the instances
+    total_bytes : int
+        the total size of the files of the series
+    files : list[str]
+        the paths of the files of the series relative to the catalogued directory
+    """
+
+    series_uid: str
+    study_uid: str = ""
+    series_number: int | None = None
+    series_description: str = ""
+    protocol_name: str = ""
+    modality: str = ""
+    sop_class_uids: list[str] = attrs.field(factory=list)
+    transfer_syntaxes: list[str] = attrs.field(factory=list)
+    image_types: list[list[str]] = attrs.field(factory=list)
+    echo_numbers: list[int] = attrs.field(factory=list)
+    num_frames: int = 0
+    total_bytes: int = 0
+    files: list[str] = attrs.field(factory=list)
+
+    @property
+    def num_instances(self) -> int:
+        return len(self.files)
+
+    @property
+    def derived(self) -> bool:
+        """Whether all instances of the series are derived images"""
+        return bool(self.image_types) and all(
+            t[:1] == ["DERIVED"] for t in self.image_types
+        )
+
+    @property
+    def localizer(self) -> bool:
+        """Whether the series is a localizer"""
+        return any("LOCALIZER" in t for t in self.image_types)
+
+
+@attrs.define
+class DicomCatalog:
+    """Per-series catalog of the DICOMs in a directory
+
+    Parameters
+    ----------
+    root : Path
+        the catalogued directory
+    series : dict[str, SeriesInfo]
+        the series in the directory keyed by their instance UIDs, ordered by series
+        number and then UID
+    non_dicom : list[str]
+        the paths of files that aren't DICOMs relative to the root
+    """
+
+    root: Path = attrs.field(converter=Path)
+    series: dict[str, SeriesInfo] = attrs.field(factory=dict)
+    non_dicom: list[str] = attrs.field(factory=list)
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(s.total_bytes for s in self.series.values())
+
+    @property
+    def num_files(self) -> int:
+        return sum(s.num_instances for s in self.series.values())
+
+    def paths(self, series_uid: str) -> list[Path]:
+        """Returns the absolute paths of the files of a series"""
+        return [self.root / f for f in self.series[series_uid].files]
+
+    @classmethod
+    def build(
+        cls,
+        in_dir: str | Path,
+        search_depth: int | None = None,
+        max_workers: int | None = None,
+        paths: ty.Sequence[Path] | None = None,
+    ) -> "DicomCatalog":
+        """Builds the catalog by reading the headers of all files in the directory
+
+        Parameters
+        ----------
+        in_dir : str or Path
+            the directory containing the DICOMs
+        search_depth : int, optional
+            the number of levels of sub-directories to search
+        max_workers : int, optional
+            the number of threads to read the headers with
+        paths : sequence[Path], optional
+            the files in the directory, if they have already been walked
+
+        Returns
+        -------
+        DicomCatalog
+            the catalog
+        """
+        root = Path(in_dir).absolute()
+        if paths is None:
+            paths = list(iter_dicom_files(root, search_depth))
+        headers = read_headers(paths, CATALOG_TAGS, max_workers)
+        series: dict[str, SeriesInfo] = {}
+        non_dicom = []
+        for path, header in zip(paths, headers):
+            relpath = os.path.relpath(path, root)
+            if header is None or "SeriesInstanceUID" not in header:
+                non_dicom.append(relpath)
+                continue
+            uid = str(header.SeriesInstanceUID)
+            try:
+                info = series[uid]
+            except KeyError:
+                number = header.get("SeriesNumber")
+                info = series[uid] = SeriesInfo(
+                    series_uid=uid,
+                    study_uid=str(header.get("StudyInstanceUID", "")),
+                    series_number=int(number) if number not in (None, "") else None,
+                    series_description=str(header.get("SeriesDescription", "")),
+                    protocol_name=str(header.get("ProtocolName", "")),
+                    modality=str(header.get("Modality", "")),
+                )
+            _add_unique(info.sop_class_uids, str(header.get("SOPClassUID", "")))
+            _add_unique(
+                info.transfer_syntaxes,
+                str(header.file_meta.get("TransferSyntaxUID", "")),
+            )
+            image_type = header.get("ImageType")
+            if image_type:
+                if isinstance(image_type, str):
+                    image_type = [image_type]
+                _add_unique(info.image_types, [str(t) for t in image_type])
+            echo = header.get("EchoNumbers")
+            # Instances that combine echoes can list several, the first of which is
+            # taken as theirs
+            if isinstance(echo, MultiValue):
+                echo = echo[0] if len(echo) else None
+            if echo not in (None, ""):
+                try:
+                    _add_unique(info.echo_numbers, int(echo))
+                except (TypeError, ValueError):
+                    pass
+            info.num_frames += int(header.get("NumberOfFrames") or 1)
+            info.total_bytes += path.stat().st_size
+            info.files.append(relpath)
+        for info in series.values():
+            info.echo_numbers.sort()
+        ordered = sorted(
+            series.values(), key=lambda s: (s.series_number or 0, s.series_uid)
+        )
+        return cls(
+            root=root,
+            series={s.series_uid: s for s in ordered},
+            non_dicom=non_dicom,
+        )
+
+    def to_dict(self) -> dict[str, ty.Any]:
+        return {
+            "root": str(self.root),
+            "series": [attrs.asdict(s) for s in self.series.values()],
+            "non_dicom": self.non_dicom,
+        }
+
+    @classmethod
+    def from_dict(cls, dct: dict[str, ty.Any]) -> "DicomCatalog":
+        series = [SeriesInfo(**s) for s in dct["series"]]
+        return cls(
+            root=dct["root"],
+            series={s.series_uid: s for s in series},
+            non_dicom=dct["non_dicom"],
+        )
+
+
+def load_catalog(
+    in_dir: str | Path,
+    search_depth: int | None = None,
+    max_workers: int | None = None,
+    cache_dir: str | Path | None = None,
+    use_cache: bool = True,
+) -> DicomCatalog:
+    """Returns the catalog of the DICOMs in a directory, loading it from the on-disk
+    cache if the directory hasn't changed since it was last catalogued
+
+    Parameters
+    ----------
+    in_dir : str or Path
+        the directory containing the DICOMs
+    search_depth : int, optional
+        the number of levels of sub-directories to search
+    max_workers : int, optional
+        the number of threads to read the headers with
+    cache_dir : str or Path, optional
+        the directory to cache catalogs in, by default 'catalogs' within the package's
+        cache root (see :func:`~pydra.tasks.dcm2niix.utils.cache_root`)
+    use_cache : bool
+        whether to look up and store the catalog in the cache
+
+    Returns
+    -------
+    DicomCatalog
+        the catalog of the directory
+    """
+    root = Path(in_dir).absolute()
+    if search_depth is None:
+        search_depth = DEFAULT_SEARCH_DEPTH
+    paths = list(iter_dicom_files(root, search_depth))
+    if not use_cache:
+        return DicomCatalog.build(root, search_depth, max_workers, paths=paths)
+    if cache_dir is None:
+        cache_dir = cache_root() / "catalogs"
+    cache_dir = Path(cache_dir)
+    # Key the catalog by the state of the directory
+    h = hashlib.sha256(f"{CATALOG_VERSION}:{root}:{search_depth}".encode())
+    for path in paths:
+        st = path.stat()
+        h.update(f"\0{path}:{st.st_size}:{st.st_mtime_ns}".encode())
+    cache_file = cache_dir / (h.hexdigest() + ".json")
+    try:
+        catalog = DicomCatalog.from_dict(json.loads(cache_file.read_text()))
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        pass
+    else:
+        logger.debug("Loaded catalog of %s from %s", root, cache_file)
+        return catalog
+    catalog = DicomCatalog.build(root, search_depth, max_workers, paths=paths)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file and move it into place so that concurrent readers
+    # never see a partially written catalog
+    with tempfile.NamedTemporaryFile(
+        "w", dir=cache_dir, suffix=".tmp", delete=False
+    ) as tmp_file:
+        json.dump(catalog.to_dict(), tmp_file)
+    os.replace(tmp_file.name, cache_file)
+    return catalog
+
+
+def _add_unique(lst: list[ty.Any], item: ty.Any) -> None:
+    if item not in lst:
+        lst.append(item)
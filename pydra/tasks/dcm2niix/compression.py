@@ -0,0 +1,451 @@
+"""Compressing the NIfTI images written by dcm2niix in a separate, multi-core stage.
+
+When asked to compress its outputs, dcm2niix does so within its own process, either
+single-threaded with its internal miniz implementation or by piping to pigz, after each
+image has been converted. With a :class:`ParallelGzip` stage, dcm2niix is instead run
+with '-z n' and each image is compressed as soon as dcm2niix moves on to the next
+series (i.e. the next "Convert ..." line is printed to its stdout), while the remaining
+series are still being converted.
+
+Images are compressed block-parallel in the same way as pigz: the image is split into
+fixed-size blocks, which are deflated concurrently on a pool of threads (zlib releases
+the GIL), each primed with the last 32 KiB of the preceding block as its dictionary and
+flushed to a byte boundary, so that the blocks can simply be concatenated into a single
+standard gzip stream.
+
+Images can also be written "indexed", in which case the blocks aren't primed with the
+preceding block, so that each can be inflated on its own, and the compressed offset
+of each block is written to a sidecar index ('<image>.nii.gz.idx'). The image is still
+a standard gzip file, but :class:`IndexedGzipReader` can use the index to read any byte
+range (e.g. a single volume of a 4D image) by inflating only the blocks it spans.
+"""
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+from pathlib import Path
+import struct
+import threading
+import typing as ty
+import zlib
+import attrs
+from .utils import GZIP_MODES
+
+if ty.TYPE_CHECKING:
+    from .utils import Dcm2Niix
+
+# The size of the deflate window, which is the most of the preceding block that can be
+# referenced by the next
+DICT_SIZE = 32 * 1024
+
+DEFAULT_BLOCK_SIZE = 1024**2
+
+# Header of a gzip member without a filename or modification time
+GZIP_HEADER = b"\x1f\x8b\x08\x00" + bytes(4) + b"\x00\xff"
+
+# Layout of the header of a sidecar index: magic, version, block size, uncompressed
+# size and number of blocks, which is followed by the compressed offset of each block
+INDEX_MAGIC = b"NIIGZIDX"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<8sIQQQ")
+INDEX_EXT = ".idx"
+
+
+def deflate_block(data: bytes, zdict: bytes, level: int, last: bool) -> bytes:
+    """Deflates a block of data into raw deflate format, ending on a byte boundary so
+    that it can be concatenated with the deflated blocks either side of it
+
+    Parameters
+    ----------
+    data : bytes
+        the block to compress
+    zdict : bytes
+        the end of the preceding block, which the block can reference
+    level : int
+        the compression level (1-9)
+    last : bool
+        whether the block is the last in the stream
+
+    Returns
+    -------
+    bytes
+        the deflated block
+    """
+    kwargs = {"zdict": zdict} if zdict else {}
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, **kwargs)
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+
+
+def gzip_file(
+    src: str | Path,
+    dest: str | Path | None = None,
+    level: int = 6,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    pool: ThreadPoolExecutor | None = None,
+    max_pending: int | None = None,
+    indexed: bool = False,
+) -> Path:
+    """Compresses a file with gzip, deflating its blocks in parallel, and removes the
+    uncompressed file
+
+    Parameters
+    ----------
+    src : str or Path
+        the file to compress
+    dest : str or Path, optional
+        the path to write the compressed file to, by default the source with '.gz'
+        appended
+    level : int
+        the compression level (1-9)
+    block_size : int
+        the size of the blocks to deflate in parallel
+    pool : ThreadPoolExecutor, optional
+        the pool to deflate the blocks on, by default they are deflated serially
+    max_pending : int, optional
+        the maximum number of blocks to read ahead of the one being written, by
+        default twice the number of workers in the pool
+    indexed : bool
+        whether to deflate the blocks independently of each other and write an index
+        of their offsets alongside the compressed file (see :class:`IndexedGzipReader`)
+
+    Returns
+    -------
+    Path
+        the compressed file
+    """
+    src = Path(src)
+    dest = Path(dest) if dest is not None else src.with_name(src.name + ".gz")
+    if max_pending is None:
+        max_pending = 2 * (pool._max_workers if pool is not None else 1)
+    # Write to a temporary file so that a partially compressed file is never seen at
+    # the final path
+    tmp = dest.with_name(f".{dest.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    crc = size = 0
+    pending: deque[Future[bytes] | bytes] = deque()
+    offsets = []
+    try:
+        with open(src, "rb") as fin, open(tmp, "wb") as fout:
+            fout.write(GZIP_HEADER)
+            offset = len(GZIP_HEADER)
+            block = fin.read(block_size)
+            zdict = b""
+            while True:
+                next_block = fin.read(block_size) if block else b""
+                last = not next_block
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                if pool is not None:
+                    pending.append(
+                        pool.submit(deflate_block, block, zdict, level, last)
+                    )
+                else:
+                    pending.append(deflate_block(block, zdict, level, last))
+                if not indexed:
+                    zdict = block[-DICT_SIZE:]
+                while pending and (last or len(pending) >= max_pending):
+                    deflated = pending.popleft()
+                    if isinstance(deflated, Future):
+                        deflated = deflated.result()
+                    fout.write(deflated)
+                    offsets.append(offset)
+                    offset += len(deflated)
+                if last:
+                    break
+                block = next_block
+            fout.write(struct.pack("<II", crc & 0xFFFFFFFF, size & 0xFFFFFFFF))
+        if indexed:
+            write_index(
+                dest.with_name(dest.name + INDEX_EXT), block_size, size, offsets
+            )
+        os.replace(tmp, dest)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    src.unlink()
+    return dest
+
+
+def write_index(
+    path: str | Path, block_size: int, size: int, offsets: ty.Sequence[int]
+) -> None:
+    """Writes the sidecar index of an indexed gzip file
+
+    Parameters
+    ----------
+    path : str or Path
+        the path to write the index to
+    block_size : int
+        the uncompressed size of each block
+    size : int
+        the total uncompressed size
+    offsets : sequence[int]
+        the offset of each deflated block within the compressed file
+    """
+    header = INDEX_HEADER.pack(
+        INDEX_MAGIC, INDEX_VERSION, block_size, size, len(offsets)
+    )
+    Path(path).write_bytes(header + struct.pack(f"<{len(offsets)}Q", *offsets))
+
+
+class IndexedGzipReader:
+    """Reads byte ranges of a gzip file written with an index by :func:`gzip_file`,
+    inflating only the blocks that they span
+
+    Parameters
+    ----------
+    path : str or Path
+        the gzip file, alongside which the index ('<path>.idx') is expected
+
+    Examples
+    --------
+    >>> with IndexedGzipReader("func.nii.gz") as reader:  # doctest: +SKIP
+    ...     volume = reader.read_volume(200)
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        index = self.path.with_name(self.path.name + INDEX_EXT).read_bytes()
+        magic, version, self.block_size, self.size, num_blocks = (
+            INDEX_HEADER.unpack_from(index)
+        )
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"{self.path} doesn't have a recognised index")
+        self.offsets = struct.unpack_from(f"<{num_blocks}Q", index, INDEX_HEADER.size)
+        self._file = open(self.path, "rb")
+        # The end of the deflated blocks, before the gzip trailer
+        self._end = self._file.seek(0, os.SEEK_END) - 8
+        self._nifti_header: tuple[int, int, int] | None = None
+
+    def read(self, offset: int, size: int) -> bytes:
+        """Reads a range of the uncompressed data
+
+        Parameters
+        ----------
+        offset : int
+            the offset of the range within the uncompressed data
+        size : int
+            the size of the range
+
+        Returns
+        -------
+        bytes
+            the uncompressed data in the range
+        """
+        if offset < 0 or offset + size > self.size:
+            raise ValueError(
+                f"Range {offset}-{offset + size} is outside of the {self.size} bytes "
+                f"of {self.path}"
+            )
+        if not size:
+            return b""
+        first = offset // self.block_size
+        last = (offset + size - 1) // self.block_size
+        start = self.offsets[first]
+        end = self.offsets[last + 1] if last + 1 < len(self.offsets) else self._end
+        self._file.seek(start)
+        data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(
+            self._file.read(end - start)
+        )
+        skip = offset - first * self.block_size
+        return data[skip : skip + size]
+
+    def volume_range(self, volume: int) -> tuple[int, int]:
+        """Returns the offset and size of a volume of a NIfTI image
+
+        Parameters
+        ----------
+        volume : int
+            the index of the volume (along the 4th dimension) of the image
+
+        Returns
+        -------
+        offset : int
+            the offset of the volume within the uncompressed image
+        size : int
+            the size of the volume in bytes
+        """
+        if self._nifti_header is None:
+            self._nifti_header = nifti_layout(self.read(0, min(self.size, 544)))
+        vox_offset, volume_size, num_volumes = self._nifti_header
+        if not 0 <= volume < num_volumes:
+            raise IndexError(f"{self.path} has {num_volumes} volumes, not {volume + 1}")
+        return vox_offset + volume * volume_size, volume_size
+
+    def read_volume(self, volume: int) -> bytes:
+        """Reads the data of a single volume of a NIfTI image
+
+        Parameters
+        ----------
+        volume : int
+            the index of the volume (along the 4th dimension) of the image
+
+        Returns
+        -------
+        bytes
+            the voxel data of the volume
+        """
+        return self.read(*self.volume_range(volume))
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "IndexedGzipReader":
+        return self
+
+    def __exit__(self, *args: ty.Any) -> None:
+        self.close()
+
+
+def nifti_layout(header: bytes) -> tuple[int, int, int]:
+    """Reads the layout of the voxel data from a NIfTI-1 or NIfTI-2 header
+
+    Parameters
+    ----------
+    header : bytes
+        the start of the image, including the header
+
+    Returns
+    -------
+    vox_offset : int
+        the offset of the voxel data
+    volume_size : int
+        the size of each volume (3D sub-image) in bytes
+    num_volumes : int
+        the number of volumes, i.e. the product of the 4th and higher dimensions
+    """
+    for endian in "<>":
+        sizeof_hdr = struct.unpack_from(endian + "i", header)[0]
+        if sizeof_hdr == 348:
+            dims = struct.unpack_from(endian + "8h", header, 40)
+            bitpix = struct.unpack_from(endian + "h", header, 72)[0]
+            vox_offset = int(struct.unpack_from(endian + "f", header, 108)[0])
+            break
+        if sizeof_hdr == 540:
+            bitpix = struct.unpack_from(endian + "h", header, 14)[0]
+            dims = struct.unpack_from(endian + "8q", header, 16)
+            vox_offset = struct.unpack_from(endian + "q", header, 168)[0]
+            break
+    else:
+        raise ValueError("Not a NIfTI-1 or NIfTI-2 image")
+    ndim = dims[0]
+    volume_size = bitpix // 8
+    for dim in dims[1 : min(ndim, 3) + 1]:
+        volume_size *= dim
+    num_volumes = 1
+    for dim in dims[4 : ndim + 1]:
+        num_volumes *= dim
+    return vox_offset, volume_size, num_volumes
+
+
+@attrs.define
+class ParallelGzip:
+    """A compression stage that gzips the NIfTI images written by dcm2niix on a pool
+    of threads, in place of dcm2niix compressing them itself
+
+    Images are compressed 'max_files' at a time (one by default) in the order they are
+    submitted, with the blocks of each image deflated in parallel. The stage can be
+    shared between concurrent conversions, but with the default of one file at a time
+    the images of all of them are queued behind each other, so when many conversions
+    share the stage 'max_files' should be raised towards the number of conversions run
+    at once so that a large image doesn't hold up the small images of the others.
+    Only NIfTI images are compressed, so conversions that export NRRD are left to
+    dcm2niix to compress (see :meth:`compresses`).
+
+    Parameters
+    ----------
+    level : int, optional
+        the compression level (1-9), by default the 'compression_level' of the task
+        or 6
+    max_workers : int, optional
+        the number of threads to deflate blocks on, by default the number of CPUs
+    block_size : int
+        the size of the blocks to deflate in parallel
+    indexed : bool
+        whether to write the images with an index for random access, see
+        :class:`IndexedGzipReader`
+    max_files : int
+        the number of images to compress at once, which share the threads deflating
+        the blocks
+    """
+
+    level: int | None = None
+    max_workers: int | None = None
+    block_size: int = DEFAULT_BLOCK_SIZE
+    indexed: bool = False
+    max_files: int = 1
+    _block_pool: ThreadPoolExecutor | None = attrs.field(
+        default=None, init=False, repr=False
+    )
+    _file_pool: ThreadPoolExecutor | None = attrs.field(
+        default=None, init=False, repr=False
+    )
+    _lock: threading.Lock = attrs.field(factory=threading.Lock, init=False, repr=False)
+
+    def compresses(self, task: "Dcm2Niix") -> bool:
+        """Whether the stage compresses the images of a task in place of dcm2niix,
+        i.e. if the task compresses them with gzip and writes them as NIfTI
+
+        Parameters
+        ----------
+        task : Dcm2Niix
+            the conversion task
+
+        Returns
+        -------
+        bool
+            whether the stage compresses the task's images
+        """
+        return task.compress in GZIP_MODES and task.export_nrrd != "y"
+
+    def submit(self, path: str | Path, level: int | None = None) -> Future[Path]:
+        """Queues a NIfTI image to be compressed, replacing it with a '.gz' file
+
+        Parameters
+        ----------
+        path : str or Path
+            the image to compress
+        level : int, optional
+            the compression level, if the stage doesn't set one
+
+        Returns
+        -------
+        Future[Path]
+            the compressed image
+        """
+        if self.level is not None:
+            level = self.level
+        elif level is None:
+            level = 6
+        with self._lock:
+            if self._file_pool is None:
+                self._block_pool = ThreadPoolExecutor(
+                    max_workers=self.max_workers or os.cpu_count(),
+                    thread_name_prefix="dcm2niix-gzip-block",
+                )
+                self._file_pool = ThreadPoolExecutor(
+                    max_workers=self.max_files, thread_name_prefix="dcm2niix-gzip"
+                )
+        return self._file_pool.submit(
+            gzip_file,
+            path,
+            level=level,
+            block_size=self.block_size,
+            pool=self._block_pool,
+            indexed=self.indexed,
+        )
+
+    def shutdown(self) -> None:
+        """Waits for queued images to be compressed and releases the threads"""
+        with self._lock:
+            if self._file_pool is not None:
+                self._file_pool.shutdown()
+                self._block_pool.shutdown()  # type: ignore[union-attr]
+                self._file_pool = self._block_pool = None
+
+    def __enter__(self) -> "ParallelGzip":
+        return self
+
+    def __exit__(self, *args: ty.Any) -> None:
+        self.shutdown()
@@ -0,0 +1,195 @@
+"""Constructing large numbers of Dcm2Niix tasks that share most of their arguments.
+
+Constructing a :class:`~pydra.tasks.dcm2niix.Dcm2Niix` task coerces and validates each
+of its ~35 arguments, and rendering its command line goes through pydra's argstr
+templating for each of them, which adds up when a workflow is split over tens of
+thousands of sessions. A :class:`TaskTemplate` holds an immutable copy of a task
+providing the common arguments, from which the task of each job is copied with only
+its per-job arguments (typically 'in_dir' and 'out_dir') set, and so coerced and
+validated. Command lines are rendered once per distinct set of overrides into a
+:class:`CommandTemplate`, into which the input and output directories of each job are
+substituted.
+"""
+
+import copy
+from pathlib import Path
+import shlex
+import typing as ty
+import attrs
+from .utils import Dcm2Niix
+
+# Substituted for the output directory when rendering the command-line template
+OUT_DIR_PLACEHOLDER = Path("/__dcm2niix_batch_out_dir__")
+
+
+@attrs.define
+class CommandTemplate:
+    """The command line rendered from a template task, with the positions of the input
+    and output directories within it
+
+    Parameters
+    ----------
+    task : Dcm2Niix
+        the task the command line was rendered from
+    argv : list[str]
+        the rendered command line
+    in_dir_pos : int
+        the position of the input directory in the command line
+    out_dir_pos : int
+        the position of the output directory in the command line
+    """
+
+    task: Dcm2Niix
+    argv: list[str]
+    in_dir_pos: int
+    out_dir_pos: int
+
+    def render(self, in_dir: Path, out_dir: Path) -> list[str]:
+        """Renders the command line of a job
+
+        Parameters
+        ----------
+        in_dir : Path
+            the input directory of the job
+        out_dir : Path
+            the output directory of the job
+
+        Returns
+        -------
+        list[str]
+            the command line
+        """
+        argv = list(self.argv)
+        argv[self.in_dir_pos] = str(in_dir)
+        argv[self.out_dir_pos] = str(out_dir)
+        return argv
+
+
+@attrs.define
+class TaskTemplate:
+    """Constructs Dcm2Niix tasks and command lines that share the arguments of a
+    template task
+
+    Parameters
+    ----------
+    template : Dcm2Niix
+        the task providing the common arguments. It is copied, so subsequent changes to
+        it don't affect the tasks constructed from the template
+    """
+
+    template: Dcm2Niix = attrs.field(factory=Dcm2Niix, converter=copy.copy)
+    _commands: dict[tuple[tuple[str, ty.Any], ...], CommandTemplate] = attrs.field(
+        factory=dict, init=False, repr=False
+    )
+
+    def task(
+        self,
+        in_dir: str | Path | None = None,
+        out_dir: str | Path | None = None,
+        **overrides: ty.Any,
+    ) -> Dcm2Niix:
+        """Constructs a task from the template, only coercing and validating the
+        arguments that are set
+
+        Parameters
+        ----------
+        in_dir : str or Path, optional
+            the directory containing the DICOMs to convert, by default that of the
+            template
+        out_dir : str or Path, optional
+            the directory to write the outputs to, by default that of the template
+        **overrides
+            other arguments of the template to override
+
+        Returns
+        -------
+        Dcm2Niix
+            the task
+
+        Raises
+        ------
+        TypeError
+            if an override isn't an argument of Dcm2Niix
+        """
+        if in_dir is not None:
+            overrides["in_dir"] = in_dir
+        if out_dir is not None:
+            overrides["out_dir"] = out_dir
+        task = copy.copy(self.template)
+        fields = attrs.fields_dict(Dcm2Niix)
+        for name, value in overrides.items():
+            field = fields.get(name)
+            if field is None or name.startswith("_"):
+                raise TypeError(f"{name!r} is not an argument of Dcm2Niix")
+            # Values are coerced to the type of the field on assignment
+            setattr(task, name, value)
+            if field.validator is not None:
+                field.validator(task, field, getattr(task, name))
+        return task
+
+    def command(self, in_dir: str | Path, **overrides: ty.Any) -> CommandTemplate:
+        """Returns the command-line template for a set of overrides, rendering it the
+        first time the overrides are seen
+
+        Parameters
+        ----------
+        in_dir : str or Path
+            a directory containing DICOMs, which is only used to render the command
+            line the first time as 'in_dir' needs to be a valid DICOM directory
+        **overrides
+            arguments of the template to override
+
+        Returns
+        -------
+        CommandTemplate
+            the command-line template
+        """
+        key = tuple(sorted((n, _hashable(v)) for n, v in overrides.items()))
+        try:
+            return self._commands[key]
+        except KeyError:
+            pass
+        task = self.task(in_dir, OUT_DIR_PLACEHOLDER, **overrides)
+        argv = shlex.split(task.cmdline)
+        command = CommandTemplate(
+            task=task,
+            argv=argv,
+            # 'in_dir' is the last argument before any that are appended
+            in_dir_pos=len(argv) - len(task.append_args) - 1,
+            out_dir_pos=argv.index(str(OUT_DIR_PLACEHOLDER)),
+        )
+        # Dictionary assignment is atomic, so at worst a template is rendered twice
+        return self._commands.setdefault(key, command)
+
+    def argv(
+        self, in_dir: str | Path, out_dir: str | Path, **overrides: ty.Any
+    ) -> list[str]:
+        """Renders the command line of a job from the command-line template of its
+        overrides
+
+        Parameters
+        ----------
+        in_dir : str or Path
+            the directory containing the DICOMs to convert
+        out_dir : str or Path
+            the directory to write the outputs to
+        **overrides
+            arguments of the template to override
+
+        Returns
+        -------
+        list[str]
+            the command line
+        """
+        in_dir = Path(in_dir).absolute()
+        return self.command(in_dir, **overrides).render(
+            in_dir, Path(out_dir).absolute()
+        )
+
+
+def _hashable(value: ty.Any) -> ty.Hashable:
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
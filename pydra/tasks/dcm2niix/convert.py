@@ -0,0 +1,416 @@
+"""Running Dcm2Niix tasks directly, outside of pydra's job machinery.
+
+:func:`convert` runs the command line of a :class:`~pydra.tasks.dcm2niix.Dcm2Niix` task
+in a subprocess and collects its outputs following the same rules as the task's output
+callables, returning the same ``Dcm2Niix.Outputs``. Doing so allows the conversion to be
+fronted by Python-side optimisations, such as a :class:`.ConversionCache`, a
+:class:`.ParallelGzip` compression stage, a :class:`.CompressionTuner`, a
+:class:`.DicomFilter` of its inputs or :class:`.Staging` on local scratch, and the phases
+of the run to be timed (see :mod:`pydra.tasks.dcm2niix.metrics`).
+"""
+
+from concurrent.futures import Future
+import logging
+import os
+from pathlib import Path
+import shlex
+import attrs
+from .cache import ConversionCache
+from .compression import ParallelGzip
+from .metrics import RunMetrics, record_metrics, run_process
+from .outputs import (
+    MANIFEST_LINE,
+    OutputBundle,
+    OutputFiles,
+    OutputIndex,
+    parse_manifest,
+)
+from .prefilter import DicomFilter
+from .staging import Staging
+from .templates import SeriesOutputs
+from .tuning import CompressionTuner
+from .utils import GZIP_MODES, Dcm2Niix, collect_outputs
+
+logger = logging.getLogger("pydra.tasks.dcm2niix")
+
+
+@attrs.define
+class ConversionRun:
+    """The files produced by a run of dcm2niix (or materialised from the cache) and
+    the results of the process
+
+    Parameters
+    ----------
+    task : Dcm2Niix
+        the task that was run
+    index : OutputIndex
+        index of the files produced by the run
+    return_code : int
+        the exit code of the process
+    stdout : str
+        the captured stdout of the process
+    stderr : str
+        the captured stderr of the process
+    metrics : RunMetrics
+        the timings and resource usage of the run
+    """
+
+    task: Dcm2Niix
+    index: OutputIndex
+    return_code: int = 0
+    stdout: str = ""
+    stderr: str = ""
+    metrics: RunMetrics = attrs.field(factory=RunMetrics)
+
+    @property
+    def names(self) -> list[str]:
+        """The names of the produced files relative to the output directory"""
+        prefix = "" if "%" in self.task.filename else self.task.filename
+        return [
+            os.path.relpath(p, self.index.out_dir)
+            for p in self.index.with_prefix(prefix)
+        ]
+
+    def files(self) -> OutputFiles:
+        """The produced files in a compact collection, ordered by volume index where
+        the series were split into one file per volume (see :class:`OutputFiles`)"""
+        return self.index.out_files(self.task.filename)
+
+    def series(self) -> dict[str, SeriesOutputs]:
+        """The produced files grouped by the series they were converted from, keyed by
+        the name shared by their files (e.g. the expanded filename template)"""
+        return self.index.series(self.task.filename)
+
+    def bundles(self) -> dict[str, OutputBundle]:
+        """The produced files grouped into the image and sidecars of each image, keyed
+        by postfix (see :meth:`OutputIndex.bundles`)"""
+        return self.index.bundles(self.task.filename)
+
+    def outputs(self) -> Dcm2Niix.Outputs:
+        """Collects the outputs of the task from the produced files"""
+        with self.metrics.phase("collect"):
+            return collect_outputs(
+                self.task, self.index, self.return_code, self.stdout, self.stderr
+            )
+
+
+def run(
+    task: Dcm2Niix,
+    cache: ConversionCache | None = None,
+    timeout: float | None = None,
+    compressor: ParallelGzip | None = None,
+    tuner: CompressionTuner | None = None,
+    staging: Staging | None = None,
+    prefilter: DicomFilter | None = None,
+) -> ConversionRun:
+    """Runs a Dcm2Niix task in a subprocess of the current process, without
+    resolving its outputs
+
+    Parameters
+    ----------
+    task : Dcm2Niix
+        the task to run, which must have 'out_dir' set
+    cache : ConversionCache, optional
+        a cache to look up the conversion in before running it, and to store its
+        outputs in afterwards
+    timeout : float, optional
+        the number of seconds after which to kill the dcm2niix process
+    compressor : ParallelGzip, optional
+        a stage to compress the NIfTI images with instead of dcm2niix, if the task
+        compresses them
+    tuner : CompressionTuner, optional
+        a tuner to choose the compression mode and level of the task with, in place
+        of its 'compress' and 'compression_level' arguments, unless it splits the
+        images into 3D volumes (compress='3')
+    staging : Staging, optional
+        stage the conversion on local scratch, committing its outputs to 'out_dir'
+        once it has finished
+    prefilter : DicomFilter, optional
+        a filter to link only the instances dcm2niix would convert into a scratch
+        directory, which dcm2niix reads in place of 'in_dir'
+
+    Returns
+    -------
+    ConversionRun
+        the files produced by the run
+
+    Raises
+    ------
+    ValueError
+        if the 'out_dir' of the task isn't set
+    RuntimeError
+        if dcm2niix exits with a non-zero return code
+    subprocess.TimeoutExpired
+        if dcm2niix doesn't complete within the timeout
+    """
+    if task.out_dir is None:
+        raise ValueError(f"'out_dir' needs to be set to run {task} outside of pydra")
+    metrics = RunMetrics(in_dir=str(task.in_dir), out_dir=str(task.out_dir))
+    if tuner is not None:
+        with metrics.phase("tune"):
+            task, metrics.compression = tuner.apply(task)
+    with metrics.phase("command"):
+        argv = shlex.split(task.cmdline)
+    return run_command(
+        task,
+        argv,
+        task.in_dir,
+        task.out_dir,
+        cache=cache,
+        timeout=timeout,
+        metrics=metrics,
+        compressor=compressor,
+        staging=staging,
+        prefilter=prefilter,
+    )
+
+
+def run_command(
+    task: Dcm2Niix,
+    argv: list[str],
+    in_dir: str | Path,
+    out_dir: str | Path,
+    cache: ConversionCache | None = None,
+    timeout: float | None = None,
+    metrics: RunMetrics | None = None,
+    compressor: ParallelGzip | None = None,
+    staging: Staging | None = None,
+    prefilter: DicomFilter | None = None,
+) -> ConversionRun:
+    """Runs a pre-rendered dcm2niix command line, which converts 'in_dir' into
+    'out_dir' with the other arguments of the task, and indexes the produced files.
+    Rendering the command line of a task is relatively expensive, so this allows the
+    command line of a single task to be reused across many input directories.
+
+    Parameters
+    ----------
+    task : Dcm2Niix
+        the task the command line was rendered from, which provides the arguments
+        used to look up the conversion in the cache and to collect its outputs
+    argv : list[str]
+        the command line to run
+    in_dir : str or Path
+        the input directory that is converted by the command line
+    out_dir : str or Path
+        the output directory that is written to by the command line
+    cache : ConversionCache, optional
+        a cache to look up the conversion in before running it, and to store its
+        outputs in afterwards
+    timeout : float, optional
+        the number of seconds after which to kill the dcm2niix process
+    metrics : RunMetrics, optional
+        the metrics to record the phases of the run in, so they are available to the
+        caller even if the run fails
+    compressor : ParallelGzip, optional
+        a stage to compress the NIfTI images with instead of dcm2niix, if the task
+        compresses them
+    staging : Staging, optional
+        stage the conversion on local scratch, committing its outputs to 'out_dir'
+        once it has finished
+    prefilter : DicomFilter, optional
+        a filter to link only the instances dcm2niix would convert into a scratch
+        directory, which dcm2niix reads in place of 'in_dir'
+
+    Returns
+    -------
+    ConversionRun
+        the files produced by the run
+    """
+    out_dir = Path(out_dir).absolute()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if metrics is None:
+        metrics = RunMetrics(in_dir=str(in_dir), out_dir=str(out_dir))
+    if cache is not None:
+        with metrics.phase("hash"):
+            key = cache.key(task, in_dir=in_dir, compressor=compressor)
+        with metrics.phase("cache"):
+            names = cache.materialize(key, out_dir, task.filename, task.name_conflicts)
+        if names is not None:
+            logger.info("Found conversion of %s in cache", in_dir)
+            metrics.cached = True
+            return ConversionRun(task, OutputIndex(out_dir, names), metrics=metrics)
+    filtered = staged = None
+    # 'in_dir' is the last argument before any that are appended
+    in_dir_pos = len(argv) - len(task.append_args) - 1
+    try:
+        if prefilter is not None:
+            with metrics.phase("filter"):
+                filtered = prefilter.link(task, in_dir)
+            metrics.excluded = filtered.excluded
+            argv = list(argv)
+            argv[in_dir_pos] = str(filtered.in_dir)
+        if staging is not None:
+            with metrics.phase("stage"):
+                staged = staging.stage(argv[in_dir_pos], search_depth=task.search_depth)
+            argv = list(argv)
+            argv[in_dir_pos] = str(staged.in_dir)
+            argv[argv.index("-o") + 1] = str(staged.out_dir)
+        return_code, stdout, stderr, index = _run_dcm2niix(
+            task,
+            argv,
+            in_dir,
+            staged.out_dir if staged is not None else out_dir,
+            timeout=timeout,
+            metrics=metrics,
+            compressor=compressor,
+        )
+        if staged is not None:
+            with metrics.phase("commit"):
+                names = staged.commit(
+                    [os.path.relpath(p, staged.out_dir) for p in index.with_prefix("")],
+                    out_dir,
+                    task.name_conflicts,
+                )
+            index = OutputIndex(out_dir, names)
+    finally:
+        if staged is not None:
+            staged.cleanup()
+        if filtered is not None:
+            filtered.cleanup()
+    result = ConversionRun(task, index, return_code, stdout, stderr, metrics)
+    if cache is not None:
+        with metrics.phase("cache"):
+            cache.store(key, out_dir, result.names, task.filename)
+    return result
+
+
+def _run_dcm2niix(
+    task: Dcm2Niix,
+    argv: list[str],
+    in_dir: str | Path,
+    out_dir: Path,
+    timeout: float | None,
+    metrics: RunMetrics,
+    compressor: ParallelGzip | None,
+) -> tuple[int, str, str, OutputIndex]:
+    """Runs the dcm2niix process, compressing its images as they are written if a
+    compressor is provided, and indexes the files it writes to 'out_dir'"""
+    on_stdout_line = None
+    compressed: list[Future[Path]] = []
+    if (
+        compressor is not None
+        and task.compress in GZIP_MODES
+        and not compressor.compresses(task)
+    ):
+        logger.warning(
+            "%s only compresses NIfTI images, so the NRRD outputs of %s are "
+            "compressed by dcm2niix instead",
+            type(compressor).__name__,
+            in_dir,
+        )
+    elif compressor is not None and compressor.compresses(task):
+        argv = list(argv)
+        argv[argv.index("-z") + 1] = "n"
+        converted: list[str] = []
+
+        def compress(stem: str) -> None:
+            image = Path(stem + ".nii")
+            if image.exists():
+                compressed.append(
+                    compressor.submit(image, level=task.compression_level)
+                )
+
+        def on_stdout_line(line: bytes) -> None:
+            if match := MANIFEST_LINE.match(line.decode(errors="replace")):
+                # dcm2niix converts one series at a time, so the previous series
+                # has been written once the next is reported
+                if converted:
+                    compress(converted[-1])
+                converted.append(match.group("path"))
+
+    with metrics.phase("dcm2niix"):
+        return_code, stdout_bytes, stderr_bytes, metrics.child = run_process(
+            argv, timeout=timeout, on_stdout_line=on_stdout_line
+        )
+    if on_stdout_line is not None:
+        with metrics.phase("compress"):
+            if converted:
+                compress(converted[-1])
+            for future in compressed:
+                future.result()
+    stdout = stdout_bytes.decode(errors="replace")
+    stderr = stderr_bytes.decode(errors="replace")
+    check_return_code(return_code, in_dir, stderr)
+    with metrics.phase("index"):
+        index = index_outputs(out_dir, stdout)
+    return return_code, stdout, stderr, index
+
+
+def check_return_code(return_code: int, in_dir: str | Path, stderr: str) -> None:
+    """Raises a RuntimeError including the stderr of dcm2niix if it failed"""
+    if return_code:
+        raise RuntimeError(
+            f"dcm2niix exited with return code {return_code} converting "
+            f"{in_dir}:\n{stderr}"
+        )
+
+
+def index_outputs(out_dir: Path, stdout: str) -> OutputIndex:
+    """Indexes the files written by dcm2niix from the manifest in its stdout, falling
+    back to scanning the output directory if it didn't print one"""
+    index = None
+    if manifest := parse_manifest(stdout):
+        index = OutputIndex.from_manifest(out_dir, manifest)
+    if index is None:
+        index = OutputIndex.scan(out_dir)
+    return index
+
+
+def convert(
+    task: Dcm2Niix,
+    cache: ConversionCache | None = None,
+    metrics_file: str | Path | None = None,
+    compressor: ParallelGzip | None = None,
+    tuner: CompressionTuner | None = None,
+    staging: Staging | None = None,
+    prefilter: DicomFilter | None = None,
+) -> Dcm2Niix.Outputs:
+    """Runs a Dcm2Niix task in a subprocess of the current process and collects its
+    outputs
+
+    Parameters
+    ----------
+    task : Dcm2Niix
+        the task to run, which must have 'out_dir' set
+    cache : ConversionCache, optional
+        a cache to look up the conversion in before running it, and to store its
+        outputs in afterwards
+    metrics_file : str or Path, optional
+        a JSONL file to append the metrics of the run to, by default the file set by
+        the 'PYDRA_DCM2NIIX_METRICS' environment variable, if any
+    compressor : ParallelGzip, optional
+        a stage to compress the NIfTI images with instead of dcm2niix, if the task
+        compresses them
+    tuner : CompressionTuner, optional
+        a tuner to choose the compression mode and level of the task with, in place
+        of its 'compress' and 'compression_level' arguments
+    staging : Staging, optional
+        stage the conversion on local scratch, committing its outputs to 'out_dir'
+        once it has finished
+    prefilter : DicomFilter, optional
+        a filter to link only the instances dcm2niix would convert into a scratch
+        directory, which dcm2niix reads in place of 'in_dir'
+
+    Returns
+    -------
+    Dcm2Niix.Outputs
+        the outputs of the task
+
+    Raises
+    ------
+    ValueError
+        if the 'out_dir' of the task isn't set
+    RuntimeError
+        if dcm2niix exits with a non-zero return code
+    """
+    result = run(
+        task,
+        cache=cache,
+        compressor=compressor,
+        tuner=tuner,
+        staging=staging,
+        prefilter=prefilter,
+    )
+    outputs = result.outputs()
+    record_metrics(result.metrics, metrics_file)
+    return outputs
@@ -0,0 +1,135 @@
+"""Header-only access to the DICOM files in the input directory of a conversion.
+
+Only the metadata preceding the pixel data is read from each file, so that inputs can be
+identified without paying the cost of reading the full DICOM series.
+"""
+
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import typing as ty
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+# The directory search depth dcm2niix uses when '-d' isn't provided
+DEFAULT_SEARCH_DEPTH = 5
+
+IDENTITY_TAGS = ("StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID")
+
+
+def iter_dicom_files(
+    in_dir: str | Path, search_depth: int | None = None
+) -> Iterator[Path]:
+    """Walks the input directory in the same way as dcm2niix, descending at most
+    'search_depth' levels into sub-directories and skipping hidden files
+
+    Parameters
+    ----------
+    in_dir : str or Path
+        the directory containing the DICOMs
+    search_depth : int, optional
+        the number of levels of sub-directories to search, by default the same as
+        dcm2niix (5)
+
+    Yields
+    ------
+    Path
+        the paths of the candidate DICOM files, in sorted order
+    """
+    if search_depth is None:
+        search_depth = DEFAULT_SEARCH_DEPTH
+    with os.scandir(in_dir) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    subdirs = []
+    for entry in entries:
+        if entry.name.startswith("."):
+            continue
+        if entry.is_dir():
+            subdirs.append(entry.path)
+        elif entry.is_file():
+            yield Path(entry.path)
+    if search_depth > 0:
+        for subdir in subdirs:
+            yield from iter_dicom_files(subdir, search_depth - 1)
+
+
+def read_header(
+    path: str | Path, specific_tags: ty.Sequence[str] | None = None
+) -> pydicom.Dataset | None:
+    """Reads the header of a DICOM file, stopping before the pixel data
+
+    Parameters
+    ----------
+    path : str or Path
+        path to the file to read
+    specific_tags : sequence[str], optional
+        only read the given tags (in addition to the file meta information)
+
+    Returns
+    -------
+    pydicom.Dataset or None
+        the header, or None if the file isn't a DICOM
+    """
+    try:
+        return pydicom.dcmread(
+            path, stop_before_pixels=True, specific_tags=specific_tags
+        )
+    except (InvalidDicomError, EOFError):
+        return None
+
+
+def read_headers(
+    paths: ty.Sequence[Path],
+    specific_tags: ty.Sequence[str] | None = None,
+    max_workers: int | None = None,
+) -> list[pydicom.Dataset | None]:
+    """Reads the headers of DICOM files over a pool of threads
+
+    Parameters
+    ----------
+    paths : sequence[Path]
+        the files to read
+    specific_tags : sequence[str], optional
+        only read the given tags (in addition to the file meta information)
+    max_workers : int, optional
+        the number of threads to read the headers with
+
+    Returns
+    -------
+    list[pydicom.Dataset or None]
+        the header of each file, or None if it isn't a DICOM
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(lambda p: read_header(p, specific_tags), paths))
+
+
+def series_identity(
+    in_dir: str | Path,
+    search_depth: int | None = None,
+    max_workers: int | None = None,
+) -> dict[str, list[str]]:
+    """Identifies the DICOM instances within an input directory by their UIDs
+
+    Parameters
+    ----------
+    in_dir : str or Path
+        the directory containing the DICOMs
+    search_depth : int, optional
+        the number of levels of sub-directories to search
+    max_workers : int, optional
+        the number of threads to read the headers with
+
+    Returns
+    -------
+    dict[str, list[str]]
+        the sorted study, series and SOP instance UIDs of the DICOMs in the directory
+    """
+    uids: dict[str, set[str]] = {t: set() for t in IDENTITY_TAGS}
+    paths = list(iter_dicom_files(in_dir, search_depth))
+    for header in read_headers(paths, IDENTITY_TAGS, max_workers):
+        if header is None:
+            continue
+        for tag in IDENTITY_TAGS:
+            uids[tag].add(str(header.get(tag, "")))
+    return {tag: sorted(vals) for tag, vals in uids.items()}
@@ -0,0 +1,315 @@
+"""Header-only hashing of DICOM directories for pydra's cache checks.
+
+By default pydra hashes a ``DicomDir`` by reading every byte of every file in it, which
+for large sessions can cost as much as the conversion itself. In the "header" hashing
+mode, only the identifying metadata preceding the pixel data of each file (its UIDs and
+instance number) is read, together with its size, over a pool of threads. Per-file
+digests are memoised in a SQLite database alongside pydra's persistent hash cache, keyed
+by the path, size and modification time of the file, so that rehashing an unchanged (or
+growing) directory only needs to read the headers of new or modified files.
+
+The header mode relies on DICOM instances being immutable for a given SOP instance UID,
+so changes to a file that don't change its size or identifying tags aren't detected.
+It is enabled by setting the ``PYDRA_DCM2NIIX_HASHING`` environment variable to "header"
+(e.g. via :func:`set_hashing_mode`), which is inherited by worker processes. It only
+applies to the 'in_dir' of :class:`~pydra.tasks.dcm2niix.Dcm2Niix` tasks (hashed with
+the task's search depth), DicomDir values hashed anywhere else in the process are
+still hashed by content.
+
+Independent of the mode, the hashes of the arguments that are typically shared by many
+tasks (strings, numbers and the Outputs class, which alone costs more to hash than all
+the other arguments put together) are memoised by :func:`task_hashes`, so that hashing
+thousands of tasks split over sessions only pays for the arguments that differ.
+"""
+
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+import functools
+from hashlib import blake2b
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import typing as ty
+import attrs
+from fileformats.medimage import DicomDir
+from pydra.compose.base import Out
+from pydra.utils.general import get_fields
+from pydra.utils.hash import Cache, CacheKey, hash_function
+from .dicom import iter_dicom_files, read_header
+
+HASHING_MODE_ENV_VAR = "PYDRA_DCM2NIIX_HASHING"
+HASHING_MODES = ("content", "header")
+
+HEADER_HASH_TAGS = (
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "SOPInstanceUID",
+    "InstanceNumber",
+)
+
+MEMO_FILENAME = "dcm2niix-header-digests.sqlite"
+
+# Types of argument values that are immutable, so their hashes can be memoised
+MEMOISED_TYPES = (str, bytes, int, float, bool, type(None), type)
+
+
+def set_hashing_mode(mode: str) -> None:
+    """Sets how DicomDir inputs are hashed by pydra, in this process and any worker
+    processes it subsequently spawns
+
+    Parameters
+    ----------
+    mode : str
+        either "content", to hash the full contents of the files (pydra's default), or
+        "header" to only hash their identifying headers and sizes
+    """
+    if mode not in HASHING_MODES:
+        raise ValueError(f"Unrecognised hashing mode {mode!r}, not in {HASHING_MODES}")
+    os.environ[HASHING_MODE_ENV_VAR] = mode
+
+
+def get_hashing_mode() -> str:
+    """Returns the mode used to hash DicomDir inputs, see :func:`set_hashing_mode`"""
+    return os.environ.get(HASHING_MODE_ENV_VAR, "content")
+
+
+def header_digest(path: str | Path, size: int) -> bytes:
+    """Digests the identifying header tags and size of a DICOM file, reading the
+    full contents instead if the file isn't a DICOM
+
+    Parameters
+    ----------
+    path : str or Path
+        path to the file
+    size : int
+        the size of the file in bytes
+
+    Returns
+    -------
+    bytes
+        the digest of the file
+    """
+    h = blake2b(digest_size=16, person=b"dcm2niix-hdr")
+    h.update(size.to_bytes(8, "little"))
+    header = read_header(path, specific_tags=HEADER_HASH_TAGS)
+    if header is None:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024**2), b""):
+                h.update(chunk)
+    else:
+        for tag in HEADER_HASH_TAGS:
+            h.update(f"{tag}={header.get(tag, '')};".encode())
+    return h.digest()
+
+
+class HeaderDigestMemo:
+    """Persistent memo of per-file header digests, keyed by the path, size and
+    modification time of the file. The database is opened once and the connection
+    shared between the threads that use the memo
+
+    Parameters
+    ----------
+    path : str or Path
+        path to the SQLite database to store the memo in
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        with self._conn as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest BLOB)"
+            )
+
+    def close(self) -> None:
+        """Closes the connection to the database"""
+        with self._lock:
+            self._conn.close()
+
+    def lookup(self, dirpath: str | Path) -> dict[str, tuple[int, int, bytes]]:
+        """Returns the memoised digests of all files under a directory
+
+        Parameters
+        ----------
+        dirpath : str or Path
+            the directory to look up
+
+        Returns
+        -------
+        dict[str, tuple[int, int, bytes]]
+            mapping from file path to the size, mtime and digest it was memoised with
+        """
+        prefix = str(Path(dirpath).absolute()) + os.sep
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, size, mtime_ns, digest FROM digests "
+                "WHERE path >= ? AND path < ?",
+                (prefix, prefix[:-1] + chr(ord(os.sep) + 1)),
+            ).fetchall()
+        return {p: (s, m, d) for p, s, m, d in rows}
+
+    def update(self, rows: ty.Iterable[tuple[str, int, int, bytes]]) -> None:
+        """Memoises the digests of files
+
+        Parameters
+        ----------
+        rows : iterable[tuple[str, int, int, bytes]]
+            the path, size, mtime and digest of each file
+        """
+        with self._lock, self._conn as conn:
+            conn.executemany("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)", rows)
+
+
+def stat_dicom_files(
+    in_dir: str | Path, search_depth: int | None = None
+) -> list[tuple[str, int, int]]:
+    """Returns the path, size and mtime of each file in the DICOM directory, in the
+    order they are hashed"""
+    stats = []
+    for path in iter_dicom_files(Path(in_dir).absolute(), search_depth):
+        st = path.stat()
+        stats.append((str(path), st.st_size, st.st_mtime_ns))
+    return stats
+
+
+def dicom_header_digests(
+    in_dir: str | Path,
+    stats: ty.Sequence[tuple[str, int, int]] | None = None,
+    memo: HeaderDigestMemo | None = None,
+    max_workers: int | None = None,
+) -> list[bytes]:
+    """Computes the header digests of the files in a DICOM directory, reusing memoised
+    digests for files that haven't changed
+
+    Parameters
+    ----------
+    in_dir : str or Path
+        the DICOM directory
+    stats : sequence[tuple[str, int, int]], optional
+        the paths, sizes and mtimes of the files, as returned by
+        :func:`stat_dicom_files`, if they have already been read
+    memo : HeaderDigestMemo, optional
+        the memo to look up and store the digests in
+    max_workers : int, optional
+        the number of threads to read the headers with
+
+    Returns
+    -------
+    list[bytes]
+        the digests of the files, in the same order as the stats
+    """
+    if stats is None:
+        stats = stat_dicom_files(in_dir)
+    memoised = memo.lookup(in_dir) if memo is not None else {}
+    digests: dict[str, bytes] = {}
+    missing = []
+    for path, size, mtime_ns in stats:
+        try:
+            msize, mmtime_ns, digest = memoised[path]
+        except KeyError:
+            missing.append((path, size, mtime_ns))
+        else:
+            if (msize, mmtime_ns) == (size, mtime_ns):
+                digests[path] = digest
+            else:
+                missing.append((path, size, mtime_ns))
+    if missing:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            computed = list(pool.map(lambda s: header_digest(s[0], s[1]), missing))
+        digests.update((s[0], d) for s, d in zip(missing, computed))
+        if memo is not None:
+            memo.update(s + (d,) for s, d in zip(missing, computed))
+    return [digests[path] for path, _, _ in stats]
+
+
+@functools.lru_cache(maxsize=None)
+def _open_memo(path: Path, pid: int) -> HeaderDigestMemo:
+    """Opens the memo at 'path' once per process ('pid' keys the memo so that forked
+    workers don't share the connection of their parent)"""
+    return HeaderDigestMemo(path)
+
+
+@attrs.frozen
+class HeaderHashedDicomDir:
+    """Hashes a DicomDir argument by the headers of its files, in place of their full
+    contents
+
+    Parameters
+    ----------
+    dicom_dir : DicomDir
+        the directory to hash
+    search_depth : int, optional
+        the number of levels of sub-directories that are converted
+    """
+
+    dicom_dir: DicomDir
+    search_depth: int | None = None
+
+    def __bytes_repr__(self, cache: Cache) -> Iterator[CacheKey | bytes]:
+        in_dir = Path(self.dicom_dir.fspath).absolute()
+        stats = stat_dicom_files(in_dir, self.search_depth)
+        # Used by pydra to look up the hash of the whole directory in its persistent
+        # cache
+        yield CacheKey(
+            ("header", str(in_dir), str(self.search_depth))
+            + tuple(f"{p}:{s}:{m}" for p, s, m in stats)
+        )
+        memo = None
+        if cache.persistent is not None:
+            memo = _open_memo(cache.persistent.location / MEMO_FILENAME, os.getpid())
+        cls = type(self.dicom_dir)
+        yield f"{cls.__module__}.{cls.__name__}[header]:".encode()
+        digests = dicom_header_digests(in_dir, stats, memo=memo)
+        for (path, _, _), digest in zip(stats, digests):
+            yield (",'" + os.path.relpath(path, in_dir) + "'=").encode()
+            yield digest
+
+
+def task_hashes(task: ty.Any) -> tuple[str, dict[str, str]]:
+    """Computes the hash of a task and of each of its arguments, as pydra does, but
+    memoising the hashes of immutable values so that arguments shared between tasks
+    are only hashed once per process, and hashing DicomDir arguments by their headers
+    in the "header" hashing mode (see :func:`set_hashing_mode`)
+
+    Parameters
+    ----------
+    task : Task
+        the task to hash
+
+    Returns
+    -------
+    tuple[str, dict[str, str]]
+        the hash of the task and the hashes of its arguments (and Outputs class)
+    """
+    values = {}
+    for field in get_fields(task):
+        if isinstance(field, Out):
+            continue
+        value = getattr(task, field.name)
+        if value is attrs.NOTHING or getattr(field, "container_path", False):
+            continue
+        values[field.name] = value
+    # Included by pydra in case the names or types of the outputs change
+    values["Outputs"] = task.Outputs
+    cache = Cache()
+    header_mode = get_hashing_mode() == "header"
+    hashes = {}
+    for name, value in values.items():
+        if header_mode and isinstance(value, DicomDir):
+            value = HeaderHashedDicomDir(value, getattr(task, "search_depth", None))
+        if isinstance(value, MEMOISED_TYPES):
+            # The type is part of the key as equal values of different types (e.g. 1
+            # and True) hash differently
+            hashes[name] = _memoised_hash(type(value), value)
+        else:
+            hashes[name] = hash_function(value, cache=cache)
+    return hash_function(sorted(hashes.items())), hashes
+
+
+@functools.lru_cache(maxsize=4096)
+def _memoised_hash(_: type, value: ty.Any) -> str:
+    return hash_function(value)
@@ -0,0 +1,276 @@
+"""Per-phase timing and resource usage of conversions run outside of pydra.
+
+Each conversion run by :func:`~pydra.tasks.dcm2niix.convert.run` (and the runners built
+on it) records a :class:`RunMetrics`, which holds the wall and CPU time of each phase of
+the run (e.g. rendering the command line, hashing the inputs for the cache, the dcm2niix
+process and collecting its outputs). The dcm2niix process is reaped with ``wait4`` so
+that its peak RSS and user/system CPU time can be recorded, together with the bytes it
+read and wrote (from ``/proc/<pid>/io`` where available, otherwise from the block I/O
+counts in its resource usage).
+
+Metrics can be appended as JSON lines to a file to be aggregated across runs, either by
+passing 'metrics_file' to the runners or by setting the ``PYDRA_DCM2NIIX_METRICS``
+environment variable.
+"""
+
+from collections.abc import Callable, Iterator
+import contextlib
+import json
+import os
+from pathlib import Path
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import typing as ty
+import attrs
+
+if ty.TYPE_CHECKING:
+    from .tuning import CompressionChoice
+
+METRICS_FILE_ENV_VAR = "PYDRA_DCM2NIIX_METRICS"
+
+
+@attrs.define
+class PhaseTiming:
+    """The time spent in a phase of a run
+
+    Parameters
+    ----------
+    wall : float
+        the elapsed wall time in seconds
+    cpu : float
+        the CPU time of the calling thread in seconds
+    """
+
+    wall: float = 0.0
+    cpu: float = 0.0
+
+
+@attrs.define
+class ChildUsage:
+    """The resources used by the dcm2niix process
+
+    Parameters
+    ----------
+    max_rss : int
+        the peak resident set size in bytes
+    user_time : float
+        the user CPU time in seconds
+    sys_time : float
+        the system CPU time in seconds
+    read_bytes : int
+        the number of bytes read
+    write_bytes : int
+        the number of bytes written
+    """
+
+    max_rss: int = 0
+    user_time: float = 0.0
+    sys_time: float = 0.0
+    read_bytes: int = 0
+    write_bytes: int = 0
+
+
+@attrs.define
+class RunMetrics:
+    """The timings and resource usage of a conversion
+
+    Parameters
+    ----------
+    in_dir : str
+        the directory that was converted
+    out_dir : str
+        the directory the outputs were written to
+    started : float
+        the time the run started, in seconds since the epoch
+    host : str
+        the name of the host the run was on
+    phases : dict[str, PhaseTiming]
+        the time spent in each phase of the run, in the order they started
+    child : ChildUsage, optional
+        the resources used by the dcm2niix process, if it was run
+    cached : bool
+        whether the outputs were materialised from the cache
+    error : str
+        the error the run failed with, if any
+    compression : CompressionChoice, optional
+        the compression settings chosen for the run, if they were tuned
+    excluded : dict[str, int]
+        the number of input files excluded by a prefilter for each reason, if the
+        inputs were filtered
+    """
+
+    in_dir: str = ""
+    out_dir: str = ""
+    started: float = attrs.field(factory=time.time)
+    host: str = attrs.field(factory=socket.gethostname)
+    phases: dict[str, PhaseTiming] = attrs.field(factory=dict)
+    child: ChildUsage | None = None
+    cached: bool = False
+    error: str = ""
+    compression: "CompressionChoice | None" = None
+    excluded: dict[str, int] = attrs.field(factory=dict)
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Times a phase of the run, adding to its previous timing if it has already
+        been recorded"""
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            timing = self.phases.setdefault(name, PhaseTiming())
+            timing.wall += time.perf_counter() - wall
+            timing.cpu += time.thread_time() - cpu
+
+    @property
+    def total_wall(self) -> float:
+        return sum(p.wall for p in self.phases.values())
+
+    def to_dict(self) -> dict[str, ty.Any]:
+        return attrs.asdict(self)
+
+    def append_to(self, path: str | Path) -> None:
+        """Appends the metrics as a line of JSON to a file
+
+        Parameters
+        ----------
+        path : str or Path
+            the file to append to
+        """
+        line = json.dumps(self.to_dict()) + "\n"
+        # Write the line with a single call in append mode, so that lines from
+        # concurrent runs aren't interleaved
+        with open(path, "a") as f:
+            f.write(line)
+
+
+def record_metrics(metrics: RunMetrics, metrics_file: str | Path | None = None) -> None:
+    """Appends the metrics of a run to the metrics file, if one is provided or set by
+    the 'PYDRA_DCM2NIIX_METRICS' environment variable"""
+    if metrics_file is None:
+        metrics_file = os.environ.get(METRICS_FILE_ENV_VAR)
+    if metrics_file:
+        metrics.append_to(metrics_file)
+
+
+def run_process(
+    argv: list[str],
+    timeout: float | None = None,
+    on_stdout_line: Callable[[bytes], None] | None = None,
+) -> tuple[int, bytes, bytes, ChildUsage]:
+    """Runs a process to completion, capturing its output and resource usage
+
+    Parameters
+    ----------
+    argv : list[str]
+        the command line to run
+    timeout : float, optional
+        the number of seconds after which to kill the process
+    on_stdout_line : Callable[[bytes], None], optional
+        a function to call with each line of stdout as it is printed
+
+    Returns
+    -------
+    return_code : int
+        the exit code of the process
+    stdout : bytes
+        the captured stdout
+    stderr : bytes
+        the captured stderr
+    usage : ChildUsage
+        the resources used by the process
+
+    Raises
+    ------
+    subprocess.TimeoutExpired
+        if the process doesn't complete within the timeout
+    """
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr: list[bytes] = []
+    stderr_reader = threading.Thread(
+        target=lambda: stderr.append(proc.stderr.read()),  # type: ignore[union-attr]
+        daemon=True,
+    )
+    stderr_reader.start()
+    timed_out = threading.Event()
+
+    def kill() -> None:
+        timed_out.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout, kill) if timeout is not None else None
+    if timer is not None:
+        timer.start()
+
+    def stop_timer() -> None:
+        # Wait for the timer to finish if it is firing, so that the process can't be
+        # killed after it has been reaped, by when its pid may have been reused
+        if timer is not None:
+            timer.cancel()
+            timer.join()
+
+    try:
+        if on_stdout_line is None:
+            stdout = proc.stdout.read()  # type: ignore[union-attr]
+        else:
+            lines = []
+            for line in proc.stdout:  # type: ignore[union-attr]
+                lines.append(line)
+                on_stdout_line(line)
+            stdout = b"".join(lines)
+        stderr_reader.join()
+        io_counts = None
+        if sys.platform == "linux":
+            # Wait for the process to exit without reaping it, so its I/O counters
+            # can still be read
+            os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+            io_counts = _read_proc_io(proc.pid)
+        stop_timer()
+        _, status, rusage = os.wait4(proc.pid, 0)
+    except BaseException:
+        # e.g. raised by on_stdout_line, in which case the process mustn't be left
+        # running or unreaped
+        stop_timer()
+        proc.kill()
+        proc.wait()
+        stderr_reader.join()
+        proc.stdout.close()  # type: ignore[union-attr]
+        proc.stderr.close()  # type: ignore[union-attr]
+        raise
+    # Let Popen know that the process has been reaped
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    proc.stdout.close()  # type: ignore[union-attr]
+    proc.stderr.close()  # type: ignore[union-attr]
+    # The timer may have fired after the process exited but before it was reaped, in
+    # which case the kill had no effect
+    if timed_out.is_set() and proc.returncode == -signal.SIGKILL:
+        raise subprocess.TimeoutExpired(
+            argv, ty.cast(float, timeout), output=stdout, stderr=stderr[0]
+        )
+    if io_counts is None:
+        # Block I/O counts are in units of 512 bytes
+        io_counts = (rusage.ru_inblock * 512, rusage.ru_oublock * 512)
+    usage = ChildUsage(
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        max_rss=rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        user_time=rusage.ru_utime,
+        sys_time=rusage.ru_stime,
+        read_bytes=io_counts[0],
+        write_bytes=io_counts[1],
+    )
+    return proc.returncode, stdout, stderr[0], usage
+
+
+def _read_proc_io(pid: int) -> tuple[int, int] | None:
+    """Reads the number of bytes read and written by a process from /proc"""
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            counts = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counts["rchar"]), int(counts["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
@@ -0,0 +1,583 @@
+"""Indexing of the files written by dcm2niix into its output directory.
+
+The output callables of :class:`~pydra.tasks.dcm2niix.Dcm2Niix` all need to look up
+files in the output directory. Rather than each of them probing the file-system
+separately, an :class:`OutputIndex` is built once, which they then share. Where
+possible the index is built from the manifest of converted series that dcm2niix prints
+to stdout, so that only the files written by the run are considered, falling back to a
+scan of the output directory otherwise.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections.abc import Iterator
+import functools
+import itertools
+import os
+import re
+from pathlib import Path
+import string
+import typing as ty
+import attrs
+from .templates import (
+    Postfix,
+    SeriesOutputs,
+    TemplateMatch,
+    compile_template,
+    is_template,
+    parse_postfix,
+)
+
+# Extensions of the files that dcm2niix can produce. Compound extensions need to come
+# before their final component so they are matched first
+KNOWN_EXTENSIONS = (
+    ".nii.gz.idx",
+    ".nii.gz",
+    ".nii",
+    ".json",
+    ".bval",
+    ".bvec",
+    ".nrrd",
+    ".nhdr",
+    ".raw.gz",
+    ".raw",
+    ".mha",
+    ".mhd",
+    ".txt",
+)
+
+# Extensions of files written alongside the outputs (e.g. the indices of indexed gzip
+# images) that belong to them but aren't returned in 'out_files'
+AUXILIARY_EXTENSIONS = (".nii.gz.idx",)
+
+# Line printed by dcm2niix for each converted series, e.g.
+# "Convert 176 DICOM as /path/to/out_file (256x256x176x1)"
+MANIFEST_LINE = re.compile(
+    r"^Convert \d+ DICOM as (?P<path>.+) \((?:\d+x)*\d+\)\s*$", flags=re.MULTILINE
+)
+
+
+def split_ext(name: str) -> tuple[str, str]:
+    """Splits a file name produced by dcm2niix into its stem and extension, taking
+    into account compound extensions such as '.nii.gz'
+
+    Parameters
+    ----------
+    name : str
+        the file name to split
+
+    Returns
+    -------
+    stem : str
+        the name without the extension
+    ext : str
+        the extension including the leading '.', or an empty string if there isn't one
+    """
+    for ext in KNOWN_EXTENSIONS:
+        if name.endswith(ext) and len(name) > len(ext):
+            return name[: -len(ext)], ext
+    stem, ext = os.path.splitext(name)
+    return stem, ext
+
+
+# Extensions of the images dcm2niix can write, in order of preference
+IMAGE_EXTENSIONS = (".nii.gz", ".nii", ".nrrd", ".nhdr", ".mha", ".mhd")
+
+# Trailing index of the files a series is split into, e.g. one file per volume with
+# compress='3' ('out_file_00012') or per image ('out_file_i00012')
+VOLUME_INDEX = re.compile(r"_i?(\d+)$")
+
+
+def volume_sort_key(name: str) -> tuple[str, int, str]:
+    """Sorts the names of the files a series is split into by their volume index (i.e.
+    numerically), after any files of the series without an index (e.g. its sidecar)"""
+    stem, ext = split_ext(name)
+    match = VOLUME_INDEX.search(stem)
+    if match is None:
+        return stem, -1, ext
+    return stem[: match.start(1)], int(match.group(1)), ext
+
+
+class OutputFiles(ty.Sequence[Path]):
+    """A compact, sorted collection of the files produced by a conversion, which can
+    hold the thousands of files a series is split into (e.g. one per volume with
+    compress='3') without the overhead of a Python object per file
+
+    The names are held in a single string, sliced by an array of offsets, and sorted
+    so that the volumes of a series are in order of their index. Paths are only
+    created as they are accessed, and the fileformats objects returned in the outputs
+    of the task by :meth:`filesets`, which validates each file once.
+
+    Parameters
+    ----------
+    out_dir : Path
+        the output directory the names are relative to
+    names : iterable[str]
+        the names of the files in the output directory
+    """
+
+    def __init__(self, out_dir: Path, names: ty.Iterable[str]):
+        self.out_dir = Path(out_dir)
+        names = sorted(names, key=volume_sort_key)
+        self._names = "".join(names)
+        self._offsets = array("Q", [0])
+        self.volumes = array("q")
+        for name in names:
+            self._offsets.append(self._offsets[-1] + len(name))
+            match = VOLUME_INDEX.search(split_ext(name)[0])
+            self.volumes.append(int(match.group(1)) if match else -1)
+        self._filesets: list[ty.Any] | None = None
+
+    def __len__(self) -> int:
+        return len(self.volumes)
+
+    @ty.overload
+    def __getitem__(self, i: int) -> Path: ...
+
+    @ty.overload
+    def __getitem__(self, i: slice) -> list[Path]: ...
+
+    def __getitem__(self, i: int | slice) -> Path | list[Path]:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.out_dir / self.name(i)
+
+    def name(self, i: int) -> str:
+        """Returns the name of the i-th file relative to the output directory"""
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"{type(self).__name__} index out of range")
+        return self._names[self._offsets[i] : self._offsets[i + 1]]
+
+    @property
+    def names(self) -> list[str]:
+        return [self.name(i) for i in range(len(self))]
+
+    def volume(self, index: int) -> list[Path]:
+        """Returns the files (e.g. the image and its sidecars) of a volume
+
+        Parameters
+        ----------
+        index : int
+            the index of the volume, as appended to the names of its files
+
+        Returns
+        -------
+        list[Path]
+            the files of the volume
+        """
+        return [self[i] for i, v in enumerate(self.volumes) if v == index]
+
+    def filesets(self, formats: ty.Mapping[str, type]) -> list[ty.Any]:
+        """Returns the files as fileformats objects, which are created (and their
+        contents validated) on the first call only
+
+        Parameters
+        ----------
+        formats : mapping[str, type]
+            the format to create the files with, by extension. Files with other
+            extensions are returned as strings
+
+        Returns
+        -------
+        list
+            the files as fileformats objects, in the same order as the collection
+        """
+        if self._filesets is None:
+            filesets = []
+            for name in self.names:
+                fileformat = formats.get(split_ext(name)[1])
+                path = self.out_dir / name
+                filesets.append(fileformat(path) if fileformat else str(path))
+            self._filesets = filesets
+        return self._filesets
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({str(self.out_dir)!r}, <{len(self)} files>)"
+
+
+@attrs.define
+class OutputBundle:
+    """The files written by dcm2niix for a single image, i.e. the image and its
+    sidecars, which share the same name
+
+    Parameters
+    ----------
+    postfix : Postfix or None
+        the parsed postfix of the image, or None if it doesn't follow dcm2niix's
+        postfix grammar
+    files : dict[str, Path]
+        the files of the bundle keyed by extension
+    """
+
+    postfix: Postfix | None
+    files: dict[str, Path] = attrs.field(factory=dict)
+
+    @property
+    def image(self) -> Path | None:
+        return next((self.files[e] for e in IMAGE_EXTENSIONS if e in self.files), None)
+
+    @property
+    def json(self) -> Path | None:
+        return self.files.get(".json")
+
+    @property
+    def bval(self) -> Path | None:
+        return self.files.get(".bval")
+
+    @property
+    def bvec(self) -> Path | None:
+        return self.files.get(".bvec")
+
+
+class OutputIndex:
+    """An index of the files in a dcm2niix output directory, grouped by extension and
+    stem, that can answer the look-ups required by the output callables without
+    touching the file-system again
+
+    Parameters
+    ----------
+    out_dir : Path
+        the output directory the names are relative to
+    names : iterable[str]
+        the names of the files in the output directory
+    """
+
+    def __init__(self, out_dir: Path, names: ty.Iterable[str]):
+        self.out_dir = Path(out_dir).absolute()
+        self._names = sorted(names)
+        self._matches: dict[str, list[tuple[Path, TemplateMatch]]] = {}
+        self._out_files: dict[str, OutputFiles] = {}
+        self._by_ext: dict[str, dict[str, str]] = {}
+        for name in self._names:
+            stem, ext = split_ext(name)
+            self._by_ext.setdefault(ext, {})[stem] = name
+
+    @classmethod
+    def scan(cls, out_dir: str | Path) -> "OutputIndex":
+        """Builds the index from a single pass over the output directory"""
+        with os.scandir(out_dir) as entries:
+            names = [e.name for e in entries if not e.is_dir()]
+        return cls(Path(out_dir), names)
+
+    @classmethod
+    def from_manifest(
+        cls, out_dir: str | Path, manifest: ty.Sequence[str]
+    ) -> "OutputIndex | None":
+        """Builds the index from the output paths (without extensions) listed by
+        dcm2niix in its stdout, probing only the extensions it could have written for
+        each of them
+
+        Parameters
+        ----------
+        out_dir : str or Path
+            the output directory the names are made relative to, and which relative
+            paths in the manifest are resolved against
+        manifest : sequence[str]
+            the output paths, without extensions, parsed from stdout
+
+        Returns
+        -------
+        OutputIndex or None
+            the index, or None if no files were found for one of the manifest entries
+            (e.g. when dcm2niix splits the series into separate 3D volumes), in which
+            case the output directory needs to be scanned instead
+        """
+        out_dir = Path(out_dir).absolute()
+        names = []
+        for stem in manifest:
+            found = False
+            for ext in KNOWN_EXTENSIONS:
+                path = out_dir / (stem + ext)
+                if path.is_file():
+                    names.append(os.path.relpath(path, out_dir))
+                    found = True
+            if not found:
+                return None
+        return cls(out_dir, names)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __contains__(self, name: str) -> bool:
+        i = bisect_left(self._names, name)
+        return i < len(self._names) and self._names[i] == name
+
+    def path(self, name: str) -> Path:
+        return self.out_dir / name
+
+    def get(self, stem: str, ext: str) -> Path | None:
+        """Returns the path of the file with the given stem and extension if present"""
+        try:
+            return self.path(self._by_ext[ext][stem])
+        except KeyError:
+            return None
+
+    def with_ext(self, ext: str) -> list[Path]:
+        """Returns all files with the given extension"""
+        return [self.path(n) for n in sorted(self._by_ext.get(ext, {}).values())]
+
+    def with_prefix(self, prefix: str) -> list[Path]:
+        """Returns all files whose names start with the given prefix"""
+        paths = []
+        for name in self._names[bisect_left(self._names, prefix) :]:
+            if not name.startswith(prefix):
+                break
+            paths.append(self.path(name))
+        return paths
+
+    def out_files(self, filename: str) -> OutputFiles:
+        """Returns the files produced with the given filename, i.e. that start with
+        it or, if it is a template, match it, excluding auxiliary files"""
+        try:
+            return self._out_files[filename]
+        except KeyError:
+            pass
+        if is_template(filename):
+            names = [
+                str(p.relative_to(self.out_dir)) for p, _ in self.matches(filename)
+            ]
+        else:
+            names = []
+            for name in self._names[bisect_left(self._names, filename) :]:
+                if not name.startswith(filename):
+                    break
+                if not name.endswith(AUXILIARY_EXTENSIONS):
+                    names.append(name)
+        return self._out_files.setdefault(filename, OutputFiles(self.out_dir, names))
+
+    def matches(self, template: str) -> list[tuple[Path, TemplateMatch]]:
+        """Returns the files whose names were produced by a filename template (e.g.
+        '%p_%s'), along with the fields recovered from their names, excluding
+        auxiliary files
+
+        Parameters
+        ----------
+        template : str
+            the filename template passed to dcm2niix
+
+        Returns
+        -------
+        list[tuple[Path, TemplateMatch]]
+            the matching files and their fields
+        """
+        try:
+            return self._matches[template]
+        except KeyError:
+            pass
+        compiled = compile_template(template)
+        matches = []
+        for name in self._names:
+            stem, ext = split_ext(name)
+            if ext in AUXILIARY_EXTENSIONS:
+                continue
+            if match := compiled.match(stem):
+                matches.append((self.path(name), match))
+        return self._matches.setdefault(template, matches)
+
+    def series(self, filename: str) -> dict[str, SeriesOutputs]:
+        """Groups the files produced with a filename or template by the series they
+        were converted from
+
+        Parameters
+        ----------
+        filename : str
+            the filename or template passed to dcm2niix
+
+        Returns
+        -------
+        dict[str, SeriesOutputs]
+            the outputs of each series, keyed by the name shared by their files
+        """
+        groups: dict[str, SeriesOutputs] = {}
+        for path, match in self.matches(filename):
+            series = groups.get(match.series)
+            if series is None:
+                series = groups[match.series] = SeriesOutputs(
+                    match.series, match.fields
+                )
+            series.files.setdefault(match.postfix, {})[split_ext(path.name)[1]] = path
+        return groups
+
+    def bundles(self, filename: str) -> dict[str, OutputBundle]:
+        """Groups the files produced with a filename into bundles of the image and
+        sidecars written for each image, parsing their postfixes
+
+        Parameters
+        ----------
+        filename : str
+            the filename or template passed to dcm2niix
+
+        Returns
+        -------
+        dict[str, OutputBundle]
+            the bundles keyed by postfix ('' for the undisambiguated image), or if the
+            filename is a template, by the name of the series followed by the postfix
+        """
+        bundles: dict[str, OutputBundle] = {}
+        if is_template(filename):
+            for path, match in self.matches(filename):
+                key = match.series + match.postfix
+                if key not in bundles:
+                    bundles[key] = OutputBundle(parse_postfix(match.postfix))
+                bundles[key].files[split_ext(path.name)[1]] = path
+        else:
+            for postfix, files in self.postfixes(filename).items():
+                files = {
+                    e: p for e, p in files.items() if e not in AUXILIARY_EXTENSIONS
+                }
+                if files:
+                    bundles[postfix] = OutputBundle(parse_postfix(postfix), files)
+        return bundles
+
+    def postfixes(self, filename: str) -> dict[str, dict[str, Path]]:
+        """Groups the files that start with the given base filename by the postfix
+        dcm2niix appended to disambiguate them (e.g. '_e2', '_ph') and then by their
+        extension
+
+        Parameters
+        ----------
+        filename : str
+            the base filename passed to dcm2niix
+
+        Returns
+        -------
+        dict[str, dict[str, Path]]
+            mapping from postfix ('' for the undisambiguated file) to extension to path
+        """
+        groups: dict[str, dict[str, Path]] = {}
+        for path in self.with_prefix(filename):
+            stem, ext = split_ext(path.name)
+            groups.setdefault(stem[len(filename) :], {})[ext] = path
+        return groups
+
+
+@functools.lru_cache(maxsize=16)
+def parse_manifest(stdout: str) -> tuple[str, ...]:
+    """Parses the output paths (without extensions) of the converted series from the
+    stdout of dcm2niix
+
+    Parameters
+    ----------
+    stdout : str
+        the captured standard output of the dcm2niix process
+
+    Returns
+    -------
+    tuple[str, ...]
+        the output paths in the order they were converted
+    """
+    return tuple(m.group("path") for m in MANIFEST_LINE.finditer(stdout))
+
+
+@functools.lru_cache(maxsize=16)
+def _cached_index(
+    out_dir: str, cache_dir: str, stdout: str, mtime_ns: int
+) -> OutputIndex:
+    return OutputIndex.scan(out_dir)
+
+
+@functools.lru_cache(maxsize=16)
+def _cached_manifest_index(
+    out_dir: str, cache_dir: str, manifest: tuple[str, ...], mtime_ns: int
+) -> OutputIndex | None:
+    return OutputIndex.from_manifest(out_dir, manifest)
+
+
+def output_index(
+    out_dir: str | Path,
+    cache_dir: str | Path | None = None,
+    stdout: str | None = None,
+) -> OutputIndex:
+    """Returns the index of the outputs of a task, building it only on the first call
+    for a given run of a task (as identified by its output directory, its stdout, the
+    modification time of the directory and, if provided, its cache directory). The
+    index is built from the manifest printed to stdout if it is provided and lists the
+    outputs, otherwise the output directory is scanned
+
+    Parameters
+    ----------
+    out_dir : str or Path
+        the output directory to index
+    cache_dir : str or Path, optional
+        the cache directory of the job the outputs are being collected for
+    stdout : str, optional
+        the captured stdout of the dcm2niix process
+
+    Returns
+    -------
+    OutputIndex
+        the index of the files in the output directory
+    """
+    out_dir = Path(out_dir).absolute()
+    cache_key = str(cache_dir) if cache_dir is not None else ""
+    # The modification time of the directory alone can't be relied on to tell runs
+    # apart, as it can be coarse, so the stdout of the run is included in the key
+    mtime_ns = out_dir.stat().st_mtime_ns
+    if stdout and (manifest := parse_manifest(stdout)):
+        index = _cached_manifest_index(str(out_dir), cache_key, manifest, mtime_ns)
+        if index is not None:
+            return index
+    return _cached_index(str(out_dir), cache_key, stdout or "", mtime_ns)
+
+
+def merge_outputs(
+    staged: list[tuple[Path, list[str]]], out_dir: Path, name_conflicts: int | None
+) -> list[str]:
+    """Moves the outputs of the separate series conversions into the output directory,
+    resolving clashing names following dcm2niix's 'name_conflicts' (-w) behaviour
+
+    Parameters
+    ----------
+    staged : list[tuple[Path, list[str]]]
+        the output directory of each series conversion and the names of the files
+        it produced, in series order
+    out_dir : Path
+        the output directory to merge them into
+    name_conflicts : int or None
+        0 to skip files that clash with existing ones, 1 to overwrite them and 2
+        (the default) to append a letter to their names
+
+    Returns
+    -------
+    list[str]
+        the names of the merged files in the output directory
+    """
+    merged = []
+    for series_dir, names in staged:
+        stems: dict[str, list[str]] = {}
+        for name in names:
+            stem, ext = split_ext(name)
+            stems.setdefault(stem, []).append(ext)
+        for stem, exts in stems.items():
+            # The files of a series share the same stem, so the same suffix is
+            # applied to all of them if any clash
+            suffix = ""
+            if _clashes(out_dir, stem, exts):
+                if name_conflicts == 0:
+                    continue
+                if name_conflicts != 1:
+                    suffixes = clash_suffixes()
+                    suffix = next(suffixes)
+                    while _clashes(out_dir, stem + suffix, exts):
+                        suffix = next(suffixes)
+            for ext in exts:
+                name = stem + suffix + ext
+                dest = out_dir / name
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(series_dir / (stem + ext), dest)
+                merged.append(name)
+    return merged
+
+
+def clash_suffixes() -> Iterator[str]:
+    """Generates the suffixes dcm2niix appends to resolve clashing names in the order
+    they are tried, i.e. 'a' to 'z', then 'aa', 'ab' and so on"""
+    for length in itertools.count(1):
+        for letters in itertools.product(string.ascii_lowercase, repeat=length):
+            yield "".join(letters)
+
+
+def _clashes(out_dir: Path, stem: str, exts: list[str]) -> bool:
+    return any(os.path.lexists(out_dir / (stem + ext)) for ext in exts)
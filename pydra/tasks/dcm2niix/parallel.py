@@ -0,0 +1,117 @@
+"""Converting the series of a DICOM directory in parallel.
+
+dcm2niix converts the series in its input directory one after another on a single
+core. :func:`convert_series_parallel` instead catalogs the directory by series instance
+UID, links the files of each series into a separate directory and runs a dcm2niix
+process on each of them concurrently, before merging their outputs back into the
+output directory, disambiguating clashing names in the same way as dcm2niix.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import attrs
+from .cache import ConversionCache
+from .compression import ParallelGzip
+from .convert import convert, run
+from .catalog import load_catalog
+from .outputs import OutputIndex, merge_outputs
+from .utils import Dcm2Niix, collect_outputs
+
+
+def link_series(paths: list[Path], farm_dir: Path) -> Path:
+    """Creates a directory of symlinks to the files of a series, named after the folder
+    holding its first file so that '%f' in the filename template expands as it would
+    converting the files in place
+
+    Parameters
+    ----------
+    paths : list[Path]
+        the files of the series
+    farm_dir : Path
+        the directory to create the directory of links in
+
+    Returns
+    -------
+    Path
+        the directory of links
+    """
+    link_dir = farm_dir / paths[0].parent.name
+    link_dir.mkdir(parents=True)
+    for i, path in enumerate(paths):
+        # Prefix the names with their index as they may come from different
+        # sub-directories
+        (link_dir / f"{i:06d}_{path.name}").symlink_to(path.absolute())
+    return link_dir
+
+
+def convert_series_parallel(
+    task: Dcm2Niix,
+    max_workers: int | None = None,
+    cache: ConversionCache | None = None,
+    compressor: ParallelGzip | None = None,
+) -> Dcm2Niix.Outputs:
+    """Converts each series in the input directory of a Dcm2Niix task with a separate
+    dcm2niix process, running up to 'max_workers' of them at a time
+
+    Parameters
+    ----------
+    task : Dcm2Niix
+        the task to run, which must have 'out_dir' set
+    max_workers : int, optional
+        the maximum number of concurrent dcm2niix processes, by default the number of
+        CPUs
+    cache : ConversionCache, optional
+        a cache to look up each series conversion in
+    compressor : ParallelGzip, optional
+        a stage to compress the NIfTI images with instead of dcm2niix, if the task
+        compresses them
+
+    Returns
+    -------
+    Dcm2Niix.Outputs
+        the outputs of all the series conversions combined
+    """
+    if task.out_dir is None:
+        raise ValueError(f"'out_dir' needs to be set to run {task} outside of pydra")
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    catalog = load_catalog(task.in_dir, task.search_depth)
+    if len(catalog.series) < 2 or max_workers == 1:
+        return convert(task, cache=cache, compressor=compressor)
+    out_dir = Path(task.out_dir).absolute()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    # Stage the outputs within the output directory so they can be moved into place,
+    # but create the links to the series on local scratch
+    staging_dir = Path(tempfile.mkdtemp(prefix=".dcm2niix-", dir=out_dir))
+    farm_dir = Path(tempfile.mkdtemp(prefix="dcm2niix-series-"))
+    try:
+        series_tasks = []
+        for i, series_uid in enumerate(catalog.series):
+            series_tasks.append(
+                attrs.evolve(
+                    task,
+                    in_dir=link_series(catalog.paths(series_uid), farm_dir / str(i)),
+                    out_dir=staging_dir / str(i),
+                    search_depth=0,
+                )
+            )
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            runs = list(
+                pool.map(
+                    lambda t: run(t, cache=cache, compressor=compressor), series_tasks
+                )
+            )
+        staged = [(r.index.out_dir, r.names) for r in runs]
+        names = merge_outputs(staged, out_dir, task.name_conflicts)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        shutil.rmtree(farm_dir, ignore_errors=True)
+    return collect_outputs(
+        task,
+        OutputIndex(out_dir, names),
+        stdout="".join(r.stdout for r in runs),
+        stderr="".join(r.stderr for r in runs),
+    )
@@ -0,0 +1,329 @@
+"""Predicting the files a conversion will produce without running dcm2niix.
+
+An :class:`OutputPlan` is built from the header-only catalog of the input directory
+(see :mod:`pydra.tasks.dcm2niix.catalog`) and dcm2niix's naming rules (see
+https://github.com/rordenlab/dcm2niix/blob/master/FILENAMING.md): the filename template
+is expanded from the headers of each series, the '_e#' and '_ph' postfixes are appended
+to tell the echoes and phase images of a series apart, clashes with existing files are
+resolved following 'name_conflicts' and the extensions follow the 'compress', 'bids'
+and 'export_nrrd' arguments. The plan can be used to size and wire up workflows before
+the conversion is run, and afterwards to check the files that were produced against it
+with a set look-up per file rather than a scan of the output directory.
+
+The plan is a prediction and some outputs can't be predicted from the catalog, such as
+the bval/bvec files of diffusion series, which are only written for some series, and
+the volumes of series split into 3D files. Such files are reported as 'extra' rather
+than unexpected when a run is checked against its plan, and plans that depend on them
+are marked as inexact.
+"""
+
+import os
+from pathlib import Path
+import re
+import typing as ty
+import attrs
+from .catalog import DicomCatalog, SeriesInfo, load_catalog
+from .dicom import read_header
+from .outputs import OutputIndex, clash_suffixes, split_ext
+from .templates import normalise_specifiers
+from .utils import GZIP_MODES, Dcm2Niix
+
+# The header fields each template specifier is expanded from, for the specifiers that
+# can be predicted
+PLANNED_SPECIFIERS = {
+    "d": "SeriesDescription",
+    "e": "EchoNumbers",
+    "i": "PatientID",
+    "j": "SeriesInstanceUID",
+    "k": "StudyInstanceUID",
+    "n": "PatientName",
+    "p": "ProtocolName",
+    "s": "SeriesNumber",
+    "x": "StudyID",
+    "z": "SequenceName",
+}
+
+# Characters that dcm2niix replaces with underscores in the expanded filename: spaces,
+# control characters and those that aren't valid in filenames on Windows, except for
+# the path separator, so templates (and values) can still create sub-directories
+FORBIDDEN_CHARACTERS = re.compile(r'[\x00-\x1f <>:"\\|?*^]')
+
+# Extensions of the files that may be written for a series in addition to the planned
+# ones, depending on headers that aren't catalogued
+OPTIONAL_EXTENSIONS = (".bval", ".bvec")
+
+
+@attrs.define
+class PlannedImage:
+    """An image (and its sidecars) that a conversion is predicted to write
+
+    Parameters
+    ----------
+    series_uid : str
+        the instance UID of the series the image is converted from
+    stem : str
+        the name of the image relative to the output directory, without extension
+    extensions : tuple[str, ...]
+        the extensions of the files written for the image
+    echo : int, optional
+        the echo of the image, if the series has more than one
+    phase : bool
+        whether the image is a phase image
+    input_bytes : int
+        the size of the DICOMs of the series, as an estimate of the size of the image
+    """
+
+    series_uid: str
+    stem: str
+    extensions: tuple[str, ...]
+    echo: int | None = None
+    phase: bool = False
+    input_bytes: int = 0
+
+    @property
+    def names(self) -> list[str]:
+        return [self.stem + ext for ext in self.extensions]
+
+
+@attrs.define
+class PlanCheck:
+    """The differences between the files produced by a conversion and its plan
+
+    Parameters
+    ----------
+    missing : list[str]
+        planned files that weren't produced
+    unexpected : list[str]
+        produced files that weren't planned
+    extra : list[str]
+        produced files that weren't planned but may be written depending on headers
+        that weren't catalogued (e.g. bval/bvec files)
+    """
+
+    missing: list[str] = attrs.field(factory=list)
+    unexpected: list[str] = attrs.field(factory=list)
+    extra: list[str] = attrs.field(factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.missing and not self.unexpected
+
+
+@attrs.define
+class OutputPlan:
+    """The files a conversion is predicted to write to its output directory
+
+    Parameters
+    ----------
+    out_dir : Path
+        the output directory
+    images : list[PlannedImage]
+        the images predicted to be written, in the order they are converted
+    inexact : list[str]
+        the reasons the prediction may not be exact, if any
+    """
+
+    out_dir: Path
+    images: list[PlannedImage] = attrs.field(factory=list)
+    inexact: list[str] = attrs.field(factory=list)
+    _names: frozenset[str] | None = attrs.field(default=None, init=False, repr=False)
+
+    @property
+    def exact(self) -> bool:
+        return not self.inexact
+
+    @property
+    def names(self) -> list[str]:
+        """The names of the planned files relative to the output directory"""
+        return [n for image in self.images for n in image.names]
+
+    @property
+    def paths(self) -> list[Path]:
+        return [self.out_dir / n for n in self.names]
+
+    @property
+    def input_bytes(self) -> int:
+        return sum(i.input_bytes for i in self.images)
+
+    def __contains__(self, name: str) -> bool:
+        if self._names is None:
+            self._names = frozenset(self.names)
+        return name in self._names
+
+    def __len__(self) -> int:
+        return sum(len(i.extensions) for i in self.images)
+
+    def check(self, produced: OutputIndex | ty.Iterable[str]) -> PlanCheck:
+        """Checks the files produced by a conversion against the plan
+
+        Parameters
+        ----------
+        produced : OutputIndex or iterable[str]
+            the index of the files produced by the run (e.g. the 'index' of a
+            ConversionRun), or their names relative to the output directory
+
+        Returns
+        -------
+        PlanCheck
+            the planned files that are missing and the unplanned files produced
+        """
+        if isinstance(produced, OutputIndex):
+            produced = [
+                os.path.relpath(p, self.out_dir) for p in produced.with_prefix("")
+            ]
+        stems = {image.stem for image in self.images}
+        check = PlanCheck()
+        found = set()
+        for name in produced:
+            if name in self:
+                found.add(name)
+                continue
+            stem, ext = split_ext(name)
+            if stem in stems and ext in OPTIONAL_EXTENSIONS:
+                check.extra.append(name)
+            else:
+                check.unexpected.append(name)
+        check.missing = [n for n in self.names if n not in found]
+        return check
+
+
+def plan_outputs(
+    task: Dcm2Niix,
+    catalog: DicomCatalog | None = None,
+    existing: ty.Iterable[str] | None = None,
+) -> OutputPlan:
+    """Predicts the files a Dcm2Niix task will write to its output directory
+
+    Parameters
+    ----------
+    task : Dcm2Niix
+        the task to plan, which must have 'out_dir' set
+    catalog : DicomCatalog, optional
+        the catalog of the task's input directory, by default it is loaded (from the
+        catalog cache if the directory hasn't changed)
+    existing : iterable[str], optional
+        the names of the files already in the output directory that the outputs may
+        clash with, by default the output directory is scanned
+
+    Returns
+    -------
+    OutputPlan
+        the predicted outputs
+
+    Raises
+    ------
+    ValueError
+        if 'out_dir' isn't set or the filename template contains specifiers that
+        can't be predicted from the headers (e.g. '%t')
+    """
+    if task.out_dir is None:
+        raise ValueError(f"'out_dir' needs to be set to plan the outputs of {task}")
+    out_dir = Path(task.out_dir).absolute()
+    template = normalise_specifiers(task.filename)
+    unsupported = (
+        set(re.findall(r"%(.)", template))
+        - set(PLANNED_SPECIFIERS)
+        - {
+            "f",
+            "%",
+        }
+    )
+    if unsupported:
+        raise ValueError(
+            f"Can't predict the names produced by the '%{'/%'.join(sorted(unsupported))}' "
+            f"specifiers of the filename template {template!r}"
+        )
+    if catalog is None:
+        catalog = load_catalog(task.in_dir, search_depth=task.search_depth)
+    if existing is None:
+        existing = os.listdir(out_dir) if out_dir.is_dir() else []
+    plan = OutputPlan(out_dir)
+    extensions = []
+    if task.bids != "o":
+        if task.export_nrrd == "y":
+            extensions.append(".nhdr")
+        else:
+            extensions.append(".nii.gz" if task.compress in GZIP_MODES else ".nii")
+        if task.compress == "3":
+            plan.inexact.append("series are split into a file per volume")
+    if task.bids in ("y", "o"):
+        extensions.append(".json")
+    # Files in the output directory, and names planned so far, that can clash
+    taken = {split_ext(n)[0] for n in existing if split_ext(n)[1] in extensions}
+    headers = [t for s, t in PLANNED_SPECIFIERS.items() if "%" + s in template]
+    for series in catalog.series.values():
+        if task.ignore_derived == "y" and (series.derived or series.localizer):
+            continue
+        fields = _series_fields(catalog, series, headers)
+        # '%f' is the name of the folder holding the files of the series
+        folder = catalog.paths(series.series_uid)[0].parent.name
+        echoes = series.echo_numbers or [1]
+        phases = sorted({_is_phase(t) for t in series.image_types} or {False})
+        for echo in echoes:
+            for phase in phases:
+                stem = _expand(template, {**fields, "EchoNumbers": str(echo)}, folder)
+                if not task.terse:
+                    if len(echoes) > 1 and "%e" not in template:
+                        stem += f"_e{echo}"
+                    if phase:
+                        stem += "_ph"
+                if stem in taken:
+                    if task.name_conflicts == 0:
+                        continue
+                    if task.name_conflicts != 1:
+                        suffixes = clash_suffixes()
+                        suffix = next(suffixes)
+                        while stem + suffix in taken:
+                            suffix = next(suffixes)
+                        stem += suffix
+                taken.add(stem)
+                plan.images.append(
+                    PlannedImage(
+                        series_uid=series.series_uid,
+                        stem=stem,
+                        extensions=tuple(extensions),
+                        echo=echo if len(echoes) > 1 else None,
+                        phase=phase,
+                        input_bytes=series.total_bytes // (len(echoes) * len(phases)),
+                    )
+                )
+    return plan
+
+
+def _series_fields(
+    catalog: DicomCatalog, series: SeriesInfo, headers: list[str]
+) -> dict[str, str]:
+    """Returns the values of the header fields the template is expanded from, reading
+    the first instance of the series for fields that aren't catalogued"""
+    fields = {
+        "SeriesDescription": series.series_description,
+        "SeriesInstanceUID": series.series_uid,
+        "StudyInstanceUID": series.study_uid,
+        "ProtocolName": series.protocol_name,
+        "SeriesNumber": (
+            str(series.series_number) if series.series_number is not None else ""
+        ),
+    }
+    uncatalogued = [h for h in headers if h not in fields and h != "EchoNumbers"]
+    if uncatalogued:
+        header = read_header(catalog.paths(series.series_uid)[0], uncatalogued)
+        for tag in uncatalogued:
+            fields[tag] = str(header.get(tag, "")) if header is not None else ""
+    return fields
+
+
+def _expand(template: str, fields: dict[str, str], folder: str) -> str:
+    """Expands the specifiers of a filename template, then replaces the characters of
+    the name that dcm2niix doesn't allow in filenames"""
+
+    def expand(match: re.Match[str]) -> str:
+        spec = match.group(1)
+        if spec == "%":
+            return "%"
+        return folder if spec == "f" else fields.get(PLANNED_SPECIFIERS[spec], "")
+
+    return FORBIDDEN_CHARACTERS.sub("_", re.sub(r"%(.)", expand, template))
+
+
+def _is_phase(image_type: list[str]) -> bool:
+    return "P" in image_type or "PHASE" in image_type
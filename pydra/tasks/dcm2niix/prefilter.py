@@ -0,0 +1,315 @@
+"""Filtering out the DICOMs dcm2niix can't or won't convert before running it.
+
+dcm2niix opens and parses every file in its input directory, including structured
+reports, presentation states, raw data and other objects that aren't images, and, when
+its 'ignore_derived' ('-i') option is set, derived images and localizers that it then
+skips. A :class:`DicomFilter` selects the convertible instances from the header-only
+catalog of the input directory (see :mod:`pydra.tasks.dcm2niix.catalog`, which is
+cached on disk), by the SOP class, modality and image type of each series, only
+reading the headers of the individual instances of series that mix convertible and
+non-convertible instances. The selected instances are then linked into a scratch
+directory, mirroring their paths within the input directory, which dcm2niix reads in
+place of the input directory.
+
+Instances are only excluded if dcm2niix wouldn't convert them anyway, so the outputs of
+a filtered conversion are the same as those of an unfiltered one: derived images
+(including secondary captures) and localizers are only excluded if the task sets
+'ignore_derived', unless the filter's 'exclude_derived' overrides it.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from pathlib import Path
+import shutil
+import tempfile
+import typing as ty
+import attrs
+from .catalog import DicomCatalog, SeriesInfo, load_catalog
+from .dicom import read_header
+from .utils import Dcm2Niix
+
+logger = logging.getLogger("pydra.tasks.dcm2niix")
+
+# SOP classes (and the classes nested under them) that don't hold images dcm2niix can
+# convert
+NON_IMAGE_SOP_CLASSES = (
+    "1.2.840.10008.5.1.4.1.1.9",  # waveforms
+    "1.2.840.10008.5.1.4.1.1.11",  # presentation states
+    "1.2.840.10008.5.1.4.1.1.66",  # raw data, registrations, segmentations, etc...
+    "1.2.840.10008.5.1.4.1.1.88",  # structured reports and key object selections
+    "1.2.840.10008.5.1.4.1.1.104",  # encapsulated documents (PDF, CDA, STL, etc...)
+    "1.2.840.10008.5.1.4.1.1.481.3",  # RT structure set
+    "1.2.840.10008.5.1.4.1.1.481.4",  # RT beams treatment record
+    "1.2.840.10008.5.1.4.1.1.481.5",  # RT plan
+    "1.2.840.10008.5.1.4.1.1.481.6",  # RT brachy treatment record
+    "1.2.840.10008.5.1.4.1.1.481.7",  # RT treatment summary record
+    "1.2.840.10008.5.1.4.1.1.481.8",  # RT ion plan
+    "1.2.840.10008.5.1.4.1.1.481.9",  # RT ion beams treatment record
+)
+
+# SOP classes of images that are derived by construction
+DERIVED_SOP_CLASSES = ("1.2.840.10008.5.1.4.1.1.7",)  # secondary captures
+
+NON_IMAGE_MODALITIES = (
+    "AU",
+    "DOC",
+    "ECG",
+    "HD",
+    "KO",
+    "PLAN",
+    "PR",
+    "REG",
+    "RTPLAN",
+    "RTRECORD",
+    "RTSTRUCT",
+    "SEG",
+    "SR",
+)
+
+FILTER_TAGS = ("SOPClassUID", "Modality", "ImageType")
+
+
+@attrs.define
+class FilteredInput:
+    """The convertible instances of an input directory, linked into a scratch directory
+
+    Parameters
+    ----------
+    work_dir : Path
+        the scratch directory holding the links
+    in_dir : Path
+        the directory for dcm2niix to read, which mirrors the name and layout of the
+        input directory
+    num_linked : int
+        the number of instances linked
+    excluded : dict[str, int]
+        the number of files excluded for each reason, i.e. 'non_dicom', 'non_image' or
+        'derived'
+    """
+
+    work_dir: Path
+    in_dir: Path
+    num_linked: int = 0
+    excluded: dict[str, int] = attrs.field(factory=dict)
+
+    @property
+    def num_excluded(self) -> int:
+        return sum(self.excluded.values())
+
+    def cleanup(self) -> None:
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+@attrs.define
+class DicomFilter:
+    """Selects the instances of an input directory that dcm2niix would convert
+
+    Parameters
+    ----------
+    exclude_derived : bool, optional
+        whether to exclude derived images (including secondary captures) and
+        localizers, by default only if the task sets 'ignore_derived'
+    non_image_sop_classes : tuple[str, ...]
+        the SOP classes to exclude, along with the classes nested under them
+    non_image_modalities : tuple[str, ...]
+        the modalities to exclude
+    root : Path, optional
+        the scratch directory to create the links in, by default $TMPDIR
+    max_workers : int, optional
+        the number of threads to read headers with
+    """
+
+    exclude_derived: bool | None = None
+    non_image_sop_classes: tuple[str, ...] = NON_IMAGE_SOP_CLASSES
+    non_image_modalities: tuple[str, ...] = NON_IMAGE_MODALITIES
+    root: Path | None = attrs.field(
+        default=None, converter=lambda p: Path(p) if p is not None else None
+    )
+    max_workers: int | None = None
+
+    def reason(
+        self,
+        sop_class_uid: str | None = None,
+        modality: str | None = None,
+        image_type: ty.Sequence[str] | None = None,
+        exclude_derived: bool = False,
+    ) -> str | None:
+        """Returns why an instance is excluded from its header values, any of which
+        can be omitted to only apply the rules of the others
+
+        Parameters
+        ----------
+        sop_class_uid : str, optional
+            the SOP class of the instance
+        modality : str, optional
+            the modality of the instance
+        image_type : sequence[str], optional
+            the image type of the instance
+        exclude_derived : bool
+            whether to exclude derived images and localizers
+
+        Returns
+        -------
+        str or None
+            'non_image' or 'derived' if the instance is excluded, otherwise None
+        """
+        if modality in self.non_image_modalities or (
+            sop_class_uid and _in_classes(sop_class_uid, self.non_image_sop_classes)
+        ):
+            return "non_image"
+        if exclude_derived and (
+            (sop_class_uid and _in_classes(sop_class_uid, DERIVED_SOP_CLASSES))
+            or (
+                image_type and (image_type[0] == "DERIVED" or "LOCALIZER" in image_type)
+            )
+        ):
+            return "derived"
+        return None
+
+    def select(
+        self, catalog: DicomCatalog, exclude_derived: bool = False
+    ) -> tuple[list[str], dict[str, int]]:
+        """Selects the convertible instances of a catalogued directory
+
+        Parameters
+        ----------
+        catalog : DicomCatalog
+            the catalog of the directory
+        exclude_derived : bool
+            whether to exclude derived images and localizers
+
+        Returns
+        -------
+        selected : list[str]
+            the paths of the convertible instances relative to the directory
+        excluded : dict[str, int]
+            the number of files excluded for each reason
+        """
+        selected = []
+        excluded: dict[str, int] = {}
+        if catalog.non_dicom:
+            excluded["non_dicom"] = len(catalog.non_dicom)
+        series_reasons = {
+            uid: self._series_reasons(series, exclude_derived)
+            for uid, series in catalog.series.items()
+        }
+        # Series that mix instances that are and aren't excluded need the headers of
+        # their instances to be read individually, which are read concurrently
+        mixed = [
+            relpath
+            for uid, reasons in series_reasons.items()
+            if len(reasons) > 1
+            for relpath in catalog.series[uid].files
+        ]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            headers = dict(
+                zip(
+                    mixed,
+                    pool.map(
+                        lambda p: read_header(catalog.root / p, FILTER_TAGS), mixed
+                    ),
+                )
+            )
+        for uid, series in catalog.series.items():
+            reasons = series_reasons[uid]
+            if reasons == {None}:
+                selected.extend(series.files)
+            elif len(reasons) == 1:
+                (reason,) = reasons
+                excluded[reason] = excluded.get(reason, 0) + len(series.files)
+            else:
+                for relpath in series.files:
+                    header = headers[relpath]
+                    reason = self.reason(
+                        str(header.get("SOPClassUID", "")),
+                        str(header.get("Modality", "")),
+                        _image_type(header.get("ImageType")),
+                        exclude_derived,
+                    )
+                    if reason is None:
+                        selected.append(relpath)
+                    else:
+                        excluded[reason] = excluded.get(reason, 0) + 1
+        return selected, excluded
+
+    def link(self, task: Dcm2Niix, in_dir: str | Path | None = None) -> FilteredInput:
+        """Links the convertible instances of the input directory of a task into a
+        scratch directory
+
+        Parameters
+        ----------
+        task : Dcm2Niix
+            the task providing the search depth and 'ignore_derived' setting
+        in_dir : str or Path, optional
+            the input directory, by default the 'in_dir' of the task
+
+        Returns
+        -------
+        FilteredInput
+            the scratch directory of links, which should be cleaned up once the
+            conversion has run
+        """
+        in_dir = Path(in_dir if in_dir is not None else task.in_dir).absolute()
+        exclude_derived = self.exclude_derived
+        if exclude_derived is None:
+            exclude_derived = task.ignore_derived == "y"
+        catalog = load_catalog(in_dir, task.search_depth, max_workers=self.max_workers)
+        selected, excluded = self.select(catalog, exclude_derived)
+        if self.root is not None:
+            self.root.mkdir(parents=True, exist_ok=True)
+        work_dir = Path(tempfile.mkdtemp(prefix="dcm2niix-filter-", dir=self.root))
+        # Keep the name of the input directory, which dcm2niix can name outputs by
+        filtered = FilteredInput(
+            work_dir=work_dir,
+            in_dir=work_dir / in_dir.name,
+            num_linked=len(selected),
+            excluded=excluded,
+        )
+        try:
+            filtered.in_dir.mkdir()
+            for relpath in selected:
+                link = filtered.in_dir / relpath
+                link.parent.mkdir(parents=True, exist_ok=True)
+                link.symlink_to(catalog.root / relpath)
+        except BaseException:
+            filtered.cleanup()
+            raise
+        logger.debug(
+            "Linked %s of the files in %s into %s, excluding %s",
+            filtered.num_linked,
+            in_dir,
+            filtered.in_dir,
+            excluded,
+        )
+        return filtered
+
+    def _series_reasons(
+        self, series: SeriesInfo, exclude_derived: bool
+    ) -> set[str | None]:
+        """Returns the reasons the instances of a series may be excluded for, from the
+        distinct values of their headers, where None stands for not being excluded"""
+        reasons = set()
+        for sop_class_uid in series.sop_class_uids or [None]:
+            reason = self.reason(
+                sop_class_uid, series.modality, exclude_derived=exclude_derived
+            )
+            if reason is None and exclude_derived:
+                reasons |= {
+                    self.reason(image_type=t, exclude_derived=True)
+                    for t in series.image_types or [None]
+                }
+            else:
+                reasons.add(reason)
+        return reasons
+
+
+def _in_classes(sop_class_uid: str, classes: ty.Sequence[str]) -> bool:
+    return any(sop_class_uid == c or sop_class_uid.startswith(c + ".") for c in classes)
+
+
+def _image_type(value: ty.Any) -> list[str] | None:
+    if not value:
+        return None
+    if isinstance(value, str):
+        return [value]
+    return [str(t) for t in value]
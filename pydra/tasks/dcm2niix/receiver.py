@@ -0,0 +1,408 @@
+"""Receiving DICOMs over the network and converting each series as it arrives.
+
+A :class:`StorageReceiver` is a DICOM storage SCP (i.e. it accepts C-STORE requests from
+a scanner, PACS or any other SCU) that writes each incoming instance straight into a
+staging directory for its series, from which the series is converted once it has been
+received. Conversions therefore overlap the network transfer of subsequent series, and
+the instances are written to disk once only, rather than being exported in bulk and
+then converted.
+
+A series is handed off to be converted either once the association(s) it was sent over
+have been released ('association' hand-off, suited to senders that send one study or
+series per association) or once it is complete by the same rules as the
+:class:`~pydra.tasks.dcm2niix.watch.SeriesWatcher` ('series' hand-off, i.e. none of its
+instances have arrived for a quiet period). Series sent over associations that are
+aborted remain pending until they are completed by a later association or the quiet
+period elapses. When a series is handed off, the instances received so far are linked
+into a hand-off directory to be converted, while further instances continue to be
+written to its staging directory. Instances arriving for a series after it has been
+handed off cause it to be converted again along with its earlier instances, replacing
+the outputs of the earlier conversion, so the staging directory of a series is only
+removed once a retention period has passed since its last successful conversion. The
+conversions of a series are run one at a time, a series handed off again while it is
+being converted being queued to be converted once that conversion has finished (see
+:class:`~pydra.tasks.dcm2niix.watch.SeriesConversions`).
+
+The receiver requires pynetdicom, which can be installed with the 'scp' extra, i.e.
+``pip install pydra-dcm2niix[scp]``.
+"""
+
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+from pathlib import Path
+import queue
+import re
+import shutil
+import tempfile
+import threading
+import time
+import typing as ty
+import attrs
+import pydicom
+from .construction import TaskTemplate
+from .utils import Dcm2Niix
+from .watch import (
+    ArrivingSeries,
+    SeriesConversions,
+    SeriesResult,
+    SeriesTracker,
+    convert_arrived,
+)
+
+logger = logging.getLogger("pydra.tasks.dcm2niix")
+
+HANDOFF_MODES = ("association", "series")
+
+# DIMSE status codes returned to the sender
+STATUS_SUCCESS = 0x0000
+STATUS_OUT_OF_RESOURCES = 0xA700
+STATUS_CANNOT_UNDERSTAND = 0xC000
+
+
+@attrs.define
+class StorageReceiver:
+    """A DICOM storage SCP that converts each series it receives
+
+    Parameters
+    ----------
+    staging_dir : str or Path
+        the directory to write the received instances to, in a sub-directory per series
+    out_root : str or Path
+        the directory to write the outputs of each series to, in a sub-directory named
+        by its SeriesInstanceUID
+    template : Dcm2Niix
+        the task providing the arguments of the conversions, the 'in_dir' and 'out_dir'
+        of which are ignored
+    ae_title : str
+        the AE title of the receiver
+    address : str
+        the address to listen on, by default all interfaces
+    port : int
+        the port to listen on, or 0 to pick a free port (see :attr:`bound_port`)
+    handoff : str
+        when series are converted, either "association", once the associations they
+        were sent over have been released, or "series", once they are complete
+    quiet_period : float
+        the number of seconds without new instances after which a series is
+        considered complete with the "series" hand-off (or, with the "association"
+        hand-off, a series sent over an aborted association), if its expected number
+        of instances isn't known
+    expected_instances : Callable[[pydicom.Dataset], int | None], optional
+        returns the number of instances expected for a whole series from the header of
+        one of its instances, by default series are only completed by the quiet period
+    max_workers : int, optional
+        the maximum number of concurrent conversions, by default the number of CPUs
+    timeout : float, optional
+        the number of seconds after which a dcm2niix process is killed and its
+        conversion failed
+    metrics_file : str or Path, optional
+        a JSONL file to append the metrics of each conversion to, by default the file
+        set by the 'PYDRA_DCM2NIIX_METRICS' environment variable, if any
+    retain_period : float, optional
+        the number of seconds the instances of a series are kept in the staging
+        directory after it has been successfully converted (and no new instances have
+        arrived for it), so that it can be converted again if late instances arrive.
+        Instances arriving after that are treated as a new series. None keeps them
+        indefinitely
+    """
+
+    staging_dir: Path = attrs.field(converter=Path)
+    out_root: Path = attrs.field(converter=Path)
+    template: Dcm2Niix = attrs.field(factory=Dcm2Niix)
+    ae_title: str = "DCM2NIIX"
+    address: str = ""
+    port: int = 11112
+    handoff: str = attrs.field(
+        default="association", validator=attrs.validators.in_(HANDOFF_MODES)
+    )
+    quiet_period: float = 30.0
+    expected_instances: Callable[[pydicom.Dataset], int | None] | None = None
+    max_workers: int | None = None
+    timeout: float | None = None
+    metrics_file: str | Path | None = None
+    retain_period: float | None = 3600.0
+    _tasks: TaskTemplate = attrs.field(
+        default=attrs.Factory(
+            lambda self: TaskTemplate(self.template), takes_self=True
+        ),
+        init=False,
+        repr=False,
+    )
+    _tracker: SeriesTracker = attrs.field(
+        default=attrs.Factory(
+            lambda self: SeriesTracker(self.quiet_period, self.expected_instances),
+            takes_self=True,
+        ),
+        init=False,
+        repr=False,
+    )
+    # Held while instances are recorded and series are handed off or removed
+    _lock: threading.Lock = attrs.field(factory=threading.Lock, init=False, repr=False)
+    _associations: dict[ty.Any, set[str]] = attrs.field(
+        factory=dict, init=False, repr=False
+    )
+    # The monotonic times of the last successful conversion of each series
+    _converted: dict[str, float] = attrs.field(factory=dict, init=False, repr=False)
+    _results: "queue.Queue[SeriesResult | None]" = attrs.field(
+        factory=queue.Queue, init=False, repr=False
+    )
+    _server: ty.Any = attrs.field(default=None, init=False, repr=False)
+    _pool: ThreadPoolExecutor | None = attrs.field(default=None, init=False, repr=False)
+    _conversions: SeriesConversions | None = attrs.field(
+        default=None, init=False, repr=False
+    )
+    _stopped: threading.Event = attrs.field(
+        factory=threading.Event, init=False, repr=False
+    )
+    _monitor: threading.Thread | None = attrs.field(
+        default=None, init=False, repr=False
+    )
+
+    @property
+    def bound_port(self) -> int:
+        """The port the receiver is listening on, once it has been started"""
+        if self._server is None:
+            raise RuntimeError(f"{self} hasn't been started")
+        return self._server.server_address[1]
+
+    def start(self) -> "StorageReceiver":
+        """Starts listening for associations in a background thread
+
+        Returns
+        -------
+        StorageReceiver
+            the receiver
+
+        Raises
+        ------
+        ImportError
+            if pynetdicom isn't installed
+        """
+        try:
+            from pynetdicom import AE, AllStoragePresentationContexts, evt
+            from pynetdicom.sop_class import Verification
+        except ImportError as e:
+            raise ImportError(
+                "StorageReceiver requires pynetdicom, which can be installed with "
+                "`pip install pydra-dcm2niix[scp]`"
+            ) from e
+        (self.staging_dir / ".incoming").mkdir(parents=True, exist_ok=True)
+        (self.staging_dir / ".handoff").mkdir(exist_ok=True)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers or os.cpu_count())
+        self._conversions = SeriesConversions(
+            self._pool, self._convert, self._on_result
+        )
+        ae = AE(ae_title=self.ae_title)
+        ae.supported_contexts = AllStoragePresentationContexts
+        ae.add_supported_context(Verification)
+        self._server = ae.start_server(
+            (self.address, self.port),
+            block=False,
+            evt_handlers=[
+                (evt.EVT_C_STORE, self._on_store),
+                (evt.EVT_RELEASED, self._on_association_released),
+                (evt.EVT_ABORTED, self._on_association_aborted),
+            ],
+        )
+        self._monitor = threading.Thread(target=self._monitor_series, daemon=True)
+        self._monitor.start()
+        logger.info("Receiving DICOMs as %s on port %s", self.ae_title, self.bound_port)
+        return self
+
+    def stop(self) -> None:
+        """Stops listening, converting the series that have been received but not yet
+        handed off and waiting for all conversions to complete"""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._stopped.set()
+        ty.cast(threading.Thread, self._monitor).join()
+        with self._lock:
+            for series in self._tracker.pending:
+                self._handoff(series.series_uid)
+        ty.cast(ThreadPoolExecutor, self._pool).shutdown(wait=True)
+        if self.retain_period is not None:
+            with self._lock:
+                self._remove_expired(time.monotonic())
+        self._results.put(None)
+        self._server = None
+
+    def __enter__(self) -> "StorageReceiver":
+        return self.start()
+
+    def __exit__(self, *_: ty.Any) -> None:
+        self.stop()
+
+    def results(self, timeout: float | None = None) -> Iterator[SeriesResult]:
+        """Yields the result of the conversion of each series as it completes, until
+        the receiver is stopped
+
+        Parameters
+        ----------
+        timeout : float, optional
+            the maximum number of seconds to wait for each result
+
+        Yields
+        ------
+        SeriesResult
+            the result of each conversion
+
+        Raises
+        ------
+        TimeoutError
+            if no result is available within the timeout
+        """
+        while True:
+            try:
+                result = self._results.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError(
+                    f"No series were converted within {timeout} seconds"
+                ) from None
+            if result is None:
+                # Leave the sentinel for any other consumers
+                self._results.put(None)
+                return
+            yield result
+
+    def _on_store(self, event: ty.Any) -> int:
+        try:
+            header = event.dataset
+            series_uid = str(header.SeriesInstanceUID)
+            sop_uid = str(header.SOPInstanceUID)
+        except Exception as e:
+            logger.warning("Could not read the dataset sent by %s: %s", event.assoc, e)
+            return STATUS_CANNOT_UNDERSTAND
+        try:
+            # Write the instance (as received, without decoding it) to a file of its
+            # own outside of the lock, so that instances sent over concurrent
+            # associations are written concurrently, then move it into place
+            fd, tmp_name = tempfile.mkstemp(
+                suffix=".dcm", dir=self.staging_dir / ".incoming"
+            )
+        except OSError as e:
+            logger.warning("Could not store instance %s: %s", sop_uid, e)
+            return STATUS_OUT_OF_RESOURCES
+        try:
+            with open(fd, "wb") as f:
+                f.write(event.encoded_dataset(include_meta=True))
+            with self._lock:
+                series_dir = self.staging_dir / _safe_name(series_uid)
+                series_dir.mkdir(exist_ok=True)
+                path = series_dir / (_safe_name(sop_uid) + ".dcm")
+                os.replace(tmp_name, path)
+                self._tracker.record(header, path)
+                self._associations.setdefault(event.assoc, set()).add(series_uid)
+        except OSError as e:
+            logger.warning("Could not store instance %s: %s", sop_uid, e)
+            Path(tmp_name).unlink(missing_ok=True)
+            return STATUS_OUT_OF_RESOURCES
+        return STATUS_SUCCESS
+
+    def _on_association_released(self, event: ty.Any) -> None:
+        with self._lock:
+            series_uids = self._associations.pop(event.assoc, set())
+            if self.handoff != "association":
+                return
+            # Series that are still being sent over other associations are handed off
+            # once those have ended
+            still_sending = set().union(*self._associations.values())
+            pending = {s.series_uid for s in self._tracker.pending}
+            for series_uid in sorted(series_uids & pending - still_sending):
+                self._handoff(series_uid)
+
+    def _on_association_aborted(self, event: ty.Any) -> None:
+        # The series sent over an aborted association may be incomplete, so they are
+        # left pending until they are completed or time out
+        with self._lock:
+            series_uids = self._associations.pop(event.assoc, set())
+        if series_uids:
+            logger.warning(
+                "Association %s was aborted while sending series %s",
+                event.assoc,
+                ", ".join(sorted(series_uids)),
+            )
+
+    def _monitor_series(self) -> None:
+        interval = min(1.0, self.quiet_period / 2)
+        while not self._stopped.wait(interval):
+            with self._lock:
+                now = time.monotonic()
+                if self.handoff == "series":
+                    for series in self._tracker.complete(now):
+                        self._handoff(series.series_uid, taken=series)
+                else:
+                    # Series left pending by aborted associations time out
+                    still_sending = set().union(*self._associations.values())
+                    for series in self._tracker.pending:
+                        if (
+                            series.series_uid not in still_sending
+                            and now - series.last_arrival >= self.quiet_period
+                        ):
+                            self._handoff(series.series_uid)
+                if self.retain_period is not None:
+                    self._remove_expired(now)
+
+    def _remove_expired(self, now: float) -> None:
+        """Removes the staged instances of the series that were converted more than
+        the retention period ago, which must be called while holding the lock"""
+        pending = {s.series_uid for s in self._tracker.pending}
+        for series_uid, converted in list(self._converted.items()):
+            series = self._tracker.series[series_uid]
+            if (
+                series_uid in pending
+                or ty.cast(SeriesConversions, self._conversions).busy(series_uid)
+                or now - max(converted, series.last_arrival)
+                < ty.cast(float, self.retain_period)
+            ):
+                continue
+            shutil.rmtree(self.staging_dir / _safe_name(series_uid), ignore_errors=True)
+            self._tracker.forget(series_uid)
+            del self._converted[series_uid]
+
+    def _handoff(self, series_uid: str, taken: ArrivingSeries | None = None) -> None:
+        """Submits the conversion of the instances of a series received so far, which
+        must be called while holding the lock"""
+        series = taken if taken is not None else self._tracker.take(series_uid)
+        # Copy the instances, which may be added to while the series is converted
+        handed_off = attrs.evolve(series, instances=dict(series.instances))
+        ty.cast(SeriesConversions, self._conversions).submit(handed_off)
+
+    def _convert(self, series: ArrivingSeries) -> SeriesResult:
+        in_dir = None
+        try:
+            in_dir = Path(
+                tempfile.mkdtemp(
+                    prefix=_safe_name(series.series_uid) + ".",
+                    dir=self.staging_dir / ".handoff",
+                )
+            )
+            for path in series.paths:
+                (in_dir / path.name).symlink_to(path)
+            result = convert_arrived(
+                series,
+                self._tasks.task(in_dir, self.out_root / series.series_uid),
+                timeout=self.timeout,
+                metrics_file=self.metrics_file,
+            )
+        except Exception as e:
+            # e.g. the received instances can't be used as the input of a task
+            logger.warning("Failed to convert series %s: %s", series.series_uid, e)
+            result = SeriesResult(series, error=e)
+        # The links of failed conversions are kept to be inspected
+        if result.ok and in_dir is not None:
+            shutil.rmtree(in_dir, ignore_errors=True)
+        return result
+
+    def _on_result(self, result: SeriesResult) -> None:
+        if result.ok:
+            with self._lock:
+                self._converted[result.series.series_uid] = time.monotonic()
+        self._results.put(result)
+
+
+def _safe_name(uid: str) -> str:
+    """Replaces any characters of a UID that aren't valid in filenames"""
+    return re.sub(r"[^\w.-]", "_", uid)
@@ -0,0 +1,249 @@
+"""Extracting the BIDS sidecars of large numbers of DICOM directories without writing
+images.
+
+With 'bids' set to 'o', dcm2niix writes only the JSON sidecar of each series, which makes
+it the cheapest way to catalogue the metadata of a large archive. As most of the cost
+of cataloguing many small directories one at a time is starting a dcm2niix process for
+each of them, a :class:`SidecarExtractor` instead links a batch of input directories
+into a scratch directory and converts them all in a single dcm2niix invocation, with
+the search depth raised by one to reach into the links. The sidecars are parsed and
+returned per batch, and the scratch directory is then removed, so that nothing is
+written to the input or output directories.
+
+NB: the series of a batch are converted together, so their sidecars can't be
+attributed to the input directory they were converted from, only to the batch. Where
+this is required, the identifying fields of the sidecars (e.g. 'SeriesInstanceUID',
+which dcm2niix only writes if 'anonymize_bids' is 'n', as it is by default here) can be
+used, or the batch size set to 1.
+"""
+
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import itertools
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import time
+import typing as ty
+import attrs
+from .construction import TaskTemplate
+from .dicom import DEFAULT_SEARCH_DEPTH
+from .metrics import RunMetrics, record_metrics, run_process
+from .staging import default_scratch_root
+from .utils import Dcm2Niix
+
+logger = logging.getLogger("pydra.tasks.dcm2niix")
+
+
+@attrs.define
+class SidecarBatch:
+    """The sidecars extracted from a batch of input directories
+
+    Parameters
+    ----------
+    in_dirs : list[Path]
+        the input directories of the batch
+    sidecars : dict[str, dict[str, Any]]
+        the parsed sidecar of each image, keyed by the name dcm2niix gave it (i.e. the
+        expanded filename template)
+    error : Exception or None
+        the error raised by the extraction, if it failed (including
+        subprocess.TimeoutExpired if it timed out)
+    duration : float
+        the wall time the batch took in seconds
+    metrics : RunMetrics, optional
+        the timings and resource usage of the batch
+    """
+
+    in_dirs: list[Path]
+    sidecars: dict[str, dict[str, ty.Any]] = attrs.field(factory=dict)
+    error: Exception | None = None
+    duration: float = 0.0
+    metrics: RunMetrics | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@attrs.define
+class SidecarExtractor:
+    """Extracts the BIDS sidecars of DICOM directories in batches, running dcm2niix
+    once per batch in metadata-only mode
+
+    Parameters
+    ----------
+    template : Dcm2Niix
+        the task providing the arguments of the conversions, the 'in_dir', 'out_dir'
+        and 'bids' of which are ignored. Its 'search_depth' is the depth to search
+        within each input directory
+    batch_size : int
+        the number of input directories converted per dcm2niix invocation
+    max_workers : int, optional
+        the maximum number of concurrent dcm2niix processes, by default the number of
+        CPUs
+    timeout : float, optional
+        the number of seconds after which a dcm2niix process is killed and its batch
+        failed
+    scratch_dir : str or Path, optional
+        the directory to create the batch directories in, by default the directory set
+        by the 'PYDRA_DCM2NIIX_SCRATCH' environment variable or $TMPDIR
+    metrics_file : str or Path, optional
+        a JSONL file to append the metrics of each batch to, by default the file set
+        by the 'PYDRA_DCM2NIIX_METRICS' environment variable, if any
+    """
+
+    template: Dcm2Niix = attrs.field(
+        factory=lambda: Dcm2Niix(filename="%j", anonymize_bids="n")
+    )
+    batch_size: int = 256
+    max_workers: int | None = None
+    timeout: float | None = None
+    scratch_dir: Path | None = attrs.field(
+        default=None, converter=lambda p: Path(p) if p is not None else None
+    )
+    metrics_file: str | Path | None = None
+    _tasks: TaskTemplate = attrs.field(
+        default=attrs.Factory(
+            lambda self: TaskTemplate(self.template), takes_self=True
+        ),
+        init=False,
+        repr=False,
+    )
+
+    def extract(self, in_dirs: Iterable[str | Path]) -> Iterator[SidecarBatch]:
+        """Extracts the sidecars of the input directories, yielding the results of
+        each batch in the order they complete
+
+        Input directories are drawn from the iterable lazily, so that it can be a
+        generator over a very large number of directories.
+
+        Parameters
+        ----------
+        in_dirs : iterable[str or Path]
+            the directories containing the DICOMs
+
+        Yields
+        ------
+        SidecarBatch
+            the sidecars of each batch
+        """
+        max_workers = self.max_workers or os.cpu_count() or 1
+        dirs = (Path(d).absolute() for d in in_dirs)
+        batches = iter(lambda: list(itertools.islice(dirs, self.batch_size)), [])
+        pending: dict[Future[SidecarBatch], list[Path]] = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for batch in batches:
+                if len(pending) >= 2 * max_workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        del pending[future]
+                        yield future.result()
+                pending[pool.submit(self._run_batch, batch)] = batch
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del pending[future]
+                    yield future.result()
+
+    def _run_batch(self, in_dirs: list[Path]) -> SidecarBatch:
+        start = time.monotonic()
+        metrics = RunMetrics(in_dir=str(in_dirs[0]))
+        sidecars: dict[str, dict[str, ty.Any]] = {}
+        error = None
+        root = self.scratch_dir
+        if root is None:
+            root = default_scratch_root()
+        root.mkdir(parents=True, exist_ok=True)
+        work_dir = Path(tempfile.mkdtemp(prefix="dcm2niix-sidecars-", dir=root))
+        try:
+            with metrics.phase("command"):
+                search_depth = self.template.search_depth
+                if search_depth is None:
+                    search_depth = DEFAULT_SEARCH_DEPTH
+                # The first input directory is used to render the command-line
+                # template, which is reused for all batches
+                command = self._tasks.command(
+                    in_dirs[0], bids="o", search_depth=search_depth + 1
+                )
+                in_dir = work_dir / "in"
+                out_dir = work_dir / "out"
+                out_dir.mkdir()
+                link_dirs(in_dir, in_dirs)
+                argv = command.render(in_dir, out_dir)
+            with metrics.phase("dcm2niix"):
+                return_code, _, stderr, metrics.child = run_process(
+                    argv, timeout=self.timeout
+                )
+            if return_code:
+                raise RuntimeError(
+                    f"dcm2niix exited with return code {return_code} extracting the "
+                    f"sidecars of {len(in_dirs)} directories from {in_dirs[0]}:\n"
+                    + stderr.decode(errors="replace")
+                )
+            with metrics.phase("collect"):
+                sidecars = read_sidecars(out_dir)
+        except Exception as e:
+            logger.warning("Failed to extract sidecars from %s: %s", in_dirs[0], e)
+            metrics.error = f"{type(e).__name__}: {e}"
+            error = e
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        record_metrics(metrics, self.metrics_file)
+        return SidecarBatch(
+            in_dirs,
+            sidecars=sidecars,
+            error=error,
+            duration=time.monotonic() - start,
+            metrics=metrics,
+        )
+
+
+def link_dirs(batch_dir: Path, in_dirs: ty.Sequence[Path]) -> list[Path]:
+    """Links input directories into a batch directory under numbered names, so that
+    they can be converted by a single dcm2niix invocation
+
+    Parameters
+    ----------
+    batch_dir : Path
+        the directory to create the links in, which is created if required
+    in_dirs : sequence[Path]
+        the input directories to link
+
+    Returns
+    -------
+    list[Path]
+        the links, in the same order as the input directories
+    """
+    batch_dir.mkdir(parents=True, exist_ok=True)
+    width = len(str(len(in_dirs) - 1))
+    links = []
+    for i, in_dir in enumerate(in_dirs):
+        link = batch_dir / f"{i:0{width}d}"
+        link.symlink_to(Path(in_dir).absolute(), target_is_directory=True)
+        links.append(link)
+    return links
+
+
+def read_sidecars(out_dir: Path) -> dict[str, dict[str, ty.Any]]:
+    """Parses the sidecars written by dcm2niix into an output directory
+
+    Parameters
+    ----------
+    out_dir : Path
+        the output directory
+
+    Returns
+    -------
+    dict[str, dict[str, Any]]
+        the parsed sidecars keyed by their names relative to the output directory,
+        without the '.json' extension
+    """
+    sidecars = {}
+    for path in sorted(out_dir.rglob("*.json")):
+        name = path.relative_to(out_dir).as_posix()[: -len(".json")]
+        sidecars[name] = json.loads(path.read_text())
+    return sidecars
@@ -0,0 +1,347 @@
+"""Staging conversions on node-local scratch space.
+
+dcm2niix reads many small DICOM files and writes each NIfTI image and its sidecars in
+many small, scattered writes, both of which perform badly on network file-systems such
+as NFS or Lustre, and a job that is killed part-way through leaves partially written
+files in its output directory. With a :class:`Staging`, the input directory is copied
+to local scratch in parallel if it is on a network file-system (otherwise dcm2niix
+reads it in place), dcm2niix writes its outputs to local scratch, and only once the
+conversion has finished are the outputs committed to the output directory.
+
+The outputs are committed by first copying them into a hidden directory within the
+output directory (which is on the same file-system), then renaming them into place one
+at a time, resolving clashing names in the same way as dcm2niix. The commit is atomic
+per file, not for the conversion as a whole (the output directory can hold the outputs
+of other conversions, so can't be swapped in with a single rename): each file in the
+output directory is only ever complete, but a job killed part-way through the renames
+leaves some of its outputs in place. Otherwise a killed job leaves nothing behind but a
+hidden '.dcm2niix-*' directory, which is removed by the next staged conversion into the
+same output directory once it is older than the 'stale_age' of the :class:`Staging`.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import time
+import attrs
+from .outputs import merge_outputs
+
+logger = logging.getLogger("pydra.tasks.dcm2niix")
+
+SCRATCH_ENV_VAR = "PYDRA_DCM2NIIX_SCRATCH"
+
+# Prefix of the hidden directories outputs are staged in within the output directory
+HIDDEN_PREFIX = ".dcm2niix-"
+
+# File-system types (as listed in /proc/mounts) that are accessed over the network
+NETWORK_FS_TYPES = (
+    "nfs",
+    "nfs4",
+    "lustre",
+    "gpfs",
+    "beegfs",
+    "cifs",
+    "smb3",
+    "smbfs",
+    "ceph",
+    "glusterfs",
+    "panfs",
+    "fuse.glusterfs",
+    "fuse.sshfs",
+    "fuse.s3fs",
+)
+
+
+def default_scratch_root() -> Path:
+    """Returns the node-local scratch directory, which can be set by the
+    'PYDRA_DCM2NIIX_SCRATCH' environment variable, otherwise is the default temporary
+    directory (i.e. $TMPDIR)"""
+    try:
+        return Path(os.environ[SCRATCH_ENV_VAR])
+    except KeyError:
+        return Path(tempfile.gettempdir())
+
+
+def filesystem_type(path: str | Path) -> str | None:
+    """Returns the type of the file-system a path is on, as listed in /proc/mounts
+
+    Parameters
+    ----------
+    path : str or Path
+        the path to look up
+
+    Returns
+    -------
+    str or None
+        the file-system type, or None if it can't be determined (e.g. not on Linux)
+    """
+    mount = find_mount(path)
+    return mount[1] if mount is not None else None
+
+
+def find_mount(path: str | Path) -> tuple[str, str, str] | None:
+    """Finds the mount that a path is on in /proc/self/mountinfo
+
+    Parameters
+    ----------
+    path : str or Path
+        the path to look up
+
+    Returns
+    -------
+    tuple[str, str, str] or None
+        the mount point, file-system type and source (e.g. device or export) of the
+        mount, or None if it can't be determined (e.g. not on Linux)
+    """
+    path = os.path.realpath(path)
+    try:
+        with open("/proc/self/mountinfo") as f:
+            mounts = f.read().splitlines()
+    except OSError:
+        return None
+    found = None
+    longest = -1
+    for mount in mounts:
+        # The optional fields before the file-system type are terminated by '-'
+        fields, _, fs_fields = mount.partition(" - ")
+        fields = fields.split()
+        fs_fields = fs_fields.split()
+        if len(fields) < 5 or len(fs_fields) < 2:
+            continue
+        # Spaces etc. are escaped as octal in the mount points
+        mount_point = fields[4].encode().decode("unicode_escape")
+        within = path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+        # Later mounts over the same mount point hide earlier ones
+        if within and len(mount_point) >= longest:
+            found = (mount_point, fs_fields[0], fs_fields[1])
+            longest = len(mount_point)
+    return found
+
+
+def is_network_fs(path: str | Path) -> bool:
+    """Whether a path is on a network file-system"""
+    return filesystem_type(path) in NETWORK_FS_TYPES
+
+
+def remove_stale_dirs(out_dir: str | Path, max_age: float) -> list[Path]:
+    """Removes the hidden '.dcm2niix-*' directories left in an output directory by
+    killed jobs, which haven't been modified for longer than 'max_age'
+
+    Parameters
+    ----------
+    out_dir : str or Path
+        the output directory
+    max_age : float
+        the number of seconds since a hidden directory was last modified after which
+        it is assumed to have been abandoned
+
+    Returns
+    -------
+    list[Path]
+        the removed directories
+    """
+    removed = []
+    cutoff = time.time() - max_age
+    try:
+        entries = list(os.scandir(out_dir))
+    except FileNotFoundError:
+        return removed
+    for entry in entries:
+        if not entry.name.startswith(HIDDEN_PREFIX):
+            continue
+        try:
+            if (
+                not entry.is_dir(follow_symlinks=False)
+                or entry.stat().st_mtime > cutoff
+            ):
+                continue
+        except FileNotFoundError:
+            continue  # Removed by another process
+        shutil.rmtree(entry.path, ignore_errors=True)
+        logger.info("Removed stale staging directory %s", entry.path)
+        removed.append(Path(entry.path))
+    return removed
+
+
+@attrs.define
+class StagedConversion:
+    """The scratch directories of a staged conversion
+
+    Parameters
+    ----------
+    work_dir : Path
+        the scratch directory holding the staged input and outputs
+    in_dir : Path
+        the directory for dcm2niix to read, either the staged copy of the input or the
+        input directory itself
+    out_dir : Path
+        the scratch directory for dcm2niix to write to
+    max_workers : int
+        the number of files to copy at a time
+    stale_age : float, optional
+        the age in seconds beyond which hidden '.dcm2niix-*' directories left in the
+        output directory by killed jobs are removed on commit, never if None
+    """
+
+    work_dir: Path
+    in_dir: Path
+    out_dir: Path
+    max_workers: int = 8
+    stale_age: float | None = 86400.0
+
+    def commit(
+        self, names: list[str], out_dir: Path, name_conflicts: int | None = None
+    ) -> list[str]:
+        """Moves the outputs of the conversion into the output directory, one file at
+        a time (see the module docstring)
+
+        Parameters
+        ----------
+        names : list[str]
+            the names of the outputs relative to the scratch output directory
+        out_dir : Path
+            the output directory to commit them to
+        name_conflicts : int, optional
+            how to resolve names that clash with existing files, following dcm2niix's
+            '-w' option
+
+        Returns
+        -------
+        list[str]
+            the names of the committed files in the output directory
+        """
+        out_dir.mkdir(parents=True, exist_ok=True)
+        if self.stale_age is not None:
+            remove_stale_dirs(out_dir, self.stale_age)
+        if os.stat(out_dir).st_dev == os.stat(self.out_dir).st_dev:
+            return merge_outputs([(self.out_dir, names)], out_dir, name_conflicts)
+        commit_dir = Path(tempfile.mkdtemp(prefix=HIDDEN_PREFIX, dir=out_dir))
+        try:
+            _copy_files(
+                [(self.out_dir / n, commit_dir / n) for n in names],
+                self.max_workers,
+                fsync=True,
+            )
+            return merge_outputs([(commit_dir, names)], out_dir, name_conflicts)
+        finally:
+            shutil.rmtree(commit_dir, ignore_errors=True)
+
+    def cleanup(self) -> None:
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+@attrs.define
+class Staging:
+    """Runs conversions on node-local scratch space, committing their outputs to the
+    output directory once they have finished
+
+    Parameters
+    ----------
+    root : Path, optional
+        the scratch directory to stage conversions in, by default the directory set by
+        the 'PYDRA_DCM2NIIX_SCRATCH' environment variable or $TMPDIR
+    copy_input : bool, optional
+        whether to copy the input directory to scratch, by default only if it is on a
+        network file-system
+    max_workers : int
+        the number of files to copy at a time
+    stale_age : float, optional
+        the age in seconds beyond which hidden '.dcm2niix-*' directories left in the
+        output directory by killed jobs are removed on commit (1 day by default), never
+        if None
+    """
+
+    root: Path | None = attrs.field(
+        default=None, converter=lambda p: Path(p) if p is not None else None
+    )
+    copy_input: bool | None = None
+    max_workers: int = 8
+    stale_age: float | None = 86400.0
+
+    def stage(
+        self, in_dir: str | Path, search_depth: int | None = None
+    ) -> StagedConversion:
+        """Creates the scratch directories of a conversion, copying the input
+        directory into them if required
+
+        Parameters
+        ----------
+        in_dir : str or Path
+            the input directory of the conversion
+        search_depth : int, optional
+            the depth of sub-directories dcm2niix searches for DICOMs in, beyond which
+            files aren't copied (5 by default, as in dcm2niix)
+
+        Returns
+        -------
+        StagedConversion
+            the scratch directories, which should be cleaned up once the conversion's
+            outputs have been committed
+        """
+        in_dir = Path(in_dir).absolute()
+        root = self.root if self.root is not None else default_scratch_root()
+        root.mkdir(parents=True, exist_ok=True)
+        work_dir = Path(tempfile.mkdtemp(prefix="dcm2niix-stage-", dir=root))
+        staged = StagedConversion(
+            work_dir=work_dir,
+            in_dir=in_dir,
+            out_dir=work_dir / "out",
+            max_workers=self.max_workers,
+            stale_age=self.stale_age,
+        )
+        staged.out_dir.mkdir()
+        copy_input = self.copy_input
+        if copy_input is None:
+            copy_input = is_network_fs(in_dir)
+        if copy_input:
+            if search_depth is None:
+                search_depth = 5
+            staged.in_dir = work_dir / "in" / in_dir.name
+            try:
+                _copy_files(
+                    [
+                        (p, staged.in_dir / p.relative_to(in_dir))
+                        for p in _walk_files(in_dir, search_depth)
+                    ],
+                    self.max_workers,
+                )
+            except BaseException:
+                staged.cleanup()
+                raise
+            logger.debug("Staged %s in %s", in_dir, staged.in_dir)
+        return staged
+
+
+def _walk_files(directory: Path, depth: int) -> list[Path]:
+    """Lists the files in a directory and its sub-directories down to 'depth'"""
+    paths = []
+    # Follow symlinked directories, as dcm2niix does, which can't recurse indefinitely
+    # through a link cycle as the walk stops at 'depth'
+    for dirpath, dirnames, filenames in os.walk(directory, followlinks=True):
+        if len(Path(dirpath).relative_to(directory).parts) >= depth:
+            dirnames.clear()
+        paths.extend(Path(dirpath) / f for f in filenames)
+    return paths
+
+
+def _copy_files(
+    pairs: list[tuple[Path, Path]], max_workers: int, fsync: bool = False
+) -> None:
+    """Copies files concurrently, as the latency of each copy on a network
+    file-system, rather than the bandwidth, is usually the limiting factor"""
+
+    def copy(src: Path, dest: Path) -> None:
+        shutil.copyfile(src, dest)
+        if fsync:
+            with open(dest, "rb+") as f:
+                os.fsync(f.fileno())
+
+    for parent in {dest.parent for _, dest in pairs}:
+        parent.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # Iterate over the results to raise any errors
+        for _ in pool.map(lambda pair: copy(*pair), pairs):
+            pass
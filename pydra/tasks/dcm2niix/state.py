@@ -0,0 +1,403 @@
+"""Incremental conversion of growing DICOM archives with a persistent state database.
+
+dcm2niix's own up-to-date check ('up_to_date_check', '-u') only skips series whose
+outputs already exist by name, and nothing on the Python side remembers what was
+converted, so re-sweeping an archive converts it in full. A :class:`ConversionState`
+instead records in SQLite, for each series converted into an output directory, a
+fingerprint of its input files (their paths, sizes and modification times), the version
+of dcm2niix, a digest of the arguments of the conversion and the names of the files it
+produced. :func:`convert_incremental` catalogues the input directory by series (see
+:mod:`pydra.tasks.dcm2niix.catalog`), converts only the series that are new or whose
+fingerprint, dcm2niix version or arguments have changed (or whose outputs have since
+been removed), each in a separate dcm2niix process, and returns the outputs of the
+other series from the store.
+
+Concurrent incremental conversions into the same output directory (from threads or
+processes sharing the state database) are serialised by a lock file per output
+directory, held from looking up the recorded conversions until the new ones are
+recorded, so that a series is never converted into the directory twice at once.
+
+NB: as series are converted separately, names that clash between series (e.g. a
+literal 'filename') are disambiguated in the order the series are converted, so a
+filename template that is unique per series (e.g. '%p_%s') is recommended.
+"""
+
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import sqlite3
+import tempfile
+import time
+import typing as ty
+import attrs
+from .cache import conversion_args
+from .catalog import DicomCatalog, load_catalog
+from .convert import ConversionRun, run
+from .outputs import OutputIndex, merge_outputs
+from .parallel import link_series
+from .utils import Dcm2Niix, cache_root, collect_outputs, dcm2niix_version
+
+logger = logging.getLogger("pydra.tasks.dcm2niix")
+
+STATE_FILENAME = "conversion-state.sqlite"
+
+
+@attrs.define
+class SeriesState:
+    """The recorded conversion of a series into an output directory
+
+    Parameters
+    ----------
+    series_uid : str
+        the instance UID of the series
+    fingerprint : str
+        the digest of the paths, sizes and modification times of its input files
+    version : str
+        the version of dcm2niix that converted it
+    args : str
+        the digest of the arguments it was converted with
+    names : list[str]
+        the files produced, relative to the output directory
+    converted : float
+        the time it was converted, in seconds since the epoch
+    """
+
+    series_uid: str
+    fingerprint: str
+    version: str
+    args: str
+    names: list[str] = attrs.field(factory=list)
+    converted: float = 0.0
+
+
+@attrs.define
+class IncrementalResult:
+    """The result of an incremental conversion
+
+    Parameters
+    ----------
+    outputs : Dcm2Niix.Outputs
+        the outputs of all the series in the input directory
+    converted : list[str]
+        the UIDs of the series that were converted by this run
+    up_to_date : list[str]
+        the UIDs of the series whose outputs were returned from the store
+    runs : list[ConversionRun]
+        the runs of dcm2niix, one per converted series
+    """
+
+    outputs: Dcm2Niix.Outputs
+    converted: list[str] = attrs.field(factory=list)
+    up_to_date: list[str] = attrs.field(factory=list)
+    runs: list[ConversionRun] = attrs.field(factory=list, repr=False)
+
+
+class ConversionState:
+    """Persistent record of the series converted into each output directory, which can
+    be shared between concurrent processes, with a lock per output directory to
+    serialise the conversions into it (see :meth:`lock`)
+
+    Parameters
+    ----------
+    path : str or Path, optional
+        path to the SQLite database, by default 'conversion-state.sqlite' within the
+        package's cache root (see :func:`~pydra.tasks.dcm2niix.utils.cache_root`)
+    """
+
+    def __init__(self, path: str | Path | None = None):
+        if path is None:
+            path = cache_root() / STATE_FILENAME
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS series ("
+                "out_dir TEXT, series_uid TEXT, fingerprint TEXT, version TEXT, "
+                "args TEXT, names TEXT, converted REAL, "
+                "PRIMARY KEY (out_dir, series_uid))"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=60)
+
+    @property
+    def locks_dir(self) -> Path:
+        return self.path.with_name(self.path.name + ".locks")
+
+    @contextlib.contextmanager
+    def lock(self, out_dir: str | Path) -> Iterator[None]:
+        """Holds an exclusive lock on the conversions into an output directory, which
+        blocks other threads and processes locking the same directory in the same
+        database until it is released
+
+        Parameters
+        ----------
+        out_dir : str or Path
+            the output directory to lock
+        """
+        import fcntl
+
+        key = hashlib.sha256(str(Path(out_dir).absolute()).encode()).hexdigest()
+        self.locks_dir.mkdir(parents=True, exist_ok=True)
+        # flock locks belong to the open file, so separate opens of the lock file
+        # exclude each other within a process as well as between processes
+        with open(self.locks_dir / (key + ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def lookup(self, out_dir: str | Path) -> dict[str, SeriesState]:
+        """Returns the recorded conversions of the series in an output directory
+
+        Parameters
+        ----------
+        out_dir : str or Path
+            the output directory
+
+        Returns
+        -------
+        dict[str, SeriesState]
+            the recorded conversions keyed by series UID
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT series_uid, fingerprint, version, args, names, converted "
+                "FROM series WHERE out_dir = ?",
+                (str(Path(out_dir).absolute()),),
+            ).fetchall()
+        return {
+            uid: SeriesState(uid, fingerprint, version, args, json.loads(names), ts)
+            for uid, fingerprint, version, args, names, ts in rows
+        }
+
+    def record(self, out_dir: str | Path, states: ty.Iterable[SeriesState]) -> None:
+        """Records the conversions of series into an output directory, replacing any
+        previously recorded conversions of them
+
+        Parameters
+        ----------
+        out_dir : str or Path
+            the output directory
+        states : iterable[SeriesState]
+            the conversions to record
+        """
+        out_dir = str(Path(out_dir).absolute())
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        out_dir,
+                        s.series_uid,
+                        s.fingerprint,
+                        s.version,
+                        s.args,
+                        json.dumps(s.names),
+                        s.converted,
+                    )
+                    for s in states
+                ),
+            )
+
+    def forget(self, out_dir: str | Path, series_uids: ty.Iterable[str]) -> None:
+        """Removes the recorded conversions of series, so they are converted again
+
+        Parameters
+        ----------
+        out_dir : str or Path
+            the output directory
+        series_uids : iterable[str]
+            the UIDs of the series to forget
+        """
+        out_dir = str(Path(out_dir).absolute())
+        with self._connect() as conn:
+            conn.executemany(
+                "DELETE FROM series WHERE out_dir = ? AND series_uid = ?",
+                ((out_dir, uid) for uid in series_uids),
+            )
+
+
+def series_fingerprint(catalog: DicomCatalog, series_uid: str) -> str:
+    """Digests the paths, sizes and modification times of the files of a series
+
+    Parameters
+    ----------
+    catalog : DicomCatalog
+        the catalog of the directory containing the series
+    series_uid : str
+        the instance UID of the series
+
+    Returns
+    -------
+    str
+        the hex digest of the files of the series
+    """
+    h = hashlib.sha256()
+    for relpath in sorted(catalog.series[series_uid].files):
+        st = (catalog.root / relpath).stat()
+        h.update(f"{relpath}:{st.st_size}:{st.st_mtime_ns}\0".encode())
+    return h.hexdigest()
+
+
+def args_digest(task: Dcm2Niix) -> str:
+    """Digests the arguments of a task that affect the content or names of its outputs"""
+    return hashlib.sha256(
+        json.dumps(conversion_args(task), sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def convert_incremental(
+    task: Dcm2Niix,
+    state: ConversionState | None = None,
+    max_workers: int | None = None,
+    timeout: float | None = None,
+) -> IncrementalResult:
+    """Converts the series in the input directory of a task that are new or have
+    changed since they were last converted into its output directory, returning the
+    outputs of the other series from the state database
+
+    Parameters
+    ----------
+    task : Dcm2Niix
+        the task to run, which must have 'out_dir' set
+    state : ConversionState, optional
+        the state database, by default the one in the package's cache root
+    max_workers : int, optional
+        the maximum number of concurrent dcm2niix processes, by default the number of
+        CPUs
+    timeout : float, optional
+        the number of seconds after which to kill a dcm2niix process
+
+    Returns
+    -------
+    IncrementalResult
+        the outputs of all series, and which of them were converted
+
+    Raises
+    ------
+    ValueError
+        if the 'out_dir' of the task isn't set
+    Exception
+        the first error raised by a series conversion, after the conversions that
+        succeeded have been recorded
+    """
+    if task.out_dir is None:
+        raise ValueError(f"'out_dir' needs to be set to run {task} outside of pydra")
+    if state is None:
+        state = ConversionState()
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    out_dir = Path(task.out_dir).absolute()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    catalog = load_catalog(task.in_dir, task.search_depth)
+    version = dcm2niix_version(task.executable)
+    args = args_digest(task)
+    # Held until the conversions have been recorded, so that concurrent runs don't
+    # both convert a series they each find missing from the state
+    with state.lock(out_dir):
+        recorded = state.lookup(out_dir)
+        result = IncrementalResult(outputs=None)  # type: ignore[arg-type]
+        fingerprints = {}
+        names: list[str] = []
+        for series_uid in catalog.series:
+            fingerprints[series_uid] = fingerprint = series_fingerprint(
+                catalog, series_uid
+            )
+            previous = recorded.get(series_uid)
+            if (
+                previous is not None
+                and (previous.fingerprint, previous.version, previous.args)
+                == (fingerprint, version, args)
+                and all((out_dir / n).exists() for n in previous.names)
+            ):
+                result.up_to_date.append(series_uid)
+                names.extend(previous.names)
+                continue
+            result.converted.append(series_uid)
+        logger.info(
+            "Converting %s new or changed series of %s (%s up to date)",
+            len(result.converted),
+            task.in_dir,
+            len(result.up_to_date),
+        )
+        errors = []
+        if result.converted:
+            # Stage the outputs within the output directory so they can be moved into
+            # place, but create the links to the series on local scratch
+            staging_dir = Path(tempfile.mkdtemp(prefix=".dcm2niix-", dir=out_dir))
+            farm_dir = Path(tempfile.mkdtemp(prefix="dcm2niix-series-"))
+            try:
+
+                def convert_series(i: int, series_uid: str) -> ConversionRun:
+                    return run(
+                        attrs.evolve(
+                            task,
+                            in_dir=link_series(
+                                catalog.paths(series_uid), farm_dir / str(i)
+                            ),
+                            out_dir=staging_dir / str(i),
+                            search_depth=0,
+                        ),
+                        timeout=timeout,
+                    )
+
+                with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                    futures = [
+                        pool.submit(convert_series, i, uid)
+                        for i, uid in enumerate(result.converted)
+                    ]
+                converted = []
+                for series_uid, future in zip(list(result.converted), futures):
+                    try:
+                        series_run = future.result()
+                    except Exception as e:
+                        logger.warning("Failed to convert series %s: %s", series_uid, e)
+                        errors.append(e)
+                        result.converted.remove(series_uid)
+                        continue
+                    result.runs.append(series_run)
+                    previous = recorded.get(series_uid)
+                    if previous is not None:
+                        # Remove the outputs of the previous conversion only now that the
+                        # series has been reconverted, so that they are replaced rather
+                        # than disambiguated from
+                        for name in previous.names:
+                            (out_dir / name).unlink(missing_ok=True)
+                    series_names = merge_outputs(
+                        [(series_run.index.out_dir, series_run.names)],
+                        out_dir,
+                        task.name_conflicts,
+                    )
+                    names.extend(series_names)
+                    converted.append(
+                        SeriesState(
+                            series_uid,
+                            fingerprints[series_uid],
+                            version,
+                            args,
+                            series_names,
+                            time.time(),
+                        )
+                    )
+                state.record(out_dir, converted)
+            finally:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+                shutil.rmtree(farm_dir, ignore_errors=True)
+    if errors:
+        raise errors[0]
+    result.outputs = collect_outputs(
+        task,
+        OutputIndex(out_dir, names),
+        stdout="".join(r.stdout for r in result.runs),
+        stderr="".join(r.stderr for r in result.runs),
+    )
+    return result
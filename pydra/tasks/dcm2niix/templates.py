@@ -0,0 +1,312 @@
+"""Mapping the files written by dcm2niix back to the fields of its filename template.
+
+The '-f' option of dcm2niix accepts a template such as '%p_%s', the specifiers of which
+are expanded from the headers of each series (see
+https://github.com/rordenlab/dcm2niix/blob/master/FILENAMING.md). A
+:class:`FilenameTemplate` is compiled once from the template into a regular expression
+that matches the names of the files produced with it, recovering the value of each
+field (e.g. the protocol and series number), the postfixes dcm2niix appended to
+disambiguate the images of a series (e.g. '_e2', '_ph') and any letter appended to
+resolve clashing names, so that the outputs of a conversion can be grouped by series
+without rescanning the output directory or reading the sidecars. The postfixes are
+parsed by :func:`parse_postfix` into their components (echo, coil, phase, etc.).
+
+Specifiers are case-insensitive, as in dcm2niix (e.g. '%P' is expanded in the same way as
+'%p').
+
+NB: dcm2niix replaces characters that aren't valid in filenames, so the recovered
+fields are the sanitised values. Where a template ends in a free-text field (e.g.
+'%s_%p'), a clash letter can't be told apart from the end of the field, so is
+considered part of it.
+"""
+
+import functools
+from pathlib import Path
+import re
+import attrs
+
+# The fields each template specifier is expanded from, and whether they are numeric
+SPECIFIERS: dict[str, tuple[str, bool]] = {
+    "a": ("coil", False),
+    "b": ("basename", False),
+    "c": ("comments", False),
+    "d": ("description", False),
+    "e": ("echo_number", True),
+    "f": ("folder", False),
+    "g": ("accession_number", False),
+    "i": ("patient_id", False),
+    "j": ("series_instance_uid", False),
+    "k": ("study_instance_uid", False),
+    "l": ("procedure_step", False),
+    "m": ("manufacturer", False),
+    "n": ("patient_name", False),
+    "o": ("media_object_instance_uid", False),
+    "p": ("protocol", False),
+    "r": ("instance_number", True),
+    "s": ("series_number", True),
+    "t": ("time", True),
+    "u": ("acquisition_number", True),
+    "v": ("vendor", False),
+    "x": ("study_id", False),
+    "z": ("sequence_name", False),
+}
+
+# The postfixes dcm2niix appends to the names of the images of a series to tell them
+# apart (see FILENAMING.md): numbered postfixes for echoes, coils, images (e.g. slices
+# with different orientations), trigger times and regions of interest, and flags for
+# phase/real/imaginary and derived images
+NUMBERED_POSTFIXES = {
+    "e": "echo",
+    "c": "coil",
+    "i": "image",
+    "t": "trigger",
+    "ROI": "roi",
+}
+FLAG_POSTFIXES = (
+    "fieldmaphz",
+    "imaginary",
+    "phMag",
+    "real",
+    "Crop",
+    "MoCo",
+    "Tilt",
+    "ADC",
+    "MPR",
+    "Eq",
+    "ph",
+)
+POSTFIX_COMPONENT = re.compile(
+    "_(?:"
+    + "|".join(rf"{p}(?P<{n}>\d+)" for p, n in NUMBERED_POSTFIXES.items())
+    + "|(?P<flag>"
+    + "|".join(FLAG_POSTFIXES)
+    + "))"
+)
+POSTFIX = (
+    "(?:_(?:"
+    + "|".join([rf"{p}\d+" for p in NUMBERED_POSTFIXES] + list(FLAG_POSTFIXES))
+    + "))*"
+)
+
+
+@attrs.define
+class TemplateMatch:
+    """The fields recovered from the name of a file produced with a template
+
+    Parameters
+    ----------
+    series : str
+        the name shared by the files of the series, i.e. the expanded template and any
+        letters appended to resolve a clash with another series
+    fields : dict[str, str]
+        the value of each field in the template, e.g. 'protocol', 'series_number'
+    postfix : str
+        everything appended to the expanded template, i.e. the image postfixes (e.g.
+        '_e2') and the clash letters, as passed to the 'file_postfix' input
+    """
+
+    series: str
+    fields: dict[str, str]
+    postfix: str
+
+
+@attrs.define
+class SeriesOutputs:
+    """The files produced for a series, grouped by postfix and extension
+
+    Parameters
+    ----------
+    name : str
+        the name shared by the files of the series
+    fields : dict[str, str]
+        the value of each field of the filename template
+    files : dict[str, dict[str, Path]]
+        mapping from postfix ('' for the undisambiguated image) to extension to path
+    """
+
+    name: str
+    fields: dict[str, str]
+    files: dict[str, dict[str, Path]] = attrs.field(factory=dict)
+
+    @property
+    def series_number(self) -> int | None:
+        number = self.fields.get("series_number")
+        return int(number) if number is not None else None
+
+    @property
+    def protocol(self) -> str | None:
+        return self.fields.get("protocol")
+
+    @property
+    def description(self) -> str | None:
+        return self.fields.get("description")
+
+    @property
+    def paths(self) -> list[Path]:
+        return sorted(p for exts in self.files.values() for p in exts.values())
+
+
+@attrs.frozen
+class Postfix:
+    """The components of a postfix appended by dcm2niix to tell the images of a series
+    apart
+
+    Parameters
+    ----------
+    echo : int, optional
+        the echo number ('_e#')
+    coil : int, optional
+        the coil number ('_c#')
+    image : int, optional
+        the image number ('_i#'), for series split by position or orientation
+    trigger : int, optional
+        the trigger time ('_t#')
+    roi : int, optional
+        the region of interest ('_ROI#')
+    phase : bool
+        whether the image is a phase image ('_ph')
+    real : bool
+        whether the image holds the real component ('_real')
+    imaginary : bool
+        whether the image holds the imaginary component ('_imaginary')
+    flags : tuple[str, ...]
+        any other flags, e.g. 'ADC', 'MoCo'
+    clash : str
+        the letters appended to resolve a clash with another series, if any
+    """
+
+    echo: int | None = None
+    coil: int | None = None
+    image: int | None = None
+    trigger: int | None = None
+    roi: int | None = None
+    phase: bool = False
+    real: bool = False
+    imaginary: bool = False
+    flags: tuple[str, ...] = ()
+    clash: str = ""
+
+
+@functools.lru_cache(maxsize=256)
+def parse_postfix(postfix: str) -> Postfix | None:
+    """Parses a postfix appended by dcm2niix (e.g. '_e2_ph') into its components
+
+    Parameters
+    ----------
+    postfix : str
+        the postfix, including any clash letters
+
+    Returns
+    -------
+    Postfix or None
+        the components, or None if the postfix doesn't follow dcm2niix's grammar
+    """
+    # Any trailing letters that aren't part of a postfix resolve a clash
+    match = re.fullmatch(rf"(?P<postfix>{POSTFIX})(?P<clash>[a-z]*)", postfix)
+    if match is None:
+        return None
+    postfix, clash = match.group("postfix"), match.group("clash")
+    numbers: dict[str, int] = {}
+    flags = []
+    for component in POSTFIX_COMPONENT.finditer(postfix):
+        if flag := component.group("flag"):
+            flags.append(flag)
+        else:
+            name, value = next(
+                (n, v) for n, v in component.groupdict().items() if v is not None
+            )
+            numbers[name] = int(value)
+    return Postfix(
+        **numbers,
+        phase="ph" in flags,
+        real="real" in flags,
+        imaginary="imaginary" in flags,
+        flags=tuple(f for f in flags if f not in ("ph", "real", "imaginary")),
+        clash=clash,
+    )
+
+
+class FilenameTemplate:
+    """A dcm2niix filename template compiled into a matcher of the names it produces
+
+    Parameters
+    ----------
+    template : str
+        the template passed to dcm2niix's '-f' option
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        self.fields: list[str] = []
+        pattern = ""
+        pos = 0
+        template = normalise_specifiers(template)
+        for spec in re.finditer(r"%(.)", template):
+            pattern += re.escape(template[pos : spec.start()])
+            pos = spec.end()
+            char = spec.group(1)
+            if char == "%":
+                pattern += "%"
+                continue
+            field, numeric = SPECIFIERS.get(char, (f"field_{char}", False))
+            if field in self.fields:
+                pattern += f"(?P={field})"
+                continue
+            self.fields.append(field)
+            value = r"\d+" if numeric else r"[^/]+?"
+            pattern += f"(?P<{field}>{value})"
+        pattern += re.escape(template[pos:])
+        self.regex = re.compile(rf"(?P<base>{pattern})(?P<postfix>{POSTFIX})")
+        # Letters are only appended to resolve clashes, so are only matched if the
+        # name doesn't match without them ('a' to 'z', then 'aa' etc.)
+        self.clash_regex = re.compile(
+            rf"(?P<base>{pattern})(?P<postfix>{POSTFIX})(?P<clash>[a-z]+)"
+        )
+
+    def match(self, stem: str) -> TemplateMatch | None:
+        """Matches the name of a produced file (without its extension) against the
+        template
+
+        Parameters
+        ----------
+        stem : str
+            the name of the file relative to the output directory, without extension
+
+        Returns
+        -------
+        TemplateMatch or None
+            the recovered fields, or None if the name wasn't produced by the template
+        """
+        clash = ""
+        match = self.regex.fullmatch(stem)
+        if match is None:
+            match = self.clash_regex.fullmatch(stem)
+            if match is None:
+                return None
+            clash = match.group("clash")
+        return TemplateMatch(
+            series=match.group("base") + clash,
+            fields={f: match.group(f) for f in self.fields},
+            postfix=match.group("postfix") + clash,
+        )
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.template!r})"
+
+
+@functools.lru_cache(maxsize=32)
+def compile_template(template: str) -> FilenameTemplate:
+    """Returns the compiled matcher for a filename template, compiling it only on the
+    first call for the template"""
+    return FilenameTemplate(template)
+
+
+def normalise_specifiers(template: str) -> str:
+    """Lower-cases the specifiers of a filename template, which dcm2niix accepts in
+    either case"""
+    return re.sub(r"%(.)", lambda m: "%" + m.group(1).lower(), template)
+
+
+def is_template(filename: str | None) -> bool:
+    """Whether a filename passed to dcm2niix contains template specifiers"""
+    return filename is not None and "%" in filename
@@ -0,0 +1,9 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache_root(tmp_path_factory, monkeypatch):
+    """Keep the caches written by the package out of the user's cache directory"""
+    monkeypatch.setenv(
+        "PYDRA_DCM2NIIX_CACHE", str(tmp_path_factory.mktemp("dcm2niix-cache"))
+    )
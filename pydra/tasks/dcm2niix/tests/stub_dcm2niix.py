@@ -0,0 +1,219 @@
+"""A stand-in for the dcm2niix executable that writes placeholder outputs named in the
+same way as dcm2niix, so the Python side of the package can be exercised without it.
+
+The instances in the input directory are grouped into images by series, echo and
+whether they are phase images, and each image is named by expanding the '-f' template
+(%d, %e, %f, %i, %j, %k, %m, %n, %p, %s, %t, %u, %x, %z), appending the '_e#' and
+'_ph' postfixes (unless '--terse' is passed) and then resolving clashing names
+according to '-w', as described in
+https://github.com/rordenlab/dcm2niix/blob/master/FILENAMING.md. Derived images and
+localizers are skipped with '-i y'.
+
+If the 'STUB_DCM2NIIX_LOG' environment variable is set, each invocation is appended
+to the file it points to, and if 'STUB_DCM2NIIX_DELAY' is set the stub sleeps for that
+many seconds before converting.
+"""
+
+import argparse
+import gzip
+import itertools
+import json
+import os
+from pathlib import Path
+import re
+import string
+import struct
+import sys
+import time
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+VERSION = "v1.0.20240202-stub"
+
+# The header fields that each template specifier is expanded from
+TEMPLATE_FIELDS = {
+    "d": "SeriesDescription",
+    "e": "EchoNumbers",
+    "i": "PatientID",
+    "j": "SeriesInstanceUID",
+    "k": "StudyInstanceUID",
+    "m": "Manufacturer",
+    "n": "PatientName",
+    "p": "ProtocolName",
+    "s": "SeriesNumber",
+    "t": "StudyTime",
+    "u": "AcquisitionNumber",
+    "x": "StudyID",
+    "z": "SequenceName",
+}
+
+
+def nifti_image(rows: int, columns: int, slices: int, volumes: int = 1) -> bytes:
+    """Returns a minimal NIfTI-1 image of 16-bit zeros with the given dimensions"""
+    header = bytearray(348)
+    struct.pack_into("<i", header, 0, 348)
+    struct.pack_into("<8h", header, 40, 4, columns, rows, slices, volumes, 1, 1, 1)
+    struct.pack_into("<hh", header, 70, 4, 16)  # datatype=int16, bitpix
+    struct.pack_into("<8f", header, 76, 1, 1, 1, 1, 1, 0, 0, 0)
+    struct.pack_into("<f", header, 108, 352)  # vox_offset
+    header[344:348] = b"n+1\0"
+    return bytes(header) + bytes(4) + bytes(rows * columns * slices * volumes * 2)
+
+
+def expand_template(template: str, first: pydicom.Dataset) -> str:
+    """Expands the specifiers in a '-f' filename template from the header of the first
+    instance of an image (and the folder holding it), replacing the characters dcm2niix
+    doesn't allow in filenames"""
+
+    def expand(match: re.Match[str]) -> str:
+        spec = match.group(1).lower()
+        if spec == "%":
+            return "%"
+        if spec == "f":
+            return Path(first.filename).parent.name
+        value = first.get(TEMPLATE_FIELDS[spec], "")
+        if spec == "t" and value:
+            value = str(value).split(".")[0]
+        return str(value)
+
+    name = re.sub(
+        r"%([%" + "".join(TEMPLATE_FIELDS) + "f])", expand, template, flags=re.I
+    )
+    return re.sub(r'[\x00-\x1f <>:"\\|?*^]', "_", name)
+
+
+def clash_suffixes():
+    """Generates the letters appended to resolve clashing names, 'a' to 'z', 'aa' etc."""
+    for length in itertools.count(1):
+        for letters in itertools.product(string.ascii_lowercase, repeat=length):
+            yield "".join(letters)
+
+
+def image_type(ds: pydicom.Dataset) -> list[str]:
+    value = ds.get("ImageType", [])
+    return [value] if isinstance(value, str) else list(value)
+
+
+def is_derived(ds: pydicom.Dataset) -> bool:
+    return image_type(ds)[:1] == ["DERIVED"] or "LOCALIZER" in image_type(ds)
+
+
+def is_phase(ds: pydicom.Dataset) -> bool:
+    return "P" in image_type(ds) or "PHASE" in image_type(ds)
+
+
+def iter_files(in_dir: Path, search_depth: int) -> list[Path]:
+    """Lists the files in the input directory down to the search depth, following
+    symbolic links to directories as dcm2niix does"""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(in_dir, followlinks=True):
+        if len(Path(dirpath).relative_to(in_dir).parts) >= search_depth:
+            dirnames.clear()
+        paths.extend(Path(dirpath) / f for f in filenames)
+    return paths
+
+
+def main(argv: list[str]) -> int:
+    if "--version" in argv:
+        print(VERSION)
+        return 0
+    parser = argparse.ArgumentParser()
+    parser.add_argument("in_dir")
+    parser.add_argument("-o", dest="out_dir")
+    parser.add_argument("-f", dest="filename", default="%f_%p_%t_%s")
+    parser.add_argument("-z", dest="compress", default="n")
+    parser.add_argument("-b", dest="bids", default="y")
+    parser.add_argument("-d", dest="search_depth", type=int, default=5)
+    parser.add_argument("-w", dest="name_conflicts", type=int, default=2)
+    parser.add_argument("-i", dest="ignore_derived", default="n")
+    for opt in "a ba e g l m n p r s t v x -big-endian -progress".split():
+        parser.add_argument("-" + opt)
+    for flag in "c u -terse -xml".split():
+        parser.add_argument("-" + flag, action="store_true")
+    # Compression levels (e.g. '-6') would otherwise be parsed as positional
+    args = parser.parse_args([a for a in argv if not re.match(r"-\d$", a)])
+    if log := os.environ.get("STUB_DCM2NIIX_LOG"):
+        with open(log, "a") as f:
+            f.write(" ".join(argv) + "\n")
+    if delay := os.environ.get("STUB_DCM2NIIX_DELAY"):
+        time.sleep(float(delay))
+    in_dir = Path(args.in_dir)
+    out_dir = Path(args.out_dir) if args.out_dir else in_dir
+    # Group the instances into images by series, echo and magnitude/phase
+    images: dict[tuple[int, str, int, bool], list[pydicom.Dataset]] = {}
+    for path in sorted(iter_files(in_dir, args.search_depth)):
+        try:
+            ds = pydicom.dcmread(path, stop_before_pixels=True)
+        except InvalidDicomError:
+            continue
+        if args.ignore_derived == "y" and is_derived(ds):
+            continue
+        key = (
+            int(ds.get("SeriesNumber") or 0),
+            str(ds.SeriesInstanceUID),
+            int(ds.get("EchoNumbers") or 1),
+            is_phase(ds),
+        )
+        images.setdefault(key, []).append(ds)
+    echoes: dict[str, set[int]] = {}
+    for _, series_uid, echo, _ in images:
+        echoes.setdefault(series_uid, set()).add(echo)
+    print(f"Chris Rorden's dcm2niiX version {VERSION}")
+    print(f"Found {sum(len(i) for i in images.values())} DICOM file(s)")
+    exts = []
+    if args.bids != "o":
+        exts.append(".nii.gz" if args.compress in ("y", "o", "i") else ".nii")
+    if args.bids in ("y", "o"):
+        exts.append(".json")
+    written: set[str] = set()
+    for (_, series_uid, echo, phase), instances in sorted(images.items()):
+        first = instances[0]
+        stem = expand_template(args.filename, first)
+        if not args.terse:
+            if len(echoes[series_uid]) > 1 and "%e" not in args.filename.lower():
+                stem += f"_e{echo}"
+            if phase:
+                stem += "_ph"
+
+        def clashes(s: str) -> bool:
+            return s in written or any((out_dir / (s + e)).exists() for e in exts)
+
+        if clashes(stem):
+            if args.name_conflicts == 0:
+                print(f"Skipping existing file name {out_dir / stem}")
+                continue
+            if args.name_conflicts == 2:
+                suffixes = clash_suffixes()
+                suffix = next(suffixes)
+                while clashes(stem + suffix):
+                    suffix = next(suffixes)
+                stem += suffix
+        written.add(stem)
+        (out_dir / stem).parent.mkdir(parents=True, exist_ok=True)
+        if args.bids != "o":
+            image = nifti_image(first.Rows, first.Columns, len(instances))
+            if args.compress in ("y", "o", "i"):
+                (out_dir / (stem + ".nii.gz")).write_bytes(gzip.compress(image))
+            else:
+                (out_dir / (stem + ".nii")).write_bytes(image)
+        if args.bids in ("y", "o"):
+            sidecar = {
+                "SeriesDescription": str(first.get("SeriesDescription", "")),
+                "ProtocolName": str(first.get("ProtocolName", "")),
+                "SeriesNumber": int(first.get("SeriesNumber", 0)),
+                "SeriesInstanceUID": str(first.SeriesInstanceUID),
+            }
+            if "EchoTime" in first:
+                sidecar["EchoTime"] = float(first.EchoTime) / 1000
+            if len(echoes[series_uid]) > 1:
+                sidecar["EchoNumber"] = echo
+            (out_dir / (stem + ".json")).write_text(json.dumps(sidecar))
+        print(
+            f"Convert {len(instances)} DICOM as {out_dir / stem} "
+            f"({first.Rows}x{first.Columns}x{len(instances)}x1)"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,178 @@
+"""Helpers for writing synthetic DICOM series and sessions to test and benchmark
+against"""
+
+from pathlib import Path
+import pydicom
+from pydicom.dataset import FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+
+def write_series(
+    out_dir: Path,
+    num_instances: int = 3,
+    series_number: int = 1,
+    study_uid: str | None = None,
+    series_uid: str | None = None,
+    rows: int = 4,
+    columns: int = 4,
+    prefix: str = "",
+    num_echoes: int = 1,
+    phase: bool = False,
+    image_type: list[str] | None = None,
+    protocol_name: str | None = None,
+) -> list[Path]:
+    """Writes a synthetic MR series, one instance per file
+
+    Parameters
+    ----------
+    out_dir : Path
+        the directory to write the instances to
+    num_instances : int
+        the number of slices in the series (per echo)
+    series_number : int
+        the series number, which is also used to name the files
+    study_uid : str, optional
+        the study instance UID, generated if not provided
+    series_uid : str, optional
+        the series instance UID, generated if not provided
+    rows : int
+        the number of rows in each slice
+    columns : int
+        the number of columns in each slice
+    prefix : str
+        prefix for the filenames
+    num_echoes : int
+        the number of echoes to acquire each slice at
+    phase : bool
+        whether the series holds phase rather than magnitude images
+    image_type : list[str], optional
+        the ImageType of the instances, by default ORIGINAL/PRIMARY/M (or P for phase)
+    protocol_name : str, optional
+        the protocol name, by default "protocol<series_number>"
+
+    Returns
+    -------
+    list[Path]
+        the paths of the written files
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if study_uid is None:
+        study_uid = generate_uid()
+    if series_uid is None:
+        series_uid = generate_uid()
+    if image_type is None:
+        image_type = ["ORIGINAL", "PRIMARY", "P" if phase else "M"]
+    if protocol_name is None:
+        protocol_name = f"protocol{series_number}"
+    paths = []
+    for i in range(1, num_instances * num_echoes + 1):
+        echo = (i - 1) // num_instances + 1
+        sop_uid = generate_uid()
+        ds = pydicom.Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.MediaStorageSOPClassUID = MRImageStorage
+        ds.file_meta.MediaStorageSOPInstanceUID = sop_uid
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.SOPClassUID = MRImageStorage
+        ds.SOPInstanceUID = sop_uid
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.PatientID = "SUBJ01"
+        ds.PatientName = "Synthetic^Subject"
+        ds.StudyID = "1"
+        ds.StudyTime = "093000.000000"
+        ds.Manufacturer = "Synthetic"
+        ds.Modality = "MR"
+        ds.ImageType = image_type
+        ds.ProtocolName = protocol_name
+        ds.SeriesDescription = f"series{series_number}"
+        ds.SeriesNumber = series_number
+        ds.AcquisitionNumber = 1
+        ds.InstanceNumber = i
+        ds.EchoNumbers = echo
+        ds.EchoTime = 5.0 * echo
+        ds.SliceThickness = 1.0
+        ds.PixelSpacing = [1.0, 1.0]
+        ds.ImagePositionPatient = [0.0, 0.0, float((i - 1) % num_instances)]
+        ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.PixelData = bytes(rows * columns * 2)
+        path = out_dir / f"{prefix}{series_number:03d}_{i:05d}.dcm"
+        pydicom.dcmwrite(path, ds, enforce_file_format=True)
+        paths.append(path)
+    return paths
+
+
+def write_session(
+    out_dir: Path,
+    num_series: int = 4,
+    num_instances: int = 16,
+    rows: int = 64,
+    columns: int = 64,
+    nested: bool = False,
+) -> list[Path]:
+    """Writes a synthetic MR session resembling a scanner export: a localizer, followed
+    by a rotation of anatomical, multi-echo magnitude/phase and derived series, plus a
+    non-DICOM file
+
+    Parameters
+    ----------
+    out_dir : Path
+        the directory to write the session to
+    num_series : int
+        the number of series to write (after the localizer)
+    num_instances : int
+        the number of slices in each series
+    rows : int
+        the number of rows in each slice
+    columns : int
+        the number of columns in each slice
+    nested : bool
+        whether to write each series into its own sub-directory, otherwise all files
+        are written directly into the output directory
+
+    Returns
+    -------
+    list[Path]
+        the paths of the written DICOM files
+    """
+    out_dir = Path(out_dir)
+    study_uid = generate_uid()
+
+    def series_dir(number: int, name: str) -> Path:
+        return out_dir / f"{number:03d}_{name}" if nested else out_dir
+
+    paths = write_series(
+        series_dir(1, "localizer"),
+        num_instances=3,
+        series_number=1,
+        study_uid=study_uid,
+        rows=rows,
+        columns=columns,
+        image_type=["ORIGINAL", "PRIMARY", "LOCALIZER"],
+        protocol_name="localizer",
+    )
+    for number in range(2, num_series + 2):
+        kind = ("t1w", "gre", "gre_ph", "derived")[(number - 2) % 4]
+        paths += write_series(
+            series_dir(number, kind),
+            num_instances=num_instances,
+            series_number=number,
+            study_uid=study_uid,
+            rows=rows,
+            columns=columns,
+            num_echoes=3 if kind.startswith("gre") else 1,
+            phase=kind == "gre_ph",
+            image_type=(["DERIVED", "SECONDARY", "ADC"] if kind == "derived" else None),
+            protocol_name=kind,
+        )
+    (out_dir / "README.txt").write_text("Synthetic session, not for clinical use\n")
+    return paths
@@ -0,0 +1,95 @@
+import asyncio
+from pathlib import Path
+import subprocess
+import sys
+import threading
+import attrs
+from pydra.tasks.dcm2niix.aio import convert_many, run_async
+from pydra.tasks.dcm2niix.cache import ConversionCache
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+def test_convert_many(tmp_path):
+    tasks = []
+    for i in range(5):
+        write_series(tmp_path / "dicoms" / str(i), num_instances=2, series_number=i)
+        tasks.append(
+            Dcm2Niix(
+                in_dir=tmp_path / "dicoms" / str(i),
+                out_dir=tmp_path / "out" / str(i),
+                compress="y",
+                executable=STUB,
+            )
+        )
+    # A task without an output directory fails without affecting the others
+    tasks.append(Dcm2Niix(in_dir=tmp_path / "dicoms" / "0", executable=STUB))
+
+    async def collect():
+        return [r async for r in convert_many(tasks, max_concurrency=2)]
+
+    results = asyncio.run(collect())
+    assert len(results) == 6
+    failed = [r for r in results if not r.ok]
+    assert len(failed) == 1 and isinstance(failed[0].error, ValueError)
+    for result in results:
+        if result.ok:
+            out_dir = Path(result.task.out_dir)
+            assert result.outputs.out_file.fspath == out_dir / "out_file.nii.gz"
+            assert "dcm2niix" in result.metrics.phases
+
+
+def test_convert_many_async_iterable_timeout(tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_DCM2NIIX_DELAY", "10")
+    write_series(tmp_path / "dicoms", num_instances=2)
+
+    async def tasks():
+        for i in range(2):
+            yield Dcm2Niix(
+                in_dir=tmp_path / "dicoms",
+                out_dir=tmp_path / "out" / str(i),
+                executable=STUB,
+            )
+
+    async def collect():
+        return [r async for r in convert_many(tasks(), timeout=0.5)]
+
+    results = asyncio.run(collect())
+    assert [type(r.error) for r in results] == [subprocess.TimeoutExpired] * 2
+
+
+def test_convert_many_metrics_off_loop(tmp_path, monkeypatch):
+    write_series(tmp_path / "dicoms", num_instances=2)
+    recorded = []
+    monkeypatch.setattr(
+        "pydra.tasks.dcm2niix.aio.record_metrics",
+        lambda metrics, metrics_file: recorded.append(threading.get_ident()),
+    )
+    task = Dcm2Niix(
+        in_dir=tmp_path / "dicoms", out_dir=tmp_path / "out", executable=STUB
+    )
+
+    async def collect():
+        return [r async for r in convert_many([task], metrics_file=tmp_path / "m")]
+
+    (result,) = asyncio.run(collect())
+    assert result.ok, result.error
+    # The metrics are written from a worker thread, not the event loop's
+    assert recorded and recorded[0] != threading.get_ident()
+
+
+def test_run_async_cached(tmp_path):
+    write_series(tmp_path / "dicoms", num_instances=2)
+    cache = ConversionCache(tmp_path / "cache")
+    task = Dcm2Niix(
+        in_dir=tmp_path / "dicoms", out_dir=tmp_path / "out", executable=STUB
+    )
+    first = asyncio.run(run_async(task, cache=cache))
+    second = asyncio.run(
+        run_async(attrs.evolve(task, out_dir=tmp_path / "out2"), cache=cache)
+    )
+    assert not first.metrics.cached
+    assert second.metrics.cached
+    assert second.names == first.names
@@ -0,0 +1,86 @@
+from pathlib import Path
+import sys
+import tarfile
+import zipfile
+import pydicom
+import pytest
+from pydra.tasks.dcm2niix.archive import convert_archive, index_archive
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+@pytest.fixture(params=["zip", "tar.gz"])
+def archive(tmp_path, request):
+    paths = write_series(tmp_path / "dicoms" / "s1", num_instances=3, series_number=1)
+    paths += write_series(tmp_path / "dicoms" / "s2", num_instances=2, series_number=2)
+    readme = tmp_path / "dicoms" / "README.txt"
+    readme.write_text("exported from PACS")
+    paths.append(readme)
+    archive = tmp_path / f"export.{request.param}"
+    if request.param == "zip":
+        with zipfile.ZipFile(archive, "w") as zf:
+            for path in paths:
+                zf.write(path, path.relative_to(tmp_path))
+    else:
+        with tarfile.open(archive, "w:gz") as tf:
+            for path in paths:
+                tf.add(path, path.relative_to(tmp_path))
+    return archive
+
+
+def test_index_archive(archive):
+    series = index_archive(archive)
+    # The README isn't a DICOM
+    assert len(series) == 6
+    assert series.count(None) == 1
+    assert len(set(series) - {None}) == 2
+
+
+def test_convert_archive(archive, tmp_path):
+    outputs = convert_archive(
+        archive,
+        Dcm2Niix(out_dir=tmp_path / "out", compress="y", executable=STUB),
+        staging_root=tmp_path / "staging",
+        max_staged_bytes=1,
+    )
+    assert sorted(Path(p).name for p in outputs.out_files) == [
+        "out_file.json",
+        "out_file.nii.gz",
+        "out_filea.json",
+        "out_filea.nii.gz",
+    ]
+    assert "Convert 3 DICOM" in outputs.stdout
+    assert "Convert 2 DICOM" in outputs.stdout
+    # Staging is cleaned up
+    assert list((tmp_path / "staging").iterdir()) == []
+
+
+def test_convert_archive_tar_order(tmp_path):
+    first = write_series(tmp_path / "s1", num_instances=3, series_number=1)
+    second = write_series(tmp_path / "s2", num_instances=2, series_number=2)
+    extra = write_series(
+        tmp_path / "extra",
+        num_instances=1,
+        series_number=1,
+        series_uid=str(pydicom.dcmread(first[0]).SeriesInstanceUID),
+    )
+    archive = tmp_path / "export.tar"
+    with tarfile.open(archive, "w") as tf:
+        # The members of the second series are interleaved with those of the first,
+        # one of which has the same name as another
+        for path in first[:2] + second + first[2:]:
+            tf.add(path, path.name)
+        tf.add(extra[0], first[0].name)
+    outputs = convert_archive(
+        archive,
+        Dcm2Niix(out_dir=tmp_path / "out", executable=STUB),
+        staging_root=tmp_path / "staging",
+    )
+    # Each series is converted once it is complete, including the member with the
+    # duplicate name
+    assert outputs.stdout.count("Convert 4 DICOM") == 1
+    assert outputs.stdout.count("Convert 2 DICOM") == 1
+    assert len(outputs.out_files) == 4
+    assert list((tmp_path / "staging").iterdir()) == []
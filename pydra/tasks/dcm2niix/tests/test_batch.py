@@ -0,0 +1,46 @@
+from pathlib import Path
+import subprocess
+import sys
+from pydra.tasks.dcm2niix.batch import BatchJob, Dcm2NiixBatch
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+def test_batch(tmp_path):
+    jobs = []
+    for i in range(5):
+        write_series(tmp_path / "dicoms" / str(i), num_instances=2, series_number=i)
+        jobs.append((tmp_path / "dicoms" / str(i), tmp_path / "out" / str(i)))
+    # Override the compression of the last job
+    jobs[-1] += ({"compress": "n"},)
+    # A directory without any DICOMs in it fails to produce an 'out_file'
+    (tmp_path / "dicoms" / "empty").mkdir()
+    (tmp_path / "dicoms" / "empty" / "notes.txt").write_text("not a DICOM")
+    jobs.append(BatchJob(tmp_path / "dicoms" / "empty", tmp_path / "out" / "empty"))
+    batch = Dcm2NiixBatch(Dcm2Niix(compress="y", executable=STUB), max_workers=2)
+    results = {r.job.in_dir.name: r for r in batch.run(iter(jobs))}
+    assert sorted(results) == ["0", "1", "2", "3", "4", "empty"]
+    for i in range(4):
+        assert results[str(i)].ok
+        assert (
+            results[str(i)].outputs.out_file.fspath
+            == tmp_path / "out" / str(i) / "out_file.nii.gz"
+        )
+    assert results["4"].outputs.out_file.fspath.name == "out_file.nii"
+    assert not results["empty"].ok
+    assert isinstance(results["empty"].error, ValueError)
+    assert results["empty"].metrics.error.startswith("ValueError")
+    assert "dcm2niix" in results["0"].metrics.phases
+    # One command-line template per distinct set of overrides
+    assert len(batch._tasks._commands) == 2
+
+
+def test_batch_timeout(tmp_path, monkeypatch):
+    write_series(tmp_path / "dicoms")
+    monkeypatch.setenv("STUB_DCM2NIIX_DELAY", "10")
+    batch = Dcm2NiixBatch(Dcm2Niix(executable=STUB), timeout=0.5)
+    (result,) = batch.run([(tmp_path / "dicoms", tmp_path / "out")])
+    assert isinstance(result.error, subprocess.TimeoutExpired)
+    assert result.duration < 10
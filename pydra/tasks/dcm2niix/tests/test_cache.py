@@ -0,0 +1,126 @@
+from pathlib import Path
+import sys
+from pydra.tasks.dcm2niix.cache import ConversionCache
+from pydra.tasks.dcm2niix.compression import ParallelGzip
+from pydra.tasks.dcm2niix.convert import convert
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+def num_runs(log):
+    return len(log.read_text().splitlines()) if log.exists() else 0
+
+
+def test_conversion_cache(tmp_path, monkeypatch):
+    log = tmp_path / "stub.log"
+    monkeypatch.setenv("STUB_DCM2NIIX_LOG", str(log))
+    cache = ConversionCache(tmp_path / "cache")
+    write_series(tmp_path / "export1", num_instances=3)
+    # A copy of the same series in a different location
+    for path in (tmp_path / "export1").iterdir():
+        (tmp_path / "export2").mkdir(exist_ok=True)
+        (tmp_path / "export2" / path.name).write_bytes(path.read_bytes())
+
+    outputs = convert(
+        Dcm2Niix(
+            in_dir=tmp_path / "export1",
+            out_dir=tmp_path / "out1",
+            compress="y",
+            executable=STUB,
+        ),
+        cache=cache,
+    )
+    assert num_runs(log) == 1
+    assert outputs.out_file.fspath == tmp_path / "out1" / "out_file.nii.gz"
+
+    outputs = convert(
+        Dcm2Niix(
+            in_dir=tmp_path / "export2",
+            out_dir=tmp_path / "out2",
+            filename="renamed",
+            compress="y",
+            executable=STUB,
+        ),
+        cache=cache,
+    )
+    assert num_runs(log) == 1
+    assert outputs.out_file.fspath == tmp_path / "out2" / "renamed.nii.gz"
+    assert outputs.out_json.fspath == tmp_path / "out2" / "renamed.json"
+    assert sorted(Path(p).name for p in outputs.out_files) == [
+        "renamed.json",
+        "renamed.nii.gz",
+    ]
+
+    # Conversion relevant arguments are part of the key
+    convert(
+        Dcm2Niix(
+            in_dir=tmp_path / "export2",
+            out_dir=tmp_path / "out3",
+            compress="n",
+            executable=STUB,
+        ),
+        cache=cache,
+    )
+    assert num_runs(log) == 2
+
+
+def test_conversion_cache_eviction(tmp_path):
+    cache = ConversionCache(tmp_path / "cache")
+    keys = []
+    for i in range(3):
+        write_series(tmp_path / f"in{i}", num_instances=1, series_number=i)
+        task = Dcm2Niix(
+            in_dir=tmp_path / f"in{i}", out_dir=tmp_path / f"out{i}", executable=STUB
+        )
+        keys.append(cache.key(task))
+        convert(task, cache=cache)
+        if i == 0:
+            # Leave room for two entries
+            cache.max_bytes = int(cache.size * 2.5)
+    assert cache.size <= cache.max_bytes
+    assert cache.materialize(keys[0], tmp_path / "out", "out_file") is None
+    assert cache.materialize(keys[1], tmp_path / "out", "out_file")
+    assert cache.materialize(keys[2], tmp_path / "out", "out_file")
+
+
+def test_conversion_cache_name_conflicts(tmp_path):
+    cache = ConversionCache(tmp_path / "cache")
+    write_series(tmp_path / "in", num_instances=2)
+    task = Dcm2Niix(in_dir=tmp_path / "in", out_dir=tmp_path / "out", executable=STUB)
+    key = cache.key(task)
+    convert(task, cache=cache)
+    existing = (tmp_path / "out" / "out_file.nii").read_bytes()
+    # Clashing outputs are renamed, skipped or overwritten like dcm2niix's
+    assert sorted(cache.materialize(key, tmp_path / "out", "out_file")) == [
+        "out_filea.json",
+        "out_filea.nii",
+    ]
+    assert cache.materialize(key, tmp_path / "out", "out_file", 0) == []
+    assert sorted(cache.materialize(key, tmp_path / "out", "out_file", 1)) == [
+        "out_file.json",
+        "out_file.nii",
+    ]
+    assert (tmp_path / "out" / "out_file.nii").read_bytes() == existing
+    assert sorted(p.name for p in (tmp_path / "out").iterdir()) == [
+        "out_file.json",
+        "out_file.nii",
+        "out_filea.json",
+        "out_filea.nii",
+    ]
+
+
+def test_conversion_cache_compression_stage(tmp_path):
+    cache = ConversionCache(tmp_path / "cache")
+    write_series(tmp_path / "in", num_instances=1)
+    task = Dcm2Niix(in_dir=tmp_path / "in", compress="y", executable=STUB)
+    keys = {
+        cache.key(task),
+        cache.key(task, compressor=ParallelGzip()),
+        cache.key(task, compressor=ParallelGzip(indexed=True)),
+    }
+    assert len(keys) == 3
+    # The stage isn't used when the task doesn't compress its outputs
+    task = Dcm2Niix(in_dir=tmp_path / "in", compress="n", executable=STUB)
+    assert cache.key(task) == cache.key(task, compressor=ParallelGzip())
@@ -0,0 +1,54 @@
+import pydicom
+from pydra.tasks.dcm2niix.catalog import DicomCatalog, load_catalog
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+
+
+def test_catalog(tmp_path):
+    write_series(tmp_path / "dicoms", num_instances=3, series_number=2)
+    write_series(tmp_path / "dicoms" / "sub", num_instances=2, series_number=1)
+    write_series(
+        tmp_path / "dicoms" / "sub" / "subsub", num_instances=1, series_number=3
+    )
+    (tmp_path / "dicoms" / "notes.txt").write_text("not a dicom")
+    catalog = DicomCatalog.build(tmp_path / "dicoms", search_depth=1)
+    assert [s.series_number for s in catalog.series.values()] == [1, 2]
+    assert [s.num_instances for s in catalog.series.values()] == [2, 3]
+    assert catalog.non_dicom == ["notes.txt"]
+    series = next(iter(catalog.series.values()))
+    assert series.modality == "MR"
+    assert series.image_types == [["ORIGINAL", "PRIMARY", "M"]]
+    assert not series.derived and not series.localizer
+    assert series.num_frames == 2
+    assert series.total_bytes == sum(
+        p.stat().st_size for p in catalog.paths(series.series_uid)
+    )
+    assert DicomCatalog.from_dict(catalog.to_dict()) == catalog
+
+
+def test_load_catalog_cached(tmp_path, monkeypatch):
+    write_series(tmp_path / "dicoms", num_instances=2)
+    cache_dir = tmp_path / "cache"
+    catalog = load_catalog(tmp_path / "dicoms", cache_dir=cache_dir)
+    assert len(list(cache_dir.iterdir())) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError("catalog rebuilt")
+
+    monkeypatch.setattr(DicomCatalog, "build", fail)
+    assert load_catalog(tmp_path / "dicoms", cache_dir=cache_dir) == catalog
+    monkeypatch.undo()
+    # Changes to the directory invalidate the cached catalog
+    write_series(tmp_path / "dicoms", num_instances=1, prefix="new")
+    assert len(load_catalog(tmp_path / "dicoms", cache_dir=cache_dir).series) == 2
+
+
+def test_catalog_multi_valued_echo(tmp_path):
+    paths = write_series(tmp_path / "dicoms", num_instances=2)
+    ds = pydicom.dcmread(paths[0])
+    ds.EchoNumbers = [2, 3]
+    ds.save_as(paths[0])
+    ds = pydicom.dcmread(paths[1])
+    ds.EchoNumbers = None
+    ds.save_as(paths[1])
+    catalog = DicomCatalog.build(tmp_path / "dicoms")
+    assert next(iter(catalog.series.values())).echo_numbers == [2]
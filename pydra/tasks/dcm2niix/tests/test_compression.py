@@ -0,0 +1,137 @@
+import gzip
+import json
+import os
+from pathlib import Path
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from fileformats.medimage import NiftiGz
+from pydra.tasks.dcm2niix.compression import (
+    IndexedGzipReader,
+    ParallelGzip,
+    gzip_file,
+)
+from pydra.tasks.dcm2niix.convert import convert
+from pydra.tasks.dcm2niix.tests.stub_dcm2niix import nifti_image
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+def test_gzip_file(tmp_path):
+    data = (os.urandom(1000) * 3 + bytes(5000)) * 100 + b"tail"
+    for block_size in (4096, 100_000, len(data) * 2):
+        src = tmp_path / "image.nii"
+        src.write_bytes(data)
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            dest = gzip_file(src, level=4, block_size=block_size, pool=pool)
+        assert dest == tmp_path / "image.nii.gz"
+        assert not src.exists()
+        assert gzip.decompress(dest.read_bytes()) == data
+    (tmp_path / "empty.nii").write_bytes(b"")
+    assert gzip.decompress(gzip_file(tmp_path / "empty.nii").read_bytes()) == b""
+
+
+def test_convert_parallel_gzip(tmp_path, monkeypatch):
+    log = tmp_path / "stub.log"
+    metrics_file = tmp_path / "metrics.jsonl"
+    monkeypatch.setenv("STUB_DCM2NIIX_LOG", str(log))
+    write_series(tmp_path / "dicoms", num_instances=4, num_echoes=3)
+    with ParallelGzip(max_workers=2, block_size=256) as compressor:
+        outputs = convert(
+            Dcm2Niix(
+                in_dir=tmp_path / "dicoms",
+                out_dir=tmp_path / "out",
+                compress="y",
+                compression_level=9,
+                file_postfix="_e2",
+                executable=STUB,
+            ),
+            compressor=compressor,
+            metrics_file=metrics_file,
+        )
+    # dcm2niix is asked not to compress
+    assert " -z n " in log.read_text()
+    assert isinstance(outputs.out_file, NiftiGz)
+    assert outputs.out_file.fspath == tmp_path / "out" / "out_file_e2.nii.gz"
+    assert sorted(p.name for p in (tmp_path / "out").iterdir()) == [
+        f"out_file_e{e}{ext}" for e in (1, 2, 3) for ext in (".json", ".nii.gz")
+    ]
+    (metrics,) = (json.loads(ln) for ln in metrics_file.read_text().splitlines())
+    assert "compress" in metrics["phases"]
+
+
+def test_convert_parallel_gzip_nrrd(tmp_path, monkeypatch, caplog):
+    log = tmp_path / "stub.log"
+    monkeypatch.setenv("STUB_DCM2NIIX_LOG", str(log))
+    write_series(tmp_path / "dicoms", num_instances=2)
+    task = Dcm2Niix(
+        in_dir=tmp_path / "dicoms",
+        out_dir=tmp_path / "out",
+        compress="y",
+        export_nrrd="y",
+        executable=STUB,
+    )
+    with ParallelGzip() as compressor:
+        assert not compressor.compresses(task)
+        convert(task, compressor=compressor)
+    # NRRD outputs are left to dcm2niix to compress
+    assert " -z y " in log.read_text()
+    assert "only compresses NIfTI images" in caplog.text
+
+
+def test_parallel_gzip_max_files(tmp_path):
+    for i in range(4):
+        (tmp_path / f"image{i}.nii").write_bytes(os.urandom(1000) * 10)
+    with ParallelGzip(max_files=4, block_size=1024) as compressor:
+        futures = [compressor.submit(tmp_path / f"image{i}.nii") for i in range(4)]
+        assert compressor._file_pool._max_workers == 4
+        paths = [f.result() for f in futures]
+    assert paths == [tmp_path / f"image{i}.nii.gz" for i in range(4)]
+
+
+def test_indexed_gzip(tmp_path):
+    # A 4D image of 6x5x4 voxels by 30 volumes, where each voxel of a volume holds the
+    # index of the volume
+    header = bytearray(nifti_image(5, 6, 4, 30)[:352])
+    volume_size = 6 * 5 * 4 * 2
+    data = bytes(header) + b"".join(
+        struct.pack("<h", v) * (volume_size // 2) for v in range(30)
+    )
+    (tmp_path / "func.nii").write_bytes(data)
+    dest = gzip_file(tmp_path / "func.nii", block_size=1000, indexed=True)
+    assert gzip.decompress(dest.read_bytes()) == data
+    assert (tmp_path / "func.nii.gz.idx").exists()
+    with IndexedGzipReader(dest) as reader:
+        assert reader.volume_range(0) == (352, volume_size)
+        for volume in (0, 1, 17, 29):
+            assert reader.read_volume(volume) == struct.pack("<h", volume) * (
+                volume_size // 2
+            )
+        assert reader.read(10, 2000) == data[10:2010]
+        with pytest.raises(IndexError):
+            reader.read_volume(30)
+
+
+def test_convert_indexed(tmp_path):
+    write_series(tmp_path / "dicoms", num_instances=4)
+    with ParallelGzip(indexed=True) as compressor:
+        outputs = convert(
+            Dcm2Niix(
+                in_dir=tmp_path / "dicoms",
+                out_dir=tmp_path / "out",
+                compress="y",
+                executable=STUB,
+            ),
+            compressor=compressor,
+        )
+    # The index is written alongside the image but isn't one of the outputs
+    assert sorted(Path(p).name for p in outputs.out_files) == [
+        "out_file.json",
+        "out_file.nii.gz",
+    ]
+    assert (tmp_path / "out" / "out_file.nii.gz.idx").exists()
+    with IndexedGzipReader(outputs.out_file) as reader:
+        assert reader.read_volume(0) == bytes(4 * 4 * 4 * 2)
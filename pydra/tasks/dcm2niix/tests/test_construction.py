@@ -0,0 +1,50 @@
+import shlex
+import pytest
+from pydra.tasks.dcm2niix.construction import TaskTemplate
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+
+def test_task_template(tmp_path):
+    write_series(tmp_path / "dicoms", num_instances=3)
+    template = Dcm2Niix(compress="y", filename="%p_%s")
+    tasks = TaskTemplate(template)
+    task = tasks.task(tmp_path / "dicoms", tmp_path / "out", compression_level=5)
+    expected = Dcm2Niix(
+        in_dir=tmp_path / "dicoms",
+        out_dir=tmp_path / "out",
+        compress="y",
+        filename="%p_%s",
+        compression_level=5,
+    )
+    assert task.cmdline == expected.cmdline
+    assert task._hash == expected._hash
+    # The template is copied, so isn't affected by changes to the original
+    template.compress = "n"
+    assert tasks.task(tmp_path / "dicoms").compress == "y"
+    with pytest.raises(ValueError, match="compression_level"):
+        tasks.task(tmp_path / "dicoms", compression_level=12)
+    with pytest.raises(TypeError, match="compresion"):
+        tasks.task(tmp_path / "dicoms", compresion="y")
+
+
+def test_task_template_argv(tmp_path):
+    for i in range(2):
+        write_series(tmp_path / "dicoms" / str(i), num_instances=3)
+    tasks = TaskTemplate(Dcm2Niix(compress="y", append_args=["--terse"]))
+    for i in range(2):
+        for level in (None, 9):
+            overrides = {"compression_level": level} if level else {}
+            argv = tasks.argv(
+                tmp_path / "dicoms" / str(i), tmp_path / "out" / str(i), **overrides
+            )
+            task = Dcm2Niix(
+                in_dir=tmp_path / "dicoms" / str(i),
+                out_dir=tmp_path / "out" / str(i),
+                compress="y",
+                append_args=["--terse"],
+                **overrides,
+            )
+            assert argv == shlex.split(task.cmdline)
+    # Rendered once per set of overrides
+    assert len(tasks._commands) == 2
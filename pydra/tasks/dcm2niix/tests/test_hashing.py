@@ -0,0 +1,95 @@
+import pytest
+from pydra.compose.base import Task
+from pydra.utils.hash import hash_function
+from fileformats.medimage import DicomDir
+from pydra.tasks.dcm2niix.hashing import (
+    HeaderDigestMemo,
+    dicom_header_digests,
+    set_hashing_mode,
+    stat_dicom_files,
+)
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+
+def test_header_hashing(tmp_path, monkeypatch):
+    monkeypatch.setenv("PYDRA_HASH_CACHE", str(tmp_path / "hash-cache"))
+    opened = []
+    init = HeaderDigestMemo.__init__
+
+    def counting_init(self, path):
+        opened.append(path)
+        init(self, path)
+
+    monkeypatch.setattr(HeaderDigestMemo, "__init__", counting_init)
+    write_series(tmp_path / "dicoms", num_instances=3)
+    dicom_dir = DicomDir(tmp_path / "dicoms")
+    content_hash = hash_function(dicom_dir)
+    task = Dcm2Niix(in_dir=dicom_dir, search_depth=0)
+    task_hash, _ = task._compute_hashes()
+    set_hashing_mode("header")
+    try:
+        # Only the 'in_dir' of Dcm2Niix tasks is hashed by its headers
+        assert hash_function(dicom_dir) == content_hash
+        header_hash, _ = task._compute_hashes()
+        assert header_hash != task_hash
+        assert Dcm2Niix(in_dir=dicom_dir, search_depth=0)._compute_hashes()[0] == (
+            header_hash
+        )
+        # Files below the search depth of the task aren't hashed
+        write_series(tmp_path / "dicoms" / "sub", num_instances=1, prefix="sub")
+        assert Dcm2Niix(in_dir=dicom_dir, search_depth=0)._compute_hashes()[0] == (
+            header_hash
+        )
+        # Adding an instance changes the hash
+        write_series(tmp_path / "dicoms", num_instances=1, prefix="new")
+        assert Dcm2Niix(in_dir=dicom_dir, search_depth=0)._compute_hashes()[0] != (
+            header_hash
+        )
+    finally:
+        set_hashing_mode("content")
+    # The memo is opened once per process
+    assert len(opened) == 1
+
+
+def test_header_digest_memo(tmp_path, monkeypatch):
+    paths = write_series(tmp_path / "dicoms", num_instances=3)
+    memo = HeaderDigestMemo(tmp_path / "memo.sqlite")
+    digests = dicom_header_digests(tmp_path / "dicoms", memo=memo)
+    assert len(set(digests)) == 3
+    assert len(memo.lookup(tmp_path / "dicoms")) == 3
+    assert memo.lookup(tmp_path / "dicom") == {}
+
+    # Memoised digests are reused for unchanged files without reading them
+    def fail(*args):
+        raise AssertionError("header read")
+
+    monkeypatch.setattr("pydra.tasks.dcm2niix.hashing.header_digest", fail)
+    assert dicom_header_digests(tmp_path / "dicoms", memo=memo) == digests
+    paths[0].write_bytes(paths[0].read_bytes() + b"\0\0")
+    stats = stat_dicom_files(tmp_path / "dicoms")
+    monkeypatch.undo()
+    new_digests = dicom_header_digests(tmp_path / "dicoms", stats, memo=memo)
+    assert new_digests[1:] == digests[1:]
+    assert new_digests[0] != digests[0]
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"store_comments": True},
+        {"filename": "%p_%s", "compress": "y", "compression_level": 9},
+        {"compress": "n", "bids": "n", "search_depth": 0},
+        {"name_conflicts": 0, "terse": True, "ignore_derived": "y"},
+        {"append_args": ["-l", "n"], "executable": ["dcm2niix", "-v", "0"]},
+        {"file_postfix": "e2", "anonymize_bids": "n", "only": 1},
+    ],
+)
+def test_task_hashes(tmp_path, kwargs):
+    write_series(tmp_path / "dicoms", num_instances=3)
+    task = Dcm2Niix(in_dir=tmp_path / "dicoms", out_dir=tmp_path / "out", **kwargs)
+    # Dcm2Niix overrides pydra's private Task._compute_hashes, so the memoised
+    # hashes must match those computed by the pinned version of pydra
+    assert task._compute_hashes() == Task._compute_hashes(task)
+    assert task._compute_hashes() == Task._compute_hashes(task)
@@ -0,0 +1,91 @@
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import pytest
+from pydra.tasks.dcm2niix.cache import ConversionCache
+from pydra.tasks.dcm2niix.convert import convert
+from pydra.tasks.dcm2niix.metrics import RunMetrics, run_process
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+def test_convert_metrics(tmp_path, monkeypatch):
+    metrics_file = tmp_path / "metrics.jsonl"
+    monkeypatch.setenv("PYDRA_DCM2NIIX_METRICS", str(metrics_file))
+    write_series(tmp_path / "dicoms", num_instances=3, rows=64, columns=64)
+    cache = ConversionCache(tmp_path / "cache")
+    for i in range(2):
+        convert(
+            Dcm2Niix(
+                in_dir=tmp_path / "dicoms",
+                out_dir=tmp_path / f"out{i}",
+                executable=STUB,
+            ),
+            cache=cache,
+        )
+    first, second = (json.loads(ln) for ln in metrics_file.read_text().splitlines())
+    assert list(first["phases"]) == [
+        "command",
+        "hash",
+        "cache",
+        "dcm2niix",
+        "index",
+        "collect",
+    ]
+    assert first["in_dir"] == str(tmp_path / "dicoms")
+    assert not first["cached"]
+    assert first["child"]["max_rss"] > 0
+    assert first["child"]["user_time"] > 0
+    # The NIfTI image alone is 64 * 64 * 3 * 2 bytes
+    assert first["child"]["write_bytes"] >= 64 * 64 * 3 * 2
+    assert second["cached"]
+    assert second["child"] is None
+    assert "dcm2niix" not in second["phases"]
+
+
+def test_run_process():
+    return_code, stdout, stderr, usage = run_process(
+        [sys.executable, "-c", "import sys; print('out'); sys.exit(3)"]
+    )
+    assert return_code == 3
+    assert stdout.strip() == b"out"
+    assert usage.max_rss > 0
+
+
+def test_run_process_timeout():
+    with pytest.raises(subprocess.TimeoutExpired):
+        run_process([sys.executable, "-c", "import time; time.sleep(10)"], timeout=0.5)
+
+
+def test_run_process_callback_error():
+    pids = []
+
+    def on_stdout_line(line):
+        pids.append(int(line))
+        raise ValueError("bad line")
+
+    with pytest.raises(ValueError, match="bad line"):
+        run_process(
+            [
+                sys.executable,
+                "-c",
+                "import os, time; print(os.getpid(), flush=True); time.sleep(10)",
+            ],
+            on_stdout_line=on_stdout_line,
+        )
+    # The process has been killed and reaped
+    with pytest.raises(ChildProcessError):
+        os.waitpid(pids[0], os.WNOHANG)
+
+
+def test_phase_accumulates():
+    metrics = RunMetrics()
+    for _ in range(2):
+        with metrics.phase("collect"):
+            sum(range(10_000))
+    assert list(metrics.phases) == ["collect"]
+    assert metrics.phases["collect"].wall > 0
@@ -0,0 +1,261 @@
+import gzip
+import itertools
+import pytest
+from fileformats.medimage import NiftiGz
+from pydra.tasks.dcm2niix.outputs import (
+    OutputFiles,
+    OutputIndex,
+    clash_suffixes,
+    merge_outputs,
+    output_index,
+    parse_manifest,
+    split_ext,
+)
+from pydra.tasks.dcm2niix.tests.stub_dcm2niix import nifti_image
+from pydra.tasks.dcm2niix.utils import (
+    OUTPUT_FORMATS,
+    Dcm2Niix,
+    collect_outputs,
+    dcm2niix_out_file,
+    dcm2niix_out_files,
+    dcm2niix_out_json,
+    dcm2niix_out_postfixes,
+    get_out_file,
+)
+
+
+def touch_outputs(out_dir, *names):
+    for name in names:
+        if name.endswith(".gz"):
+            (out_dir / name).write_bytes(gzip.compress(b"x"))
+        else:
+            (out_dir / name).write_text("{}")
+
+
+def test_split_ext():
+    assert split_ext("out_file_e2.nii.gz") == ("out_file_e2", ".nii.gz")
+    assert split_ext("out_file.json") == ("out_file", ".json")
+    assert split_ext("notes") == ("notes", "")
+
+
+def test_output_index(tmp_path):
+    touch_outputs(
+        tmp_path,
+        "out_file_e1.nii.gz",
+        "out_file_e1.json",
+        "out_file_e2.nii.gz",
+        "out_file_e2.json",
+        "other.nii.gz",
+    )
+    (tmp_path / "out_file_dir").mkdir()
+    index = OutputIndex.scan(tmp_path)
+    assert len(index) == 5
+    assert index.get("out_file_e2", ".nii.gz") == tmp_path / "out_file_e2.nii.gz"
+    assert index.get("out_file", ".nii.gz") is None
+    assert [p.name for p in index.with_prefix("out_file")] == [
+        "out_file_e1.json",
+        "out_file_e1.nii.gz",
+        "out_file_e2.json",
+        "out_file_e2.nii.gz",
+    ]
+    assert index.postfixes("out_file") == {
+        "_e1": {
+            ".json": tmp_path / "out_file_e1.json",
+            ".nii.gz": tmp_path / "out_file_e1.nii.gz",
+        },
+        "_e2": {
+            ".json": tmp_path / "out_file_e2.json",
+            ".nii.gz": tmp_path / "out_file_e2.nii.gz",
+        },
+    }
+
+
+def test_merge_outputs_clashes(tmp_path):
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    touch_outputs(
+        out_dir, "t1.nii", *(f"t1{c}.nii" for c in "abcdefghijklmnopqrstuvwxyz")
+    )
+    series_dir = tmp_path / "series"
+    series_dir.mkdir()
+    touch_outputs(series_dir, "t1.nii", "t1.json")
+    # Clashes beyond 'z' are resolved with multiple letters, as dcm2niix does
+    names = merge_outputs([(series_dir, ["t1.nii", "t1.json"])], out_dir, 2)
+    assert names == ["t1aa.nii", "t1aa.json"]
+    assert list(itertools.islice(clash_suffixes(), 25, 29)) == ["z", "aa", "ab", "ac"]
+
+
+def test_output_index_shared_per_task(tmp_path):
+    touch_outputs(tmp_path, "out_file.nii.gz")
+    cache_dir = tmp_path / "cache"
+    assert output_index(tmp_path, cache_dir) is output_index(tmp_path, cache_dir)
+    assert output_index(tmp_path, cache_dir) is not output_index(tmp_path, "other")
+    # Separate runs of the task are told apart by their stdout
+    assert output_index(tmp_path, cache_dir, "run 1") is not output_index(
+        tmp_path, cache_dir, "run 2"
+    )
+    # Without a cache directory, runs are told apart by their stdout alone
+    assert output_index(tmp_path, stdout="run 1") is output_index(
+        tmp_path, stdout="run 1"
+    )
+    assert output_index(tmp_path, stdout="run 1") is not output_index(
+        tmp_path, stdout="run 2"
+    )
+
+
+def test_out_callables(tmp_path):
+    touch_outputs(tmp_path, "out_file_e1.nii.gz", "out_file_e1.json", "stale.txt")
+    cache_dir = tmp_path / "cache"
+    # Only a single NIfTI was written so it is returned despite the missing postfix
+    out_file = dcm2niix_out_file(tmp_path, "out_file", None, "y", cache_dir, "")
+    assert isinstance(out_file, NiftiGz)
+    assert out_file.fspath == tmp_path / "out_file_e1.nii.gz"
+    assert dcm2niix_out_json(tmp_path, "out_file", "_e1", "y", cache_dir, "")
+    assert dcm2niix_out_json(tmp_path, "out_file", None, "y", cache_dir, "") is None
+    assert dcm2niix_out_json(tmp_path, "out_file", "_e1", "n", cache_dir, "") is None
+    assert sorted(dcm2niix_out_files(tmp_path, "out_file", cache_dir, "")) == [
+        str(tmp_path / "out_file_e1.json"),
+        str(tmp_path / "out_file_e1.nii.gz"),
+    ]
+
+
+def test_parse_manifest():
+    stdout = (
+        "Chris Rorden's dcm2niiX version v1.0.20240202\n"
+        "Found 352 DICOM file(s)\n"
+        "Convert 176 DICOM as /data/out (x)/out_file_e1 (256x256x176x1)\n"
+        "Convert 176 DICOM as /data/out (x)/out_file_e2 (256x256x176x1)\n"
+        "Conversion required 1.234 seconds (1.2 for core code).\n"
+    )
+    assert parse_manifest(stdout) == (
+        "/data/out (x)/out_file_e1",
+        "/data/out (x)/out_file_e2",
+    )
+
+
+def test_out_files_from_manifest(tmp_path):
+    # Leftovers of a previous run sharing the output directory
+    touch_outputs(tmp_path, "out_file_e1.nii.gz", "out_file_e1.json")
+    touch_outputs(tmp_path, "out_file_e2.nii.gz", "out_file_e2.json")
+    stdout = f"Convert 10 DICOM as {tmp_path}/out_file_e2 (64x64x10x1)\n"
+    cache_dir = tmp_path / "cache"
+    assert dcm2niix_out_files(tmp_path, "out_file", cache_dir, stdout) == [
+        str(tmp_path / "out_file_e2.json"),
+        str(tmp_path / "out_file_e2.nii.gz"),
+    ]
+    out_file = dcm2niix_out_file(tmp_path, "out_file", None, "y", cache_dir, stdout)
+    assert out_file.fspath == tmp_path / "out_file_e2.nii.gz"
+    # Falls back to scanning the directory if the manifest doesn't match the outputs
+    stdout = f"Convert 10 DICOM as {tmp_path}/out_file (64x64x10x1)\n"
+    assert len(dcm2niix_out_files(tmp_path, "out_file", cache_dir, stdout)) == 4
+
+
+def test_output_index_relative_manifest(tmp_path, monkeypatch):
+    (tmp_path / "out").mkdir()
+    touch_outputs(tmp_path / "out", "out_file.nii", "out_file.json")
+    # Relative paths are resolved against the output directory, not the CWD
+    monkeypatch.chdir(tmp_path)
+    index = OutputIndex.from_manifest(tmp_path / "out", ["out_file"])
+    assert sorted(index.with_prefix("")) == [
+        tmp_path / "out" / "out_file.json",
+        tmp_path / "out" / "out_file.nii",
+    ]
+
+
+def test_get_out_file_ambiguous(tmp_path):
+    touch_outputs(tmp_path, "out_file_e1.nii.gz", "out_file_e2.nii.gz")
+    with pytest.raises(ValueError, match="Did not find expected file"):
+        get_out_file(tmp_path, NiftiGz, "out_file", None, required=True)
+
+
+def test_out_postfixes(tmp_path):
+    touch_outputs(
+        tmp_path,
+        "out_file_e1.nii.gz",
+        "out_file_e1.json",
+        "out_file_e2.nii.gz",
+        "out_file_e2.json",
+        "out_file_e2_ph.nii.gz",
+        "out_file_e2_ph.nii.gz.idx",
+        "out_file_e2_ph.json",
+        "out_file_ROI1.txt",
+    )
+    index = OutputIndex.scan(tmp_path)
+    bundles = index.bundles("out_file")
+    assert list(bundles) == ["_ROI1", "_e1", "_e2", "_e2_ph"]
+    assert bundles["_e2_ph"].image == tmp_path / "out_file_e2_ph.nii.gz"
+    assert bundles["_e2_ph"].json == tmp_path / "out_file_e2_ph.json"
+    assert bundles["_e2_ph"].bval is None
+    assert bundles["_e2_ph"].postfix.echo == 2
+    assert bundles["_e2_ph"].postfix.phase
+    assert bundles["_ROI1"].image is None
+    assert bundles["_ROI1"].postfix.roi == 1
+    # Files in formats that aren't returned by the task are left out of the output
+    postfixes = dcm2niix_out_postfixes(tmp_path, "out_file", tmp_path / "cache", "")
+    assert postfixes == {
+        "_ROI1": [],
+        "_e1": [
+            str(tmp_path / "out_file_e1.json"),
+            str(tmp_path / "out_file_e1.nii.gz"),
+        ],
+        "_e2": [
+            str(tmp_path / "out_file_e2.json"),
+            str(tmp_path / "out_file_e2.nii.gz"),
+        ],
+        "_e2_ph": [
+            str(tmp_path / "out_file_e2_ph.json"),
+            str(tmp_path / "out_file_e2_ph.nii.gz"),
+        ],
+    }
+
+
+def test_output_files_volume_order(tmp_path):
+    # More volumes than the zero-padding of their indices can hold
+    names = [f"out_file_{i:05d}.nii" for i in (1, 2, 10, 100000)]
+    names += ["out_file.json", "out_file_i2.nii", "out_file_i10.nii", "out_file_e1.nii"]
+    files = OutputFiles(tmp_path, reversed(names))
+    assert len(files) == 8
+    assert files.names == [
+        "out_file.json",
+        "out_file_00001.nii",
+        "out_file_00002.nii",
+        "out_file_00010.nii",
+        "out_file_100000.nii",
+        "out_file_e1.nii",
+        "out_file_i2.nii",
+        "out_file_i10.nii",
+    ]
+    assert list(files.volumes) == [-1, 1, 2, 10, 100000, -1, 2, 10]
+    assert files[1] == tmp_path / "out_file_00001.nii"
+    assert files[-1] == tmp_path / "out_file_i10.nii"
+    assert files[1:3] == [
+        tmp_path / "out_file_00001.nii",
+        tmp_path / "out_file_00002.nii",
+    ]
+    assert files.volume(10) == [
+        tmp_path / "out_file_00010.nii",
+        tmp_path / "out_file_i10.nii",
+    ]
+    with pytest.raises(IndexError):
+        files[8]
+
+
+def test_collect_outputs_split(tmp_path):
+    image = nifti_image(4, 4, 4)
+    for i in range(1, 13):
+        (tmp_path / f"out_file_{i:05d}.nii").write_bytes(image)
+    (tmp_path / "out_file.json").write_text("{}")
+    index = OutputIndex.scan(tmp_path)
+    task = Dcm2Niix(out_dir=tmp_path, file_postfix="_00001", compress="3")
+    outputs = collect_outputs(task, index)
+    assert outputs.out_file.fspath == tmp_path / "out_file_00001.nii"
+    assert [f.fspath.name for f in outputs.out_files][:3] == [
+        "out_file.json",
+        "out_file_00001.nii",
+        "out_file_00002.nii",
+    ]
+    assert outputs.out_files[-1].fspath == tmp_path / "out_file_00012.nii"
+    # Each file is created (and validated) once, and shared between the outputs
+    files = index.out_files("out_file")
+    assert files.filesets(OUTPUT_FORMATS) is files.filesets(OUTPUT_FORMATS)
+    assert outputs.out_postfixes["_00012"][0] is files.filesets(OUTPUT_FORMATS)[-1]
@@ -0,0 +1,41 @@
+from pathlib import Path
+import sys
+from pydra.tasks.dcm2niix.parallel import convert_series_parallel
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+def test_convert_series_parallel(tmp_path):
+    for series_number in range(1, 5):
+        write_series(
+            tmp_path / "dicoms",
+            num_instances=2,
+            series_number=series_number,
+        )
+    outputs = convert_series_parallel(
+        Dcm2Niix(
+            in_dir=tmp_path / "dicoms",
+            out_dir=tmp_path / "out",
+            compress="y",
+            executable=STUB,
+        ),
+        max_workers=4,
+    )
+    # Clashing names are disambiguated in series order, as dcm2niix does
+    assert sorted(Path(p).name for p in outputs.out_files) == [
+        "out_file.json",
+        "out_file.nii.gz",
+        "out_filea.json",
+        "out_filea.nii.gz",
+        "out_fileb.json",
+        "out_fileb.nii.gz",
+        "out_filec.json",
+        "out_filec.nii.gz",
+    ]
+    assert outputs.out_file.fspath == tmp_path / "out" / "out_file.nii.gz"
+    assert outputs.stdout.count("Convert 2 DICOM") == 4
+    assert sorted(p.name for p in (tmp_path / "out").iterdir()) == sorted(
+        Path(p).name for p in outputs.out_files
+    )
@@ -0,0 +1,118 @@
+from pathlib import Path
+import sys
+import pytest
+from pydra.tasks.dcm2niix.convert import run
+from pydra.tasks.dcm2niix.planning import plan_outputs
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+@pytest.fixture
+def session(tmp_path):
+    in_dir = tmp_path / "session"
+    write_series(in_dir, num_instances=2, series_number=1, protocol_name="t1 mprage")
+    write_series(in_dir, num_instances=2, series_number=2, num_echoes=3)
+    write_series(in_dir, num_instances=2, series_number=3, phase=True)
+    write_series(
+        in_dir,
+        num_instances=2,
+        series_number=4,
+        image_type=["DERIVED", "SECONDARY", "M"],
+    )
+    return in_dir
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        {},
+        {"filename": "%p_%s"},
+        # Specifiers are case-insensitive
+        {"filename": "%P_%S_%E"},
+        {"filename": "%f/%i_%d_%s", "compress": "y"},
+        {"filename": "%s_%e", "bids": "o"},
+        {"filename": "%x_%z_%n", "bids": "n", "ignore_derived": "y"},
+        {"filename": "%s", "terse": True},
+    ],
+)
+def test_plan_matches_run(tmp_path, session, args):
+    task = Dcm2Niix(in_dir=session, out_dir=tmp_path / "out", executable=STUB, **args)
+    plan = plan_outputs(task)
+    assert plan.exact
+    result = run(task)
+    check = plan.check(result.index)
+    assert check.ok, check
+    assert sorted(plan.names) == sorted(result.names)
+
+
+def test_plan_folder_per_series(tmp_path):
+    in_dir = tmp_path / "session"
+    write_series(in_dir, num_instances=2, series_number=1)
+    write_series(in_dir / "anat", num_instances=2, series_number=2)
+    write_series(in_dir / "func" / "run 1", num_instances=2, series_number=3)
+    task = Dcm2Niix(
+        in_dir=in_dir, out_dir=tmp_path / "out", filename="%f_%s", executable=STUB
+    )
+    plan = plan_outputs(task)
+    # '%f' is the folder holding the files of each series, not the input directory
+    assert [i.stem for i in plan.images] == ["session_1", "anat_2", "run_1_3"]
+    result = run(task)
+    assert plan.check(result.index).ok
+    assert sorted(plan.names) == sorted(result.names)
+
+
+def test_plan_special_characters(tmp_path):
+    in_dir = tmp_path / "session"
+    write_series(
+        in_dir, num_instances=2, series_number=1, protocol_name="t1+mprage (1.0mm)"
+    )
+    write_series(in_dir, num_instances=2, series_number=2, protocol_name='a<b>:"c|?*^')
+    task = Dcm2Niix(
+        in_dir=in_dir, out_dir=tmp_path / "out", filename="%p", executable=STUB
+    )
+    plan = plan_outputs(task)
+    # Only the characters dcm2niix doesn't allow in filenames are replaced
+    assert [i.stem for i in plan.images] == ["t1+mprage_(1.0mm)", "a_b___c____"]
+    result = run(task)
+    assert plan.check(result.index).ok
+
+
+def test_plan_clashes(tmp_path, session):
+    task = Dcm2Niix(
+        in_dir=session, out_dir=tmp_path / "out", filename="%p", executable=STUB
+    )
+    run(task)
+    # The outputs of the second run clash with those of the first
+    plan = plan_outputs(task)
+    assert "protocol2_e1a.json" in plan
+    result = run(task)
+    assert plan.check(result.index).ok
+    assert sorted(plan.names) == sorted(result.names)
+    # Clashing outputs are skipped
+    skip = Dcm2Niix(
+        in_dir=session, out_dir=tmp_path / "out", filename="%p", name_conflicts=0
+    )
+    assert len(plan_outputs(skip)) == 0
+
+
+def test_plan_check(tmp_path, session):
+    task = Dcm2Niix(in_dir=session, out_dir=tmp_path / "out", filename="%s")
+    plan = plan_outputs(task)
+    names = list(plan.names)
+    assert names[:2] == ["1.nii", "1.json"]
+    assert plan.input_bytes > 0
+    check = plan.check(names[1:] + ["1.bval", "1.bvec", "stray.txt"])
+    assert check.missing == ["1.nii"]
+    assert check.extra == ["1.bval", "1.bvec"]
+    assert check.unexpected == ["stray.txt"]
+    assert not check.ok
+
+
+def test_plan_inexact(tmp_path, session):
+    task = Dcm2Niix(in_dir=session, out_dir=tmp_path / "out", compress="3")
+    assert not plan_outputs(task).exact
+    task = Dcm2Niix(in_dir=session, out_dir=tmp_path / "out", filename="%p_%t")
+    with pytest.raises(ValueError, match="'%t'"):
+        plan_outputs(task)
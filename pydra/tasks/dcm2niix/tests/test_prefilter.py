@@ -0,0 +1,97 @@
+from pathlib import Path
+import sys
+import pydicom
+from pydicom.dataset import FileMetaDataset
+from pydicom.uid import BasicTextSRStorage, ExplicitVRLittleEndian, generate_uid
+from pydra.tasks.dcm2niix.catalog import load_catalog
+from pydra.tasks.dcm2niix.convert import run
+from pydra.tasks.dcm2niix.prefilter import DicomFilter
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+def write_report(path: Path) -> None:
+    ds = pydicom.Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = BasicTextSRStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = sop_uid = generate_uid()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.SOPClassUID = BasicTextSRStorage
+    ds.SOPInstanceUID = sop_uid
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SeriesNumber = 99
+    ds.Modality = "SR"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pydicom.dcmwrite(path, ds, enforce_file_format=True)
+
+
+def write_session(in_dir: Path) -> None:
+    write_series(in_dir, num_instances=2, series_number=1)
+    write_series(
+        in_dir / "derived",
+        num_instances=2,
+        series_number=2,
+        image_type=["DERIVED", "SECONDARY", "ADC"],
+    )
+    # A series that mixes original and derived instances
+    series_uid = generate_uid()
+    write_series(
+        in_dir / "mixed", num_instances=2, series_number=3, series_uid=series_uid
+    )
+    write_series(
+        in_dir / "mixed",
+        num_instances=1,
+        series_number=3,
+        series_uid=series_uid,
+        prefix="derived_",
+        image_type=["DERIVED", "PRIMARY", "M"],
+    )
+    write_report(in_dir / "report" / "sr.dcm")
+
+
+def test_select(tmp_path):
+    write_session(tmp_path / "dicoms")
+    (tmp_path / "dicoms" / "notes.txt").write_text("not a DICOM")
+    catalog = load_catalog(tmp_path / "dicoms")
+    dicom_filter = DicomFilter()
+    selected, excluded = dicom_filter.select(catalog)
+    assert len(selected) == 7
+    assert excluded == {"non_dicom": 1, "non_image": 1}
+    selected, excluded = dicom_filter.select(catalog, exclude_derived=True)
+    assert sorted(selected) == [
+        "001_00001.dcm",
+        "001_00002.dcm",
+        "mixed/003_00001.dcm",
+        "mixed/003_00002.dcm",
+    ]
+    assert excluded == {"non_dicom": 1, "non_image": 1, "derived": 3}
+
+
+def test_run_prefiltered(tmp_path):
+    in_dir = tmp_path / "dicoms"
+    write_session(in_dir)
+    result = run(
+        Dcm2Niix(
+            in_dir=in_dir,
+            out_dir=tmp_path / "out",
+            filename="%f_%s",
+            ignore_derived="y",
+            executable=STUB,
+        ),
+        prefilter=DicomFilter(root=tmp_path / "scratch"),
+    )
+    # The outputs are named by the folders holding the series as without the filter
+    assert sorted(result.names) == [
+        "dicoms_1.json",
+        "dicoms_1.nii",
+        "mixed_3.json",
+        "mixed_3.nii",
+    ]
+    assert "Found 4 DICOM file(s)" in result.stdout
+    assert result.metrics.excluded == {"non_image": 1, "derived": 3}
+    assert "filter" in result.metrics.phases
+    # The links are removed once the conversion has run
+    assert not list((tmp_path / "scratch").iterdir())
@@ -0,0 +1,119 @@
+from pathlib import Path
+import sys
+import pydicom
+import pytest
+from pydra.tasks.dcm2niix.receiver import StorageReceiver
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+pynetdicom = pytest.importorskip("pynetdicom")
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+def send(port, paths, abort=False):
+    from pynetdicom.sop_class import MRImageStorage
+
+    ae = pynetdicom.AE(ae_title="TESTSCU")
+    ae.add_requested_context(MRImageStorage)
+    assoc = ae.associate("127.0.0.1", port, ae_title="DCM2NIIX")
+    assert assoc.is_established
+    try:
+        for path in paths:
+            status = assoc.send_c_store(pydicom.dcmread(path))
+            assert status.Status == 0x0000
+    finally:
+        if abort:
+            assoc.abort()
+        else:
+            assoc.release()
+
+
+@pytest.mark.parametrize("handoff", ["association", "series"])
+def test_storage_receiver(tmp_path, handoff):
+    first = write_series(tmp_path / "sent", num_instances=3, series_number=1)
+    second = write_series(tmp_path / "sent", num_instances=2, series_number=2)
+    with StorageReceiver(
+        tmp_path / "staging",
+        tmp_path / "out",
+        template=Dcm2Niix(executable=STUB, compress="y"),
+        port=0,
+        handoff=handoff,
+        quiet_period=0.2,
+        retain_period=0,
+    ) as receiver:
+        send(receiver.bound_port, first + second)
+        results = receiver.results(timeout=30)
+        converted = {r.series.series_uid: r for r in (next(results), next(results))}
+    assert list(receiver.results()) == []
+    for paths in (first, second):
+        uid = pydicom.dcmread(paths[0]).SeriesInstanceUID
+        result = converted[uid]
+        assert result.ok, result.error
+        assert len(result.series.instances) == len(paths)
+        assert result.outputs.out_file.fspath == (
+            tmp_path / "out" / uid / "out_file.nii.gz"
+        )
+    # The staged instances are removed once converted and retained
+    assert sorted(p.name for p in (tmp_path / "staging").iterdir()) == [
+        ".handoff",
+        ".incoming",
+    ]
+    assert list((tmp_path / "staging" / ".handoff").iterdir()) == []
+    assert list((tmp_path / "staging" / ".incoming").iterdir()) == []
+
+
+def test_storage_receiver_late_and_aborted(tmp_path):
+    paths = write_series(tmp_path / "sent", num_instances=3, series_uid="1.2.3")
+    with StorageReceiver(
+        tmp_path / "staging",
+        tmp_path / "out",
+        template=Dcm2Niix(executable=STUB),
+        port=0,
+        quiet_period=0.2,
+    ) as receiver:
+        results = receiver.results(timeout=30)
+        # A series sent over an aborted association is converted once it times out
+        send(receiver.bound_port, paths[:1], abort=True)
+        result = next(results)
+        assert result.ok, result.error
+        assert len(result.series.instances) == 1
+        # Late instances are converted along with the earlier ones, replacing the
+        # outputs of the earlier conversion
+        send(receiver.bound_port, paths[1:])
+        result = next(results)
+        assert result.ok, result.error
+        assert len(result.series.instances) == 3
+        assert "Convert 3 DICOM" in result.outputs.stdout
+    assert sorted(p.name for p in (tmp_path / "out" / "1.2.3").iterdir()) == [
+        "out_file.json",
+        "out_file.nii",
+    ]
+
+
+def test_storage_receiver_overlapping_handoffs(tmp_path, monkeypatch):
+    # Slow the conversions down so that the series is handed off again while its
+    # first conversion is in flight
+    monkeypatch.setenv("STUB_DCM2NIIX_DELAY", "1")
+    paths = write_series(tmp_path / "sent", num_instances=3, series_uid="1.2.3")
+    with StorageReceiver(
+        tmp_path / "staging",
+        tmp_path / "out",
+        template=Dcm2Niix(executable=STUB),
+        port=0,
+        max_workers=4,
+    ) as receiver:
+        for path in paths:
+            send(receiver.bound_port, [path])
+        results = receiver.results(timeout=30)
+        # The hand-offs are converted one at a time, the second being superseded by
+        # the third while the first is converted, the result of which is dropped
+        result = next(results)
+        assert result.ok, result.error
+        assert len(result.series.instances) == 3
+        assert "Convert 3 DICOM" in result.outputs.stdout
+    assert list(receiver.results()) == []
+    assert sorted(p.name for p in (tmp_path / "out" / "1.2.3").iterdir()) == [
+        "out_file.json",
+        "out_file.nii",
+    ]
@@ -0,0 +1,82 @@
+from pathlib import Path
+import sys
+from pydra.tasks.dcm2niix.convert import convert
+from pydra.tasks.dcm2niix.sidecars import SidecarExtractor, link_dirs
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix, dcm2niix_out_file
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+def test_convert_metadata_only(tmp_path):
+    write_series(tmp_path / "dicoms", num_instances=3)
+    outputs = convert(
+        Dcm2Niix(
+            in_dir=tmp_path / "dicoms",
+            out_dir=tmp_path / "out",
+            bids="o",
+            executable=STUB,
+        )
+    )
+    assert outputs.out_file is None
+    assert outputs.out_json.fspath == tmp_path / "out" / "out_file.json"
+    assert [p.name for p in (tmp_path / "out").iterdir()] == ["out_file.json"]
+    # The output callable doesn't look for an image either
+    out_file = dcm2niix_out_file(
+        tmp_path / "out", "out_file", None, None, tmp_path / "cache", "", bids="o"
+    )
+    assert out_file is None
+
+
+def test_extract_sidecars(tmp_path, monkeypatch):
+    log = tmp_path / "stub.log"
+    monkeypatch.setenv("STUB_DCM2NIIX_LOG", str(log))
+    in_dirs = []
+    for i in range(5):
+        write_series(
+            tmp_path / "dicoms" / f"sub{i}",
+            num_instances=2,
+            series_number=i + 1,
+            series_uid=f"1.2.3.{i}",
+            num_echoes=2 if i == 0 else 1,
+        )
+        in_dirs.append(tmp_path / "dicoms" / f"sub{i}")
+    scratch = tmp_path / "scratch"
+    extractor = SidecarExtractor(
+        Dcm2Niix(executable=STUB, filename="%j", anonymize_bids="n"),
+        batch_size=2,
+        scratch_dir=scratch,
+    )
+    batches = sorted(extractor.extract(iter(in_dirs)), key=lambda b: b.in_dirs)
+    assert all(b.ok for b in batches), [b.error for b in batches]
+    assert [b.in_dirs for b in batches] == [in_dirs[:2], in_dirs[2:4], in_dirs[4:]]
+    assert sorted(batches[0].sidecars) == ["1.2.3.0_e1", "1.2.3.0_e2", "1.2.3.1"]
+    assert batches[2].sidecars["1.2.3.4"]["SeriesInstanceUID"] == "1.2.3.4"
+    assert batches[2].sidecars["1.2.3.4"]["SeriesNumber"] == 5
+    # One invocation per batch, searching one level deeper to reach into the links
+    invocations = log.read_text().splitlines()
+    assert len(invocations) == 3
+    assert all("-b o" in i and "-d 6" in i for i in invocations)
+    # Nothing is left behind
+    assert list(scratch.iterdir()) == []
+
+
+def test_extract_sidecars_failed_batch(tmp_path):
+    extractor = SidecarExtractor(
+        Dcm2Niix(executable=[sys.executable, "-c", "import sys; sys.exit(3)"]),
+        scratch_dir=tmp_path / "scratch",
+    )
+    write_series(tmp_path / "dicoms", num_instances=2)
+    (batch,) = extractor.extract([tmp_path / "dicoms"])
+    assert not batch.ok
+    assert "return code 3" in str(batch.error)
+    assert batch.sidecars == {}
+
+
+def test_link_dirs(tmp_path):
+    in_dirs = [tmp_path / str(i) for i in range(12)]
+    for d in in_dirs:
+        d.mkdir()
+    links = link_dirs(tmp_path / "batch", in_dirs)
+    assert [p.name for p in links[:2]] == ["00", "01"]
+    assert [p.resolve() for p in links] == in_dirs
@@ -0,0 +1,139 @@
+import os
+from pathlib import Path
+import subprocess
+import sys
+import pytest
+from pydra.tasks.dcm2niix.batch import Dcm2NiixBatch
+from pydra.tasks.dcm2niix.convert import convert, run
+from pydra.tasks.dcm2niix.staging import Staging, filesystem_type
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+@pytest.mark.parametrize("copy_input", [True, False])
+def test_convert_staged(tmp_path, copy_input):
+    log = tmp_path / "stub.log"
+    write_series(tmp_path / "dicoms", num_instances=3)
+    scratch = tmp_path / "scratch"
+    result = run(
+        Dcm2Niix(
+            in_dir=tmp_path / "dicoms",
+            out_dir=tmp_path / "out",
+            executable=STUB,
+        ),
+        staging=Staging(scratch, copy_input=copy_input),
+    )
+    outputs = result.outputs()
+    assert outputs.out_file.fspath == tmp_path / "out" / "out_file.nii"
+    assert outputs.out_json.fspath == tmp_path / "out" / "out_file.json"
+    assert list(result.metrics.phases) == [
+        "command",
+        "stage",
+        "dcm2niix",
+        "index",
+        "commit",
+        "collect",
+    ]
+    # The scratch space is cleaned up and no hidden commit directories are left
+    assert list(scratch.iterdir()) == []
+    assert sorted(p.name for p in (tmp_path / "out").iterdir()) == [
+        "out_file.json",
+        "out_file.nii",
+    ]
+
+
+def test_stage_symlinked_dirs(tmp_path):
+    in_dir = tmp_path / "dicoms"
+    write_series(tmp_path / "elsewhere", num_instances=2)
+    in_dir.mkdir()
+    (in_dir / "linked").symlink_to(tmp_path / "elsewhere", target_is_directory=True)
+    # A link cycle is only followed down to the search depth
+    (in_dir / "cycle").symlink_to(in_dir, target_is_directory=True)
+    staged = Staging(tmp_path / "scratch", copy_input=True).stage(in_dir, 2)
+    try:
+        assert len(list((staged.in_dir / "linked").iterdir())) == 2
+        assert len(list((staged.in_dir / "cycle" / "linked").iterdir())) == 2
+        assert not (staged.in_dir / "cycle" / "cycle").exists()
+    finally:
+        staged.cleanup()
+
+
+def test_convert_staged_name_conflicts(tmp_path, monkeypatch):
+    monkeypatch.setenv("PYDRA_DCM2NIIX_SCRATCH", str(tmp_path / "scratch"))
+    write_series(tmp_path / "dicoms", num_instances=3)
+    task = Dcm2Niix(
+        in_dir=tmp_path / "dicoms", out_dir=tmp_path / "out", executable=STUB
+    )
+    convert(task, staging=Staging())
+    # The existing outputs are disambiguated as dcm2niix would in place
+    outputs = convert(task, staging=Staging())
+    assert outputs.out_file.name == "out_filea.nii"
+    assert sorted(p.name for p in outputs.out_files) == [
+        "out_filea.json",
+        "out_filea.nii",
+    ]
+
+
+def test_convert_staged_timeout(tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_DCM2NIIX_DELAY", "10")
+    write_series(tmp_path / "dicoms", num_instances=3)
+    scratch = tmp_path / "scratch"
+    with pytest.raises(subprocess.TimeoutExpired):
+        run(
+            Dcm2Niix(
+                in_dir=tmp_path / "dicoms",
+                out_dir=tmp_path / "out",
+                executable=STUB,
+            ),
+            timeout=0.5,
+            staging=Staging(scratch, copy_input=True),
+        )
+    assert list(scratch.iterdir()) == []
+    assert list((tmp_path / "out").iterdir()) == []
+
+
+def test_batch_staged(tmp_path):
+    for i in range(3):
+        write_series(tmp_path / "dicoms" / str(i), num_instances=3)
+    scratch = tmp_path / "scratch"
+    batch = Dcm2NiixBatch(
+        Dcm2Niix(executable=STUB, compress="y"),
+        staging=Staging(scratch, copy_input=True),
+    )
+    results = list(
+        batch.run(
+            (tmp_path / "dicoms" / str(i), tmp_path / "out" / str(i)) for i in range(3)
+        )
+    )
+    assert all(r.ok for r in results), [r.error for r in results]
+    for i in range(3):
+        assert (tmp_path / "out" / str(i) / "out_file.nii.gz").exists()
+    assert list(scratch.iterdir()) == []
+
+
+def test_filesystem_type():
+    assert filesystem_type("/") is not None or sys.platform != "linux"
+
+
+def test_remove_stale_dirs(tmp_path):
+    write_series(tmp_path / "dicoms", num_instances=3)
+    out_dir = tmp_path / "out"
+    # Left behind by killed jobs, one long ago and one that may still be running
+    (out_dir / ".dcm2niix-stale").mkdir(parents=True)
+    (out_dir / ".dcm2niix-stale" / "out_file.nii").write_text("partial")
+    os.utime(out_dir / ".dcm2niix-stale", (0, 0))
+    (out_dir / ".dcm2niix-recent").mkdir()
+    (out_dir / ".hidden").mkdir()
+    os.utime(out_dir / ".hidden", (0, 0))
+    convert(
+        Dcm2Niix(in_dir=tmp_path / "dicoms", out_dir=out_dir, executable=STUB),
+        staging=Staging(tmp_path / "scratch", stale_age=3600),
+    )
+    assert sorted(p.name for p in out_dir.iterdir()) == [
+        ".dcm2niix-recent",
+        ".hidden",
+        "out_file.json",
+        "out_file.nii",
+    ]
@@ -0,0 +1,151 @@
+import os
+from pathlib import Path
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import attrs
+import pytest
+from pydra.tasks.dcm2niix.state import ConversionState, convert_incremental
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+def test_convert_incremental(tmp_path):
+    in_dir = tmp_path / "dicoms"
+    for series_number in range(1, 3):
+        write_series(in_dir, num_instances=2, series_number=series_number)
+    state = ConversionState(tmp_path / "state.sqlite")
+    task = Dcm2Niix(
+        in_dir=in_dir,
+        out_dir=tmp_path / "out",
+        filename="%s",
+        executable=STUB,
+    )
+    result = convert_incremental(task, state)
+    assert len(result.converted) == 2
+    assert not result.up_to_date
+    assert sorted(Path(p).name for p in result.outputs.out_files) == [
+        "1.json",
+        "1.nii",
+        "2.json",
+        "2.nii",
+    ]
+
+    # Re-running converts nothing and returns the outputs from the store
+    result = convert_incremental(task, state)
+    assert not result.converted
+    assert len(result.up_to_date) == 2
+    assert len(result.outputs.out_files) == 4
+
+    # Only a new series is converted
+    write_series(in_dir, num_instances=2, series_number=3)
+    result = convert_incremental(task, state)
+    assert len(result.converted) == 1
+    assert sorted(Path(p).name for p in result.outputs.out_files) == [
+        "1.json",
+        "1.nii",
+        "2.json",
+        "2.nii",
+        "3.json",
+        "3.nii",
+    ]
+
+    # A series whose files have changed is reconverted, replacing its outputs
+    changed = next(in_dir.rglob("*.dcm"))
+    st = changed.stat()
+    os.utime(changed, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    result = convert_incremental(task, state)
+    assert len(result.converted) == 1
+    assert len(result.up_to_date) == 2
+    assert sorted(p.name for p in (tmp_path / "out").iterdir()) == [
+        "1.json",
+        "1.nii",
+        "2.json",
+        "2.nii",
+        "3.json",
+        "3.nii",
+    ]
+
+    # A series whose outputs have been removed is reconverted
+    (tmp_path / "out" / "2.nii").unlink()
+    result = convert_incremental(task, state)
+    assert len(result.converted) == 1
+    assert (tmp_path / "out" / "2.nii").exists()
+
+
+def test_convert_incremental_concurrent(tmp_path, monkeypatch):
+    log = tmp_path / "stub.log"
+    monkeypatch.setenv("STUB_DCM2NIIX_LOG", str(log))
+    monkeypatch.setenv("STUB_DCM2NIIX_DELAY", "0.5")
+    write_series(tmp_path / "dicoms", num_instances=2)
+    task = Dcm2Niix(
+        in_dir=tmp_path / "dicoms", out_dir=tmp_path / "out", executable=STUB
+    )
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [
+            pool.submit(convert_incremental, task, ConversionState(tmp_path / "db"))
+            for _ in range(2)
+        ]
+        results = [f.result() for f in futures]
+    # The second run waits for the first to record its conversion, so the series is
+    # only converted once, and not disambiguated from its own outputs
+    assert len(log.read_text().splitlines()) == 1
+    assert sorted(len(r.converted) for r in results) == [0, 1]
+    assert sorted(p.name for p in (tmp_path / "out").iterdir()) == [
+        "out_file.json",
+        "out_file.nii",
+    ]
+
+
+def test_convert_incremental_args_changed(tmp_path):
+    in_dir = tmp_path / "dicoms"
+    for series_number in range(1, 3):
+        write_series(in_dir, num_instances=2, series_number=series_number)
+    state = ConversionState(tmp_path / "state.sqlite")
+    task = Dcm2Niix(
+        in_dir=in_dir,
+        out_dir=tmp_path / "out",
+        filename="%s",
+        executable=STUB,
+    )
+    convert_incremental(task, state)
+    result = convert_incremental(attrs.evolve(task, compress="y"), state)
+    assert len(result.converted) == 2
+    assert sorted(p.name for p in (tmp_path / "out").iterdir()) == [
+        "1.json",
+        "1.nii.gz",
+        "2.json",
+        "2.nii.gz",
+    ]
+    # Arguments that don't affect the conversion don't invalidate it
+    result = convert_incremental(attrs.evolve(task, compress="y", verbose="y"), state)
+    assert not result.converted
+
+
+def test_convert_incremental_failure_keeps_outputs(tmp_path, monkeypatch):
+    in_dir = tmp_path / "dicoms"
+    paths = write_series(in_dir, num_instances=2, series_number=1)
+    state = ConversionState(tmp_path / "state.sqlite")
+    task = Dcm2Niix(
+        in_dir=in_dir,
+        out_dir=tmp_path / "out",
+        filename="%s",
+        executable=STUB,
+    )
+    convert_incremental(task, state)
+    st = paths[0].stat()
+    os.utime(paths[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def fail(task, **kwargs):
+        raise RuntimeError("dcm2niix failed")
+
+    monkeypatch.setattr("pydra.tasks.dcm2niix.state.run", fail)
+    with pytest.raises(RuntimeError, match="dcm2niix failed"):
+        convert_incremental(task, state)
+    # The outputs of the previous conversion are kept if the reconversion fails
+    assert sorted(p.name for p in (tmp_path / "out").iterdir()) == ["1.json", "1.nii"]
+    monkeypatch.undo()
+    result = convert_incremental(task, state)
+    assert len(result.converted) == 1
+    assert sorted(p.name for p in (tmp_path / "out").iterdir()) == ["1.json", "1.nii"]
@@ -0,0 +1,34 @@
+from pathlib import Path
+import shlex
+import subprocess
+import sys
+from pydra.tasks.dcm2niix.tests.synthetic import write_session
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+def test_stub_naming(tmp_path):
+    write_session(tmp_path / "dicoms", num_series=4, num_instances=2, rows=8, columns=8)
+    task = Dcm2Niix(
+        in_dir=tmp_path / "dicoms",
+        out_dir=tmp_path / "out",
+        filename="%p_%s",
+        executable=STUB,
+    )
+    (tmp_path / "out").mkdir()
+    subprocess.run(shlex.split(task.cmdline), check=True, stdout=subprocess.PIPE)
+    assert sorted(p.stem for p in (tmp_path / "out").glob("*.nii")) == [
+        "derived_5",
+        "gre_3_e1",
+        "gre_3_e2",
+        "gre_3_e3",
+        "gre_ph_4_e1_ph",
+        "gre_ph_4_e2_ph",
+        "gre_ph_4_e3_ph",
+        "localizer_1",
+        "t1w_2",
+    ]
+    # Clashing names have a letter appended
+    subprocess.run(shlex.split(task.cmdline), check=True, stdout=subprocess.PIPE)
+    assert (tmp_path / "out" / "t1w_2a.nii").exists()
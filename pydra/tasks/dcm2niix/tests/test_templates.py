@@ -0,0 +1,173 @@
+from pathlib import Path
+import sys
+import pytest
+from fileformats.medimage import NiftiGz
+from pydra.tasks.dcm2niix.convert import run
+from pydra.tasks.dcm2niix.outputs import OutputIndex
+from pydra.tasks.dcm2niix.templates import Postfix, compile_template, parse_postfix
+from pydra.tasks.dcm2niix.tests.synthetic import write_series, write_session
+from pydra.tasks.dcm2niix.utils import Dcm2Niix, get_out_file
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+@pytest.mark.parametrize(
+    "stem,series,fields,postfix",
+    [
+        ("gre_5", "gre_5", {"protocol": "gre", "series_number": "5"}, ""),
+        ("gre_5_e2_ph", "gre_5", {"protocol": "gre", "series_number": "5"}, "_e2_ph"),
+        # Separators within free-text fields are kept
+        (
+            "gre_2echo_5",
+            "gre_2echo_5",
+            {"protocol": "gre_2echo", "series_number": "5"},
+            "",
+        ),
+        # Clash letters distinguish series
+        ("gre_5_e1a", "gre_5a", {"protocol": "gre", "series_number": "5"}, "_e1a"),
+        ("gre_5_e1ab", "gre_5ab", {"protocol": "gre", "series_number": "5"}, "_e1ab"),
+    ],
+)
+def test_match(stem, series, fields, postfix):
+    match = compile_template("%p_%s").match(stem)
+    assert match.series == series
+    assert match.fields == fields
+    assert match.postfix == postfix
+
+
+def test_match_upper_case():
+    # dcm2niix accepts specifiers in either case
+    match = compile_template("%P_%S").match("gre_5_e2")
+    assert match.fields == {"protocol": "gre", "series_number": "5"}
+    assert match.postfix == "_e2"
+    assert compile_template("%P_%S").match("gre_x") is None
+
+
+def test_match_mismatch():
+    template = compile_template("%p_%s")
+    assert template.match("gre_x") is None
+    assert template.match("gre") is None
+    # Fields don't span sub-directories
+    assert compile_template("%s/%p").match("5/anat/t1w") is None
+    assert compile_template("%s/%p").match("5/t1w").fields == {
+        "series_number": "5",
+        "protocol": "t1w",
+    }
+
+
+@pytest.mark.parametrize(
+    "postfix,expected",
+    [
+        ("", Postfix()),
+        ("_e2_ph", Postfix(echo=2, phase=True)),
+        ("_c3_i00001", Postfix(coil=3, image=1)),
+        ("_real_e3", Postfix(echo=3, real=True)),
+        ("_phMag", Postfix(flags=("phMag",))),
+        ("_ROI2", Postfix(roi=2)),
+        ("_e1a", Postfix(echo=1, clash="a")),
+        ("_e1ab", Postfix(echo=1, clash="ab")),
+        ("_pha", Postfix(phase=True, clash="a")),
+        ("b", Postfix(clash="b")),
+        ("_stale", None),
+    ],
+)
+def test_parse_postfix(postfix, expected):
+    assert parse_postfix(postfix) == expected
+
+
+def test_compile_cached():
+    assert compile_template("%p_%s") is compile_template("%p_%s")
+
+
+def test_index_series(tmp_path):
+    index = OutputIndex(
+        tmp_path,
+        [
+            "t1w_2.nii.gz",
+            "t1w_2.json",
+            "gre_3_e1.nii.gz",
+            "gre_3_e1.json",
+            "gre_3_e2.nii.gz",
+            "gre_3_e2.json",
+            "gre_3_e2.nii.gz.idx",
+            "notes.txt",
+        ],
+    )
+    series = index.series("%p_%s")
+    assert list(series) == ["gre_3", "t1w_2"]
+    assert series["gre_3"].protocol == "gre"
+    assert series["gre_3"].series_number == 3
+    assert series["gre_3"].files == {
+        "_e1": {
+            ".json": tmp_path / "gre_3_e1.json",
+            ".nii.gz": tmp_path / "gre_3_e1.nii.gz",
+        },
+        "_e2": {
+            ".json": tmp_path / "gre_3_e2.json",
+            ".nii.gz": tmp_path / "gre_3_e2.nii.gz",
+        },
+    }
+    assert [p.name for p in index.out_files("%p_%s")] == [
+        "gre_3_e1.json",
+        "gre_3_e1.nii.gz",
+        "gre_3_e2.json",
+        "gre_3_e2.nii.gz",
+        "t1w_2.json",
+        "t1w_2.nii.gz",
+    ]
+    # The file is only resolved when a single series was converted
+    assert get_out_file(tmp_path, NiftiGz, "%p_%s", "", True, index=index) is None
+
+
+def test_convert_templated(tmp_path):
+    write_session(tmp_path / "dicoms", num_series=4, rows=4, columns=4)
+    result = run(
+        Dcm2Niix(
+            in_dir=tmp_path / "dicoms",
+            out_dir=tmp_path / "out",
+            filename="%p_%s",
+            executable=STUB,
+        )
+    )
+    series = result.series()
+    assert sorted(series) == ["derived_5", "gre_3", "gre_ph_4", "localizer_1", "t1w_2"]
+    assert series["gre_ph_4"].protocol == "gre_ph"
+    assert sorted(series["gre_ph_4"].files) == ["_e1_ph", "_e2_ph", "_e3_ph"]
+    outputs = result.outputs()
+    assert outputs.out_file is None
+    assert len(outputs.out_files) == 2 * (3 + 3 + 3)
+
+
+def test_convert_templated_single_series(tmp_path):
+    write_series(tmp_path / "dicoms", num_instances=3, series_number=7)
+    outputs = run(
+        Dcm2Niix(
+            in_dir=tmp_path / "dicoms",
+            out_dir=tmp_path / "out",
+            filename="%p_%s",
+            executable=STUB,
+        )
+    ).outputs()
+    assert outputs.out_file.name == "protocol7_7.nii"
+    assert outputs.out_json.name == "protocol7_7.json"
+
+
+def test_convert_bundles(tmp_path):
+    write_series(tmp_path / "dicoms", num_instances=3, num_echoes=2, phase=True)
+    result = run(
+        Dcm2Niix(
+            in_dir=tmp_path / "dicoms",
+            out_dir=tmp_path / "out",
+            file_postfix="_e1_ph",
+            executable=STUB,
+        )
+    )
+    assert {k: b.postfix for k, b in result.bundles().items()} == {
+        "_e1_ph": Postfix(echo=1, phase=True),
+        "_e2_ph": Postfix(echo=2, phase=True),
+    }
+    outputs = result.outputs()
+    assert [f.name for f in outputs.out_postfixes["_e2_ph"]] == [
+        "out_file_e2_ph.json",
+        "out_file_e2_ph.nii",
+    ]
@@ -0,0 +1,205 @@
+import json
+from pathlib import Path
+import sys
+import threading
+import pytest
+from pydra.tasks.dcm2niix.batch import Dcm2NiixBatch
+from pydra.tasks.dcm2niix.convert import convert
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.tuning import (
+    Calibration,
+    CompressionTuner,
+    LevelRate,
+    filesystem_key,
+    image_like_sample,
+)
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+def calibration(write_rate: float) -> Calibration:
+    # Each level is half the speed of the previous for a slightly better ratio
+    return Calibration(
+        write_rate=write_rate,
+        levels={
+            level: LevelRate(rate=400e6 / 2 ** (level - 1), ratio=0.5 - level / 100)
+            for level in range(1, 10)
+        },
+    )
+
+
+def test_estimate():
+    cal = calibration(write_rate=100e6)
+    # Uncompressed images are limited by the write bandwidth
+    assert cal.estimate("n") == pytest.approx(1 / 100e6)
+    # Compressing internally is serial with writing
+    assert cal.estimate("i", 1) == pytest.approx(1 / 400e6 + 0.49 / 100e6)
+    # Piping to pigz is limited by the slower of compression and writing
+    assert cal.estimate("o", 1, cpus=8) == pytest.approx(0.49 / 100e6)
+
+
+@pytest.mark.parametrize(
+    "write_rate,pigz,expected",
+    [
+        # Fast local disk: compressing isn't worth it on a single thread
+        (2e9, False, ("n", None)),
+        # Slow network storage: compress, at the fastest level on a single thread
+        (10e6, False, ("i", 1)),
+        # With pigz the higher levels keep up with the network
+        (10e6, True, ("o", 7)),
+    ],
+)
+def test_choose_wall_time(tmp_path, write_rate, pigz, expected):
+    tuner = CompressionTuner(pigz=pigz, cpus=4, cache_file=tmp_path / "tuning.json")
+    tuner._calibrations[filesystem_key(tmp_path)] = calibration(write_rate)
+    choice = tuner.choose(tmp_path / "out")
+    assert (choice.compress, choice.level) == expected
+    assert choice.calibrated
+    assert choice.estimated_rate > 0
+
+
+def test_choose_bytes_written(tmp_path):
+    tuner = CompressionTuner(
+        policy="bytes_written", pigz=False, cache_file=tmp_path / "tuning.json"
+    )
+    choice = tuner.choose(tmp_path)
+    assert (choice.compress, choice.level) == ("i", 9)
+    assert not choice.calibrated
+    # No calibration is needed to minimise the bytes written
+    assert not (tmp_path / "tuning.json").exists()
+
+
+def test_unrecognised_policy():
+    with pytest.raises(ValueError, match="Unrecognised policy"):
+        CompressionTuner(policy="fastest")
+
+
+def test_calibration_cached(tmp_path, monkeypatch):
+    cache_file = tmp_path / "tuning.json"
+    calibrate = CompressionTuner.calibrate
+    calls = []
+
+    def counted_calibrate(self, directory, write_size=1024**2):
+        calls.append(directory)
+        return calibrate(self, directory, write_size=write_size)
+
+    monkeypatch.setattr(CompressionTuner, "calibrate", counted_calibrate)
+    first = CompressionTuner(cache_file=cache_file).calibration(tmp_path / "a" / "b")
+    assert len(calls) == 1
+    assert first.write_rate > 0
+    assert sorted(first.levels) == list(range(1, 10))
+    # Higher levels compress the sample at least as well as lower ones
+    assert first.levels[9].ratio <= first.levels[1].ratio < 1
+    # A new tuner (e.g. in another process) loads the calibration from the cache file
+    second = CompressionTuner(cache_file=cache_file).calibration(tmp_path)
+    assert len(calls) == 1
+    assert second == first
+    assert list(json.loads(cache_file.read_text())) == [filesystem_key(tmp_path)]
+    # No calibration files are left behind
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["tuning.json"]
+
+
+def test_calibration_expired(tmp_path, monkeypatch):
+    cache_file = tmp_path / "tuning.json"
+    stale = calibration(write_rate=10e6)
+    stale.calibrated -= 2 * 24 * 60 * 60
+    cache_file.write_text(json.dumps({filesystem_key(tmp_path): stale.to_dict()}))
+    monkeypatch.setattr(
+        CompressionTuner, "calibrate", lambda self, directory: calibration(2e9)
+    )
+    # A calibration within the maximum age is loaded from the cache file
+    tuner = CompressionTuner(cache_file=cache_file, max_age=3 * 24 * 60 * 60)
+    assert tuner.calibration(tmp_path) == stale
+    # An older one is run again and replaced in the cache file
+    tuner = CompressionTuner(cache_file=cache_file, max_age=24 * 60 * 60)
+    assert tuner.calibration(tmp_path).write_rate == 2e9
+    cached = json.loads(cache_file.read_text())
+    assert cached[filesystem_key(tmp_path)]["write_rate"] == 2e9
+
+
+def test_calibration_concurrent(tmp_path, monkeypatch):
+    # Treat each directory as a separate file-system
+    monkeypatch.setattr(
+        "pydra.tasks.dcm2niix.tuning.filesystem_key", lambda d: Path(d).name
+    )
+    (tmp_path / "slow").mkdir()
+    (tmp_path / "fast").mkdir()
+    release = threading.Event()
+    calls = []
+
+    def calibrate(self, directory):
+        calls.append(Path(directory).name)
+        if Path(directory).name == "slow":
+            assert release.wait(10)
+        return calibration(10e6)
+
+    monkeypatch.setattr(CompressionTuner, "calibrate", calibrate)
+    tuner = CompressionTuner(cache_file=tmp_path / "tuning.json")
+    threads = [
+        threading.Thread(target=tuner.calibration, args=(tmp_path / "slow",))
+        for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    # Calibrating one file-system doesn't hold up the calibration of another
+    tuner.calibration(tmp_path / "fast")
+    release.set()
+    for thread in threads:
+        thread.join()
+    # Each file-system is only calibrated once
+    assert sorted(calls) == ["fast", "slow"]
+
+
+def test_apply_split_untouched(tmp_path):
+    tuner = CompressionTuner(pigz=False, cache_file=tmp_path / "tuning.json")
+    task = Dcm2Niix(out_dir=tmp_path, compress="3")
+    # Splitting images into 3D volumes changes the files produced, so isn't tuned
+    assert tuner.apply(task) == (task, None)
+    assert not (tmp_path / "tuning.json").exists()
+
+
+def test_image_like_sample():
+    sample = image_like_sample(10_000)
+    assert len(sample) == 10_000
+    assert sample == image_like_sample(10_000)
+
+
+def test_convert_tuned(tmp_path):
+    metrics_file = tmp_path / "metrics.jsonl"
+    write_series(tmp_path / "dicoms", num_instances=3, rows=64, columns=64)
+    tuner = CompressionTuner(
+        policy="bytes_written", pigz=False, cache_file=tmp_path / "tuning.json"
+    )
+    outputs = convert(
+        Dcm2Niix(
+            in_dir=tmp_path / "dicoms",
+            out_dir=tmp_path / "out",
+            compress="n",
+            executable=STUB,
+        ),
+        tuner=tuner,
+        metrics_file=metrics_file,
+    )
+    assert outputs.out_file.name == "out_file.nii.gz"
+    metrics = json.loads(metrics_file.read_text())
+    assert metrics["compression"] == {
+        "compress": "i",
+        "level": 9,
+        "policy": "bytes_written",
+        "calibrated": False,
+        "estimated_rate": None,
+    }
+    assert list(metrics["phases"])[0] == "tune"
+
+
+def test_batch_tuned(tmp_path):
+    write_series(tmp_path / "dicoms", num_instances=3)
+    tuner = CompressionTuner(
+        policy="bytes_written", pigz=True, cache_file=tmp_path / "tuning.json"
+    )
+    batch = Dcm2NiixBatch(Dcm2Niix(executable=STUB), tuner=tuner)
+    (result,) = batch.run([(tmp_path / "dicoms", tmp_path / "out")])
+    assert result.ok, result.error
+    assert result.outputs.out_file.name == "out_file.nii.gz"
+    assert result.metrics.compression.compress == "o"
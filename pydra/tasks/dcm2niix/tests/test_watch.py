@@ -0,0 +1,180 @@
+from pathlib import Path
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import time
+import pytest
+from pydra.tasks.dcm2niix.tests.synthetic import write_series
+from pydra.tasks.dcm2niix.utils import Dcm2Niix
+from pydra.tasks.dcm2niix.watch import (
+    InotifySource,
+    PollingSource,
+    ArrivingSeries,
+    SeriesConversions,
+    SeriesResult,
+    SeriesTracker,
+    SeriesWatcher,
+    replace_dir,
+)
+
+STUB = [sys.executable, str(Path(__file__).parent / "stub_dcm2niix.py")]
+
+
+def test_series_tracker(tmp_path):
+    first = write_series(tmp_path / "landing", num_instances=3, series_number=1)
+    second = write_series(tmp_path / "landing", num_instances=2, series_number=2)
+    (tmp_path / "landing" / "notes.txt").write_text("not a DICOM")
+    tracker = SeriesTracker(quiet_period=10, expected_instances=lambda h: 3)
+    assert tracker.add(tmp_path / "landing" / "notes.txt", now=0) is None
+    for path in first[:2] + second:
+        tracker.add(path, now=0)
+    assert tracker.complete(now=1) == []
+    # Adding the last instance of the first series completes it
+    series = tracker.add(first[2], now=2)
+    assert series.expected == 3
+    assert tracker.complete(now=2) == [series]
+    # Recording a file again doesn't reopen the series
+    assert tracker.add(first[2], now=3) is None
+    # The second series is completed by the quiet period
+    (complete,) = tracker.complete(now=13)
+    assert complete.paths == sorted(second)
+    assert tracker.pending == []
+
+
+def test_polling_source(tmp_path):
+    (tmp_path / "landing").mkdir()
+    source = PollingSource(tmp_path / "landing", poll_interval=0)
+    paths = write_series(tmp_path / "landing", num_instances=2)
+    # Files are only reported once they are unchanged between scans
+    assert source.changes(0) == []
+    assert sorted(source.changes(0)) == paths
+    assert source.changes(0) == []
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="inotify is Linux only")
+def test_inotify_source(tmp_path):
+    existing = write_series(tmp_path / "landing", num_instances=2)
+    source = InotifySource(tmp_path / "landing")
+    try:
+        assert sorted(source.changes(0)) == existing
+        added = write_series(tmp_path / "landing" / "sub", num_instances=2, prefix="a")
+        changed = set(source.changes(1))
+        while not changed.issuperset(added):
+            new = source.changes(1)
+            assert new, changed
+            changed.update(new)
+    finally:
+        source.close()
+
+
+@pytest.mark.parametrize("use_inotify", [False, True])
+def test_series_watcher(tmp_path, use_inotify):
+    if use_inotify and sys.platform != "linux":
+        pytest.skip("inotify is Linux only")
+    (tmp_path / "landing").mkdir()
+    stop = threading.Event()
+    watcher = SeriesWatcher(
+        tmp_path / "landing",
+        tmp_path / "out",
+        template=Dcm2Niix(executable=STUB, compress="y"),
+        quiet_period=0.5,
+        poll_interval=0.05,
+        use_inotify=use_inotify,
+        scratch_dir=tmp_path / "scratch",
+    )
+    results = watcher.watch(stop)
+    paths = write_series(tmp_path / "landing", num_instances=3, series_uid="1.2.3")
+    start = time.monotonic()
+    result = next(results)
+    assert result.ok, result.error
+    assert time.monotonic() - start >= 0.5
+    assert result.series.paths == paths
+    assert result.outputs.out_file.fspath == (
+        tmp_path / "out" / "1.2.3" / "out_file.nii.gz"
+    )
+    stop.set()
+    assert list(results) == []
+    assert list((tmp_path / "scratch").iterdir()) == []
+
+
+def test_series_watcher_reconvert(tmp_path):
+    paths = write_series(tmp_path / "landing", num_instances=3, series_uid="1.2.3")
+    watcher = SeriesWatcher(
+        tmp_path / "landing",
+        tmp_path / "out",
+        template=Dcm2Niix(executable=STUB),
+        scratch_dir=tmp_path / "scratch",
+    )
+    series = ArrivingSeries("1.2.3", {str(i): p for i, p in enumerate(paths[:2])})
+    assert watcher.convert_series(series).ok
+    # The conversion including the late instance replaces the partial outputs
+    series.instances["2"] = paths[2]
+    result = watcher.convert_series(series)
+    assert result.ok, result.error
+    assert "Convert 3 DICOM" in result.outputs.stdout
+    assert sorted(p.name for p in (tmp_path / "out").iterdir()) == ["1.2.3"]
+    assert sorted(p.name for p in (tmp_path / "out" / "1.2.3").iterdir()) == [
+        "out_file.json",
+        "out_file.nii",
+    ]
+    assert result.outputs.out_file.fspath == tmp_path / "out" / "1.2.3" / "out_file.nii"
+
+
+def test_series_watcher_retention(tmp_path):
+    (tmp_path / "landing").mkdir()
+    stop = threading.Event()
+    watcher = SeriesWatcher(
+        tmp_path / "landing",
+        tmp_path / "out",
+        template=Dcm2Niix(executable=STUB),
+        quiet_period=0.2,
+        poll_interval=0.05,
+        use_inotify=False,
+        retain_period=0,
+    )
+    results = watcher.watch(stop)
+    write_series(tmp_path / "landing", num_instances=2, series_uid="1.2.3")
+    assert len(next(results).series.instances) == 2
+    # Once the series has been forgotten, a late instance starts a new series
+    write_series(
+        tmp_path / "landing", num_instances=1, series_uid="1.2.3", prefix="late"
+    )
+    assert len(next(results).series.instances) == 1
+    stop.set()
+    assert list(results) == []
+
+
+def test_series_conversions():
+    started = []
+    release = threading.Event()
+    results = []
+
+    def convert(series):
+        started.append(len(series.instances))
+        release.wait(10)
+        return SeriesResult(series)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        conversions = SeriesConversions(pool, convert, results.append)
+        for num_instances in range(1, 4):
+            conversions.submit(
+                ArrivingSeries("1.2.3", {str(i): Path() for i in range(num_instances)})
+            )
+        assert conversions.busy("1.2.3")
+        release.set()
+    # The conversions of the series are run one at a time, the second being
+    # superseded by the third before it starts, and the result of the first, which
+    # is superseded too, is dropped
+    assert started == [1, 3]
+    assert [len(r.series.instances) for r in results] == [3]
+    assert not conversions.busy("1.2.3")
+
+
+def test_replace_dir(tmp_path):
+    (tmp_path / "old").mkdir()
+    (tmp_path / "old" / "stale.nii").write_text("stale")
+    (tmp_path / "new").mkdir()
+    (tmp_path / "new" / "out_file.nii").write_text("new")
+    replace_dir(tmp_path / "new", tmp_path / "old")
+    assert [p.name for p in tmp_path.iterdir()] == ["old"]
+    assert [p.name for p in (tmp_path / "old").iterdir()] == ["out_file.nii"]
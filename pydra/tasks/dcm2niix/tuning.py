@@ -0,0 +1,479 @@
+"""Choosing the compression mode and level of conversions for the host they run on.
+
+Whether it is quicker for dcm2niix to write its images uncompressed, compress them
+itself ('-z i'), or pipe them through pigz ('-z o'), and at which level, depends on the
+number of cores, the bandwidth of the storage the images are written to (e.g. network
+storage rewards writing fewer bytes) and how compressible the images are.
+:class:`CompressionTuner` picks the mode and level for a conversion according to a
+policy:
+
+* 'wall_time' minimises the estimated time to compress and write the images, from a
+  short calibration run on the host, which measures the single-threaded deflate
+  throughput and ratio of each level on an image-like sample and the write bandwidth
+  of the file-system of the output directory. Calibrations are cached per host and
+  file-system (identified by its mount point, type and source, which unlike its device
+  number are stable across reboots) within the package's cache root, so are only run
+  again once they are older than the tuner's 'max_age'.
+* 'bytes_written' minimises the size of the written images, compressing them at the
+  highest level (with pigz if it is available), without calibration.
+
+When the images are compressed by a :class:`~pydra.tasks.dcm2niix.ParallelGzip` stage
+instead of dcm2niix, the stage compresses them at the chosen level. The chosen settings
+are recorded in the 'compression' field of the metrics of each run
+(see :mod:`pydra.tasks.dcm2niix.metrics`).
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+import random
+import shutil
+import socket
+import threading
+import time
+import typing as ty
+import zlib
+import attrs
+from .staging import find_mount
+from .utils import GZIP_MODES, cache_root
+
+if ty.TYPE_CHECKING:
+    from .utils import Dcm2Niix
+
+logger = logging.getLogger("pydra.tasks.dcm2niix")
+
+POLICIES = ("wall_time", "bytes_written")
+
+LEVELS = tuple(range(1, 10))
+
+DEFAULT_SAMPLE_SIZE = 4 * 1024**2
+
+DEFAULT_WRITE_SIZE = 32 * 1024**2
+
+# Values of 'compress' that only determine how the images are compressed, so can be
+# tuned, unlike '3', which also splits them into 3D volumes
+TUNABLE_MODES = (None, "n") + GZIP_MODES
+
+# Seconds after which a calibration is run again
+MAX_CALIBRATION_AGE = 30 * 24 * 60 * 60
+
+
+@attrs.define
+class LevelRate:
+    """The measured performance of a compression level
+
+    Parameters
+    ----------
+    rate : float
+        the single-threaded deflate throughput in uncompressed bytes per second
+    ratio : float
+        the compressed size as a fraction of the uncompressed size
+    """
+
+    rate: float
+    ratio: float
+
+
+@attrs.define
+class Calibration:
+    """The measured compression and write performance of a host and file-system
+
+    Parameters
+    ----------
+    write_rate : float
+        the bandwidth of writes to the file-system in bytes per second
+    levels : dict[int, LevelRate]
+        the throughput and ratio of each compression level
+    calibrated : float
+        the time the calibration was run, in seconds since the epoch
+    """
+
+    write_rate: float
+    levels: dict[int, LevelRate]
+    calibrated: float = attrs.field(factory=time.time)
+
+    def estimate(
+        self,
+        compress: str,
+        level: int | None = None,
+        cpus: int = 1,
+    ) -> float:
+        """Estimates the time taken to compress and write each byte of an image
+
+        Parameters
+        ----------
+        compress : str
+            the compression mode, 'n', 'i' or 'o'
+        level : int, optional
+            the compression level, required for compressed modes
+        cpus : int
+            the number of cores pigz can use
+
+        Returns
+        -------
+        float
+            the estimated seconds per uncompressed byte
+        """
+        if compress not in GZIP_MODES:
+            return 1 / self.write_rate
+        level_rate = self.levels[level or 6]
+        write = level_rate.ratio / self.write_rate
+        if compress == "i":
+            # Compressed in memory on a single thread before being written
+            return 1 / level_rate.rate + write
+        # Compression by pigz overlaps with writing its output
+        return max(1 / (level_rate.rate * cpus), write)
+
+    def to_dict(self) -> dict[str, ty.Any]:
+        return attrs.asdict(self)
+
+    @classmethod
+    def from_dict(cls, dct: dict[str, ty.Any]) -> "Calibration":
+        return cls(
+            write_rate=dct["write_rate"],
+            levels={int(k): LevelRate(**v) for k, v in dct["levels"].items()},
+            calibrated=dct["calibrated"],
+        )
+
+
+@attrs.define
+class CompressionChoice:
+    """The compression settings chosen for a conversion
+
+    Parameters
+    ----------
+    compress : str
+        the value of the task's 'compress' argument
+    level : int, optional
+        the value of the task's 'compression_level' argument
+    policy : str
+        the policy the settings were chosen by
+    calibrated : bool
+        whether the settings were chosen from a calibration of the host
+    estimated_rate : float, optional
+        the estimated throughput of compressing and writing the images in uncompressed
+        bytes per second, if calibrated
+    """
+
+    compress: str
+    level: int | None
+    policy: str
+    calibrated: bool = False
+    estimated_rate: float | None = None
+
+    def apply(self, task: "Dcm2Niix") -> "Dcm2Niix":
+        """Returns a copy of the task with the chosen settings, unless its 'compress'
+        mode can't be tuned"""
+        if task.compress not in TUNABLE_MODES or (
+            task.compress == self.compress and task.compression_level == self.level
+        ):
+            return task
+        return attrs.evolve(task, **self.overrides())
+
+    def overrides(self) -> dict[str, ty.Any]:
+        """The chosen settings as arguments of the task"""
+        return {"compress": self.compress, "compression_level": self.level}
+
+
+class CompressionTuner:
+    """Chooses the compression mode and level of conversions according to a policy
+
+    A tuner can be shared between concurrent conversions, and calibrates each
+    file-system that outputs are written to at most once.
+
+    Parameters
+    ----------
+    policy : str
+        'wall_time' to minimise the estimated time to compress and write the images,
+        or 'bytes_written' to minimise their size
+    cpus : int, optional
+        the number of cores available to pigz, by default the number of CPUs
+    pigz : bool, optional
+        whether dcm2niix can pipe its images to pigz, by default whether pigz is on
+        the PATH
+    sample : str or Path, optional
+        an image (e.g. the output of a previous conversion) to calibrate the
+        compression levels on, by default a synthetic image-like sample is used
+    cache_file : str or Path, optional
+        the file calibrations are cached in, by default
+        '<cache root>/tuning/<host>.json'
+    max_age : float, optional
+        the number of seconds after which a file-system is calibrated again, by
+        default 30 days, or None for calibrations never to expire
+    """
+
+    def __init__(
+        self,
+        policy: str = "wall_time",
+        cpus: int | None = None,
+        pigz: bool | None = None,
+        sample: str | Path | None = None,
+        cache_file: str | Path | None = None,
+        max_age: float | None = MAX_CALIBRATION_AGE,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unrecognised policy {policy!r}, not in {POLICIES}")
+        self.policy = policy
+        self.cpus = cpus or os.cpu_count() or 1
+        self.pigz = shutil.which("pigz") is not None if pigz is None else pigz
+        self.sample = Path(sample) if sample is not None else None
+        if cache_file is None:
+            cache_file = cache_root() / "tuning" / f"{socket.gethostname()}.json"
+        self.cache_file = Path(cache_file)
+        self.max_age = max_age
+        self._calibrations: dict[str, Calibration] = {}
+        # Set once the calibration of each file-system being calibrated has finished
+        self._calibrating: dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def choose(self, out_dir: str | Path) -> CompressionChoice:
+        """Chooses the compression settings for a conversion
+
+        Parameters
+        ----------
+        out_dir : str or Path
+            the directory the conversion writes to
+
+        Returns
+        -------
+        CompressionChoice
+            the chosen settings
+        """
+        gzip_mode = "o" if self.pigz else "i"
+        if self.policy == "bytes_written":
+            return CompressionChoice(gzip_mode, max(LEVELS), self.policy)
+        calibration = self.calibration(out_dir)
+        candidates = [("n", None)] + [(gzip_mode, level) for level in LEVELS]
+        estimates = {c: calibration.estimate(*c, cpus=self.cpus) for c in candidates}
+        (compress, level), estimate = min(estimates.items(), key=lambda i: i[1])
+        return CompressionChoice(
+            compress,
+            level,
+            self.policy,
+            calibrated=True,
+            estimated_rate=1 / estimate,
+        )
+
+    def apply(self, task: "Dcm2Niix") -> tuple["Dcm2Niix", CompressionChoice | None]:
+        """Chooses the compression settings for a task, which must have 'out_dir' set.
+        Tasks that split their images into 3D volumes ('compress' set to '3') are left
+        untouched, as the mode determines the files they produce
+
+        Parameters
+        ----------
+        task : Dcm2Niix
+            the task to choose the settings for
+
+        Returns
+        -------
+        task : Dcm2Niix
+            a copy of the task with the chosen settings
+        choice : CompressionChoice or None
+            the chosen settings, or None if the task's mode can't be tuned
+        """
+        if task.compress not in TUNABLE_MODES:
+            return task, None
+        choice = self.choose(task.out_dir)
+        return choice.apply(task), choice
+
+    def calibration(self, out_dir: str | Path) -> Calibration:
+        """Returns the calibration of the file-system of the output directory, loading
+        it from the cache file or running it if it hasn't been run on this host within
+        the maximum age
+
+        Parameters
+        ----------
+        out_dir : str or Path
+            the directory that outputs are written to, which doesn't need to exist yet
+
+        Returns
+        -------
+        Calibration
+            the calibration of the file-system
+        """
+        directory = _existing_ancestor(Path(out_dir).absolute())
+        key = filesystem_key(directory)
+        while True:
+            with self._lock:
+                calibration = self._calibrations.get(key)
+                if calibration is not None and self._current(calibration):
+                    return calibration
+                calibration = self._load(key)
+                if calibration is not None and self._current(calibration):
+                    self._calibrations[key] = calibration
+                    return calibration
+                # Calibrate outside of the lock, so that conversions to other
+                # file-systems aren't held up, but only once per file-system
+                calibrating = self._calibrating.get(key)
+                if calibrating is None:
+                    calibrating = self._calibrating[key] = threading.Event()
+                    break
+            # Wait for the calibration by another thread, then check whether it
+            # succeeded
+            calibrating.wait()
+        try:
+            calibration = self.calibrate(directory)
+            with self._lock:
+                # Re-read the cache file in case another process has calibrated a
+                # different file-system in the meantime
+                try:
+                    cached = json.loads(self.cache_file.read_text())
+                except (OSError, ValueError):
+                    cached = {}
+                cached[key] = calibration.to_dict()
+                self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+                tmp = self.cache_file.with_name(
+                    f".{self.cache_file.name}.{os.getpid()}.tmp"
+                )
+                tmp.write_text(json.dumps(cached, indent=2))
+                os.replace(tmp, self.cache_file)
+                self._calibrations[key] = calibration
+        finally:
+            with self._lock:
+                del self._calibrating[key]
+            calibrating.set()
+        return calibration
+
+    def _load(self, key: str) -> Calibration | None:
+        """Loads the calibration of a file-system from the cache file, if it is there"""
+        try:
+            cached = json.loads(self.cache_file.read_text())
+            return Calibration.from_dict(cached[key])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _current(self, calibration: Calibration) -> bool:
+        """Whether a calibration is within the maximum age"""
+        return (
+            self.max_age is None or time.time() - calibration.calibrated <= self.max_age
+        )
+
+    def calibrate(
+        self, directory: str | Path, write_size: int = DEFAULT_WRITE_SIZE
+    ) -> Calibration:
+        """Measures the compression throughput and ratio of each level and the write
+        bandwidth of a directory
+
+        Parameters
+        ----------
+        directory : str or Path
+            the directory to measure the write bandwidth of
+        write_size : int
+            the number of bytes to write to measure the bandwidth
+
+        Returns
+        -------
+        Calibration
+            the measurements
+        """
+        logger.info("Calibrating compression for writes to %s", directory)
+        if self.sample is not None:
+            with open(self.sample, "rb") as f:
+                sample = f.read(DEFAULT_SAMPLE_SIZE)
+        else:
+            sample = image_like_sample(DEFAULT_SAMPLE_SIZE)
+        levels = {}
+        for level in LEVELS:
+            start = time.perf_counter()
+            compressed = zlib.compress(sample, level)
+            elapsed = time.perf_counter() - start
+            levels[level] = LevelRate(
+                rate=len(sample) / max(elapsed, 1e-9),
+                ratio=len(compressed) / len(sample),
+            )
+        return Calibration(
+            write_rate=measure_write_rate(Path(directory), write_size),
+            levels=levels,
+        )
+
+
+def image_like_sample(size: int, seed: int = 0) -> bytes:
+    """Generates a sample of 16-bit voxel data that compresses similarly to MR images,
+    i.e. rows of noisy foreground values in the middle of an empty background
+
+    Parameters
+    ----------
+    size : int
+        the size of the sample in bytes
+    seed : int
+        the seed of the noise
+
+    Returns
+    -------
+    bytes
+        the sample
+    """
+    row = 512  # bytes, i.e. a row of 256 voxels
+    num_voxels = size // 2
+    # Foreground values are 0x03xx with 6 bits of noise in the low byte
+    noise = random.Random(seed).randbytes(num_voxels)
+    low = noise.translate(bytes(b & 0x3F for b in range(256)))
+    sample = bytearray(2 * num_voxels)
+    sample[0::2] = low
+    sample[1::2] = b"\x03" * num_voxels
+    # Blank the background at either end of each row
+    blank = bytes(row // 4)
+    for start in range(0, len(sample), row):
+        sample[start : start + row // 4] = blank
+        sample[start + 3 * row // 4 : start + row] = blank
+    return bytes(sample[:size])
+
+
+def measure_write_rate(directory: Path, size: int = DEFAULT_WRITE_SIZE) -> float:
+    """Measures the bandwidth of durable writes to a directory in bytes per second
+
+    Parameters
+    ----------
+    directory : Path
+        the directory to write to
+    size : int
+        the number of bytes to write
+
+    Returns
+    -------
+    float
+        the write bandwidth
+    """
+    chunk = os.urandom(min(size, 1024**2))
+    path = directory / f".dcm2niix-calibration.{os.getpid()}.tmp"
+    start = time.perf_counter()
+    try:
+        with open(path, "wb") as f:
+            written = 0
+            while written < size:
+                written += f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        elapsed = time.perf_counter() - start
+    finally:
+        path.unlink(missing_ok=True)
+    return written / max(elapsed, 1e-9)
+
+
+def filesystem_key(directory: str | Path) -> str:
+    """Identifies the file-system a directory is on by its mount point, type and
+    source, falling back to its device number where mounts can't be listed (e.g. not
+    on Linux)
+
+    Parameters
+    ----------
+    directory : str or Path
+        an existing directory
+
+    Returns
+    -------
+    str
+        the key of the file-system
+    """
+    mount = find_mount(directory)
+    if mount is None:
+        return f"dev:{os.stat(directory).st_dev}"
+    mount_point, fstype, source = mount
+    return f"{fstype}:{source}:{mount_point}"
+
+
+def _existing_ancestor(path: Path) -> Path:
+    while not path.exists():
+        path = path.parent
+    return path
@@ -1,11 +1,39 @@
+import functools
+import os
 from pathlib import Path
+import re
+import shutil
+import subprocess
 import typing as ty
 from fileformats.application import Json
 from fileformats.medimage import DicomDir, Nifti1, NiftiGz, Bvec, Bval
 from pydra.compose import shell
+from pydra.utils.general import user_cache_root
+from .hashing import task_hashes
+from .outputs import OutputIndex, output_index, split_ext
+from .templates import is_template
 
 FS = ty.TypeVar("FS", bound=Nifti1 | NiftiGz | Json | Bval | Bvec)
 
+CACHE_ROOT_ENV_VAR = "PYDRA_DCM2NIIX_CACHE"
+
+# Values of 'compress' that produce gzipped NIfTI images
+GZIP_MODES = ("y", "o", "i")
+
+# Formats of the files returned in the outputs of the task, by extension
+OUTPUT_FORMATS = {f.ext: f for f in (NiftiGz, Nifti1, Json, Bval, Bvec)}
+OUTPUT_EXTENSIONS = tuple(OUTPUT_FORMATS)
+
+
+def cache_root() -> Path:
+    """Returns the root directory of the caches kept by this package, which can be set
+    by the 'PYDRA_DCM2NIIX_CACHE' environment variable, otherwise is within pydra's
+    user cache directory"""
+    try:
+        return Path(os.environ[CACHE_ROOT_ENV_VAR])
+    except KeyError:
+        return user_cache_root / "dcm2niix"
+
 
 def get_out_file(
     out_dir: Path,
@@ -13,6 +41,7 @@ def get_out_file(
     filename: str,
     file_postfix: str | None,
     required: bool = False,
+    index: OutputIndex | None = None,
 ) -> FS | None:
     """Attempting to handle the different suffixes that are appended to filenames
     created by Dcm2niix (see https://github.com/rordenlab/dcm2niix/blob/master/FILENAMING.md)
@@ -20,24 +49,37 @@ def get_out_file(
 
     assert fileformat.ext, f"File format {fileformat} does not have an extension"
 
-    fpath = Path(out_dir) / (
-        filename + (file_postfix if file_postfix else "") + fileformat.ext
-    )
-    fpath = fpath.absolute()
+    if index is None:
+        index = OutputIndex.scan(out_dir)
+
+    if is_template(filename):
+        # The template is expanded differently for each series, so the file is only
+        # resolved if a single series was converted
+        matches = index.matches(filename)
+        if len({m.series for _, m in matches}) != 1:
+            return None
+        for path, match in matches:
+            if match.postfix == (file_postfix or "") and (
+                split_ext(path.name)[1] == fileformat.ext
+            ):
+                return fileformat(path)
+        return None
+
+    stem = filename + (file_postfix if file_postfix else "")
+    fpath = index.get(stem, fileformat.ext)
 
     # Check to see if multiple echos exist in the DICOM dataset
-    if fpath.exists():
+    if fpath is not None:
         fileset = fileformat(fpath)
     else:
         if required:
-            neighbours = [
-                p for p in fpath.parent.iterdir() if p.name.endswith(fileformat.ext)
-            ]
+            neighbours = index.with_ext(fileformat.ext)
             if len(neighbours) == 1:
-                fpath = neighbours[0]
+                fileset = fileformat(neighbours[0])
             else:
                 raise ValueError(
-                    f"\nDid not find expected file '{fpath}' (file_postfix={file_postfix}) "
+                    f"\nDid not find expected file '{index.path(stem + fileformat.ext)}' "
+                    f"(file_postfix={file_postfix}) "
                     "after DICOM -> NIfTI conversion, please see "
                     "https://github.com/rordenlab/dcm2niix/blob/master/FILENAMING.md for the "
                     "list of postfixes that dcm2niix produces and provide an appropriate "
@@ -51,50 +93,229 @@ def get_out_file(
     return fileset
 
 
+def nifti_format(compress: str | None) -> ty.Type[Nifti1 | NiftiGz]:
+    """Returns the format of the NIfTI images written with the given compression"""
+    return NiftiGz if compress in GZIP_MODES else Nifti1
+
+
 def dcm2niix_out_file(
-    out_dir: Path, filename: str, file_postfix: str, compress: str
-) -> Nifti1 | NiftiGz:
-    fileformat: ty.Type[Nifti1 | NiftiGz] = (
-        NiftiGz if compress in ("y", "o", "i") else Nifti1
+    out_dir: Path,
+    filename: str,
+    file_postfix: str,
+    compress: str,
+    cache_dir: Path,
+    stdout: str,
+    bids: str = "y",
+) -> Nifti1 | NiftiGz | None:
+    # No images are written in metadata-only mode
+    if bids == "o":
+        return None
+    return get_out_file(  # type: ignore[return-value]
+        out_dir,
+        nifti_format(compress),
+        filename,
+        file_postfix,
+        True,
+        index=output_index(out_dir, cache_dir, stdout),
     )
-    return get_out_file(out_dir, fileformat, filename, file_postfix, True)  # type: ignore[return-value]
 
 
 def dcm2niix_out_json(
-    out_dir: Path, filename: str, file_postfix: str, bids: str
+    out_dir: Path,
+    filename: str,
+    file_postfix: str,
+    bids: str,
+    cache_dir: Path,
+    stdout: str,
 ) -> Json | None:
     # Append echo number of NIfTI echo to select is provided
     if bids in ("y", "o"):
-        return get_out_file(out_dir, Json, filename, file_postfix)
+        return get_out_file(
+            out_dir,
+            Json,
+            filename,
+            file_postfix,
+            index=output_index(out_dir, cache_dir, stdout),
+        )
     return None
 
 
 def dcm2niix_out_bvec(
-    out_dir: Path, filename: str, file_postfix: str, bids: str
+    out_dir: Path,
+    filename: str,
+    file_postfix: str,
+    bids: str,
+    cache_dir: Path,
+    stdout: str,
 ) -> Bvec | None:
     # Append echo number of NIfTI echo to select is provided
     if bids in ("y", "o"):
-        return get_out_file(out_dir, Bvec, filename, file_postfix)
+        return get_out_file(
+            out_dir,
+            Bvec,
+            filename,
+            file_postfix,
+            index=output_index(out_dir, cache_dir, stdout),
+        )
     return None
 
 
 def dcm2niix_out_bval(
-    out_dir: Path, filename: str, file_postfix: str, bids: str
+    out_dir: Path,
+    filename: str,
+    file_postfix: str,
+    bids: str,
+    cache_dir: Path,
+    stdout: str,
 ) -> Bval | None:
     # Append echo number of NIfTI echo to select is provided
     if bids in ("y", "o"):
-        return get_out_file(out_dir, Bval, filename, file_postfix)
+        return get_out_file(
+            out_dir,
+            Bval,
+            filename,
+            file_postfix,
+            index=output_index(out_dir, cache_dir, stdout),
+        )
     return None
 
 
-def dcm2niix_out_files(out_dir: Path, filename: str) -> list[str]:
+def dcm2niix_out_files(
+    out_dir: Path, filename: str, cache_dir: Path, stdout: str
+) -> list[str]:
     return [
-        str(p.absolute())
-        for p in Path(out_dir).iterdir()
-        if p.name.startswith(filename)
+        str(p) for p in output_index(out_dir, cache_dir, stdout).out_files(filename)
     ]
 
 
+def dcm2niix_out_postfixes(
+    out_dir: Path, filename: str, cache_dir: Path, stdout: str
+) -> dict[str, list[str]]:
+    return postfix_bundles(output_index(out_dir, cache_dir, stdout), filename)
+
+
+def postfix_bundles(
+    index: OutputIndex,
+    filename: str,
+    filesets: ty.Mapping[Path, ty.Any] | None = None,
+) -> dict[str, list[ty.Any]]:
+    """Returns the files of each image produced with the filename, keyed by postfix,
+    restricted to the formats of the task's outputs, either as paths or, if provided,
+    as the already created fileformats objects of the files"""
+    return {
+        key: [
+            filesets[p] if filesets is not None else str(p)
+            for e, p in sorted(bundle.files.items())
+            if e in OUTPUT_EXTENSIONS
+        ]
+        for key, bundle in index.bundles(filename).items()
+    }
+
+
+def collect_outputs(
+    task: "Dcm2Niix",
+    index: OutputIndex,
+    return_code: int = 0,
+    stdout: str = "",
+    stderr: str = "",
+) -> "Dcm2Niix.Outputs":
+    """Collects the outputs of a Dcm2Niix task that has been run outside of pydra
+    (see :mod:`pydra.tasks.dcm2niix.convert`) from an index of the files it produced,
+    following the same rules as the output callables
+
+    Parameters
+    ----------
+    task : Dcm2Niix
+        the task that was run
+    index : OutputIndex
+        index of the files produced by the run
+    return_code : int
+        the exit code of the dcm2niix process
+    stdout : str
+        the captured stdout of the dcm2niix process
+    stderr : str
+        the captured stderr of the dcm2niix process
+
+    Returns
+    -------
+    Dcm2Niix.Outputs
+        the outputs of the task
+    """
+    sidecars = task.bids in ("y", "o")
+    # The files are created as fileformats objects once and shared between the
+    # outputs, as validating them dominates the cost of collecting large output sets
+    # (e.g. series split into one file per volume)
+    out_files = index.out_files(task.filename)
+    filesets = out_files.filesets(OUTPUT_FORMATS)
+
+    def sidecar(fileformat: ty.Type[FS]) -> FS | None:
+        if not sidecars:
+            return None
+        return get_out_file(
+            index.out_dir, fileformat, task.filename, task.file_postfix, index=index
+        )
+
+    return Dcm2Niix.Outputs(
+        out_file=(
+            get_out_file(
+                index.out_dir,
+                nifti_format(task.compress),
+                task.filename,
+                task.file_postfix,
+                True,
+                index=index,
+            )
+            if task.bids != "o"
+            else None
+        ),
+        out_json=sidecar(Json),
+        out_bval=sidecar(Bval),
+        out_bvec=sidecar(Bvec),
+        out_files=filesets,
+        out_postfixes=postfix_bundles(
+            index, task.filename, dict(zip(out_files, filesets))
+        ),
+        return_code=return_code,
+        stdout=stdout,
+        stderr=stderr,
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_version(executable: tuple[str, ...], mtime_ns: int) -> str:
+    proc = subprocess.run(
+        list(executable) + ["--version"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    match = re.search(r"v\d+\.\d+\.\d+\S*", proc.stdout)
+    return match.group(0) if match else proc.stdout.strip()
+
+
+def dcm2niix_version(executable: str | ty.Sequence[str] = "dcm2niix") -> str:
+    """Returns the version string reported by the dcm2niix executable, e.g.
+    'v1.0.20240202', which is cached until the executable is modified
+
+    Parameters
+    ----------
+    executable : str or sequence[str]
+        the dcm2niix executable (or command prefix) to query
+
+    Returns
+    -------
+    str
+        the version of dcm2niix
+    """
+    command = (executable,) if isinstance(executable, str) else tuple(executable)
+    resolved = shutil.which(command[-1]) or command[-1]
+    try:
+        mtime_ns = Path(resolved).stat().st_mtime_ns
+    except OSError:
+        mtime_ns = 0
+    return _cached_version(command, mtime_ns)
+
+
 @shell.define
 class Dcm2Niix(shell.Task["Dcm2Niix.Outputs"]):
     """
@@ -127,6 +348,7 @@ class Dcm2Niix(shell.Task["Dcm2Niix.Outputs"]):
     )
     file_postfix: str | None = shell.arg(
         default=None,
+        argstr=None,
         help=(
             "The postfix appended to the output filename. Used to select which "
             "of the disambiguated nifti files created by dcm2niix to return "
@@ -290,14 +512,24 @@ class Dcm2Niix(shell.Task["Dcm2Niix.Outputs"]):
     version: bool = shell.arg(default=False, argstr="--version", help="report version")
     xml: bool = shell.arg(default=False, argstr="--xml", help="Slicer format features")
 
+    def _compute_hashes(self) -> tuple[str, dict[str, str]]:
+        # Memoises the hashes of the arguments shared between tasks, which otherwise
+        # dominate the cost of hashing the tasks of large splits. NB: overrides a
+        # private method of pydra's Task, so the hashes are checked against pydra's
+        # own by test_task_hashes for the pinned range of pydra versions
+        return task_hashes(self)
+
     class Outputs(shell.Outputs):
-        out_file: Nifti1 | NiftiGz = shell.out(
+        out_file: Nifti1 | NiftiGz | None = shell.out(
             help=(
                 "output NIfTI image. If multiple nifti files are created (e.g. for "
                 "different echoes), then the 'file_postfix' input can be provided to "
                 "select which of them is considered the 'out_file'. Otherwise it "
                 "should be set to None and 'out_files' used instead (in which case "
-                "'out_file' will be set to attrs.NOTHING)",
+                "'out_file' will be set to attrs.NOTHING). If 'filename' is a "
+                "template (e.g. '%p_%s'), 'out_file' is only set if a single series "
+                "was converted. Not set if 'bids' is 'o' (metadata only), as no "
+                "images are written",
             ),
             callable=dcm2niix_out_file,
         )
@@ -320,7 +552,24 @@ class Dcm2Niix(shell.Task["Dcm2Niix.Outputs"]):
             help=(
                 "all output files in a list, including files disambiguated "
                 "by their suffixes (e.g. echoes, phase-maps, etc... see "
-                "https://github.com/rordenlab/dcm2niix/blob/master/FILENAMING.md"
+                "https://github.com/rordenlab/dcm2niix/blob/master/FILENAMING.md). "
+                "Where dcm2niix lists the series it converted in its stdout, only "
+                "the files written for them are included, otherwise all files in "
+                "'out_dir' starting with 'filename' (or matching it, if it is a "
+                "template) are returned"
             ),
             callable=dcm2niix_out_files,
         )
+        out_postfixes: dict[str, list[Nifti1 | NiftiGz | Json | Bval | Bvec]] = (
+            shell.out(
+                help=(
+                    "the output files grouped by the image they belong to, i.e. the "
+                    "NIfTI image and its JSON/bval/bvec sidecars, keyed by the postfix "
+                    "dcm2niix appended to tell the images apart (e.g. '_e2', '_ph', "
+                    "'_c3', '' for the undisambiguated image). If 'filename' is a "
+                    "template, the keys are the name of the series followed by the "
+                    "postfix"
+                ),
+                callable=dcm2niix_out_postfixes,
+            )
+        )
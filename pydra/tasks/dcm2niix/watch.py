@@ -0,0 +1,849 @@
+"""Converting series as they arrive in a landing directory.
+
+Scanners and PACS typically push DICOMs into a landing directory one file at a time, so
+a nightly sweep of the directory adds up to a day of latency, while converting it
+as files arrive risks converting partial series. A :class:`SeriesWatcher` follows the
+files written to the landing directory (with inotify on Linux, or by polling it
+otherwise), reads the header of each new file to track the instances that have arrived
+for each SeriesInstanceUID, and converts each series on its own as soon as it is
+complete. By default, a series is considered complete once no new instances have
+arrived for it for a quiet period, or, if an 'expected_instances' callable is provided,
+as soon as the number of instances it returns have arrived.
+
+The files of a series are linked into a scratch directory to be converted, so the
+landing directory is left untouched. Instances arriving for a series after it has
+been converted reopen it, and all of its instances are converted again once it is
+complete, replacing the outputs of its earlier conversion. The conversions of a series
+are run one at a time (see :class:`SeriesConversions`), so that an earlier conversion
+can't replace the outputs of a later one. A series is forgotten once a retention period
+has passed since it was last converted, after which any instances arriving for it are
+treated as a new series.
+"""
+
+from collections.abc import Callable, Iterator
+from concurrent.futures import Executor, ThreadPoolExecutor
+import ctypes
+import ctypes.util
+import errno
+import functools
+import logging
+import os
+from pathlib import Path
+import queue
+import select
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import typing as ty
+import attrs
+import pydicom
+from .construction import TaskTemplate
+from .convert import ConversionRun, run
+from .dicom import iter_dicom_files, read_header
+from .metrics import RunMetrics, record_metrics
+from .outputs import OutputIndex
+from .staging import default_scratch_root
+from .utils import Dcm2Niix
+
+logger = logging.getLogger("pydra.tasks.dcm2niix")
+
+# The header tags read from each arriving file
+TRACKED_TAGS = ("SeriesInstanceUID", "SOPInstanceUID", "ImagesInAcquisition")
+
+# inotify event flags, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# renameat2 arguments, from <fcntl.h> and <linux/fs.h>
+AT_FDCWD = -100
+RENAME_EXCHANGE = 0x2
+
+
+def images_in_acquisition(header: pydicom.Dataset) -> int | None:
+    """Returns the number of instances expected for a series from the
+    'ImagesInAcquisition' header of one of its instances, if it is set
+
+    NB: this only counts the images of one acquisition, so can only be used as the
+    'expected_instances' of series that are known to consist of a single acquisition
+    (i.e. not multi-volume series such as fMRI, or multi-echo series)"""
+    count = header.get("ImagesInAcquisition")
+    return int(count) if count else None
+
+
+@attrs.define
+class ArrivingSeries:
+    """The instances of a series that have arrived in the landing directory
+
+    Parameters
+    ----------
+    series_uid : str
+        the instance UID of the series
+    instances : dict[str, Path]
+        the path of each instance that has arrived, keyed by its SOP instance UID
+    expected : int, optional
+        the number of instances expected for the series, if known
+    last_arrival : float
+        the monotonic time the last instance arrived
+    conversions : int
+        the number of times the series has been converted
+    """
+
+    series_uid: str
+    instances: dict[str, Path] = attrs.field(factory=dict)
+    expected: int | None = None
+    last_arrival: float = 0.0
+    conversions: int = 0
+
+    @property
+    def paths(self) -> list[Path]:
+        return sorted(self.instances.values())
+
+
+@attrs.define
+class SeriesTracker:
+    """Tracks the instances arriving for each series, to decide when each series is
+    complete
+
+    Parameters
+    ----------
+    quiet_period : float
+        the number of seconds after the last instance of a series has arrived after
+        which it is considered complete, if the number of instances it expects isn't
+        known or hasn't been reached
+    expected_instances : Callable[[pydicom.Dataset], int | None], optional
+        returns the number of instances expected for a whole series from the header of
+        one of its instances, or None if it isn't known. By default series are only
+        completed by the quiet period
+    """
+
+    quiet_period: float = 30.0
+    expected_instances: Callable[[pydicom.Dataset], int | None] | None = None
+    series: dict[str, ArrivingSeries] = attrs.field(factory=dict, init=False)
+    _pending: set[str] = attrs.field(factory=set, init=False, repr=False)
+    _stats: dict[Path, tuple[int, int]] = attrs.field(
+        factory=dict, init=False, repr=False
+    )
+
+    def add(self, path: Path, now: float | None = None) -> ArrivingSeries | None:
+        """Records a file that has arrived, reading its header
+
+        Parameters
+        ----------
+        path : Path
+            the path of the file
+        now : float, optional
+            the monotonic time it arrived, by default the current time
+
+        Returns
+        -------
+        ArrivingSeries or None
+            the series the file belongs to, or None if it isn't a DICOM or has
+            already been recorded unchanged
+        """
+        if now is None:
+            now = time.monotonic()
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        stat = (st.st_size, st.st_mtime_ns)
+        if self._stats.get(path) == stat:
+            return None
+        try:
+            header = read_header(path, TRACKED_TAGS)
+        except Exception as e:
+            # e.g. a file that is still being written, which is retried when it changes
+            logger.debug("Could not read the header of %s: %s", path, e)
+            return None
+        self._stats[path] = stat
+        if header is None or "SeriesInstanceUID" not in header:
+            return None
+        return self.record(header, path, now)
+
+    def record(
+        self, header: pydicom.Dataset, path: Path, now: float | None = None
+    ) -> ArrivingSeries:
+        """Records an instance that has arrived, the header of which has been read
+
+        Parameters
+        ----------
+        header : pydicom.Dataset
+            the header of the instance, including its SeriesInstanceUID
+        path : Path
+            the path the instance was written to
+        now : float, optional
+            the monotonic time it arrived, by default the current time
+
+        Returns
+        -------
+        ArrivingSeries
+            the series the instance belongs to
+        """
+        if now is None:
+            now = time.monotonic()
+        uid = str(header.SeriesInstanceUID)
+        series = self.series.get(uid)
+        if series is None:
+            series = self.series[uid] = ArrivingSeries(uid)
+        sop_uid = str(header.get("SOPInstanceUID", path))
+        if sop_uid in series.instances:
+            # Instances that are sent again don't change the series
+            return series
+        if series.conversions and uid not in self._pending:
+            logger.warning(
+                "Instance %s arrived for series %s after it was converted, which will "
+                "be converted again once it is complete",
+                path,
+                uid,
+            )
+        series.instances[sop_uid] = path
+        series.last_arrival = now
+        if series.expected is None and self.expected_instances is not None:
+            series.expected = self.expected_instances(header)
+        self._pending.add(uid)
+        return series
+
+    def complete(self, now: float | None = None) -> list[ArrivingSeries]:
+        """Returns the series that have become complete since the last call
+
+        Parameters
+        ----------
+        now : float, optional
+            the current monotonic time, by default the current time
+
+        Returns
+        -------
+        list[ArrivingSeries]
+            the complete series
+        """
+        if now is None:
+            now = time.monotonic()
+        complete = []
+        for uid in list(self._pending):
+            series = self.series[uid]
+            if (
+                series.expected is not None and len(series.instances) >= series.expected
+            ) or now - series.last_arrival >= self.quiet_period:
+                complete.append(self.take(uid))
+        return complete
+
+    def take(self, series_uid: str) -> ArrivingSeries:
+        """Marks a pending series as complete, e.g. once the association it was sent
+        over has been released, regardless of whether it has met the completion rules
+
+        Parameters
+        ----------
+        series_uid : str
+            the instance UID of the series
+
+        Returns
+        -------
+        ArrivingSeries
+            the series
+        """
+        self._pending.discard(series_uid)
+        series = self.series[series_uid]
+        series.conversions += 1
+        return series
+
+    def forget(self, series_uid: str) -> None:
+        """Stops tracking a series, e.g. once its instances have been removed, so that
+        any further instances that arrive for it start a new series
+
+        Parameters
+        ----------
+        series_uid : str
+            the instance UID of the series
+        """
+        self._pending.discard(series_uid)
+        series = self.series.pop(series_uid, None)
+        if series is not None:
+            for path in series.instances.values():
+                self._stats.pop(path, None)
+
+    @property
+    def pending(self) -> list[ArrivingSeries]:
+        """The series that are still waiting for instances"""
+        return [self.series[uid] for uid in self._pending]
+
+
+@attrs.define
+class SeriesResult:
+    """The result of the conversion of a series by a :class:`SeriesWatcher`
+
+    Parameters
+    ----------
+    series : ArrivingSeries
+        the series that was converted
+    outputs : Dcm2Niix.Outputs or None
+        the outputs of the conversion, if it succeeded
+    error : Exception or None
+        the error raised by the conversion, if it failed
+    latency : float
+        the number of seconds between the arrival of the last instance of the series
+        and the completion of its conversion
+    metrics : RunMetrics, optional
+        the timings and resource usage of the conversion
+    """
+
+    series: ArrivingSeries
+    outputs: Dcm2Niix.Outputs | None = None
+    error: Exception | None = None
+    latency: float = 0.0
+    metrics: RunMetrics | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class SeriesConversions:
+    """Runs the conversions of series on a pool of workers, one at a time per series
+
+    A series that is handed off again while an earlier conversion of it is in flight
+    (e.g. because late instances have arrived) is queued to be converted once the
+    earlier conversion finishes, replacing any conversion of it that is already
+    queued. The result of a conversion that has been superseded by a queued one is
+    dropped.
+
+    Parameters
+    ----------
+    pool : Executor
+        the pool to run the conversions on
+    convert : Callable[[ArrivingSeries], SeriesResult]
+        converts a series, capturing any error in the result
+    on_result : Callable[[SeriesResult], None]
+        called with the result of each conversion that hasn't been superseded
+    """
+
+    def __init__(
+        self,
+        pool: Executor,
+        convert: Callable[[ArrivingSeries], SeriesResult],
+        on_result: Callable[[SeriesResult], None],
+    ):
+        self.pool = pool
+        self.convert = convert
+        self.on_result = on_result
+        self._lock = threading.Lock()
+        self._running: set[str] = set()
+        self._queued: dict[str, ArrivingSeries] = {}
+
+    def submit(self, series: ArrivingSeries) -> None:
+        """Converts a series, once any conversion of it in flight has finished
+
+        Parameters
+        ----------
+        series : ArrivingSeries
+            the series to convert, which isn't modified while it is converted
+        """
+        with self._lock:
+            if series.series_uid in self._running:
+                self._queued[series.series_uid] = series
+                return
+            self._running.add(series.series_uid)
+        self.pool.submit(self._run, series)
+
+    def busy(self, series_uid: str) -> bool:
+        """Whether a conversion of a series is in flight or queued"""
+        with self._lock:
+            return series_uid in self._running
+
+    def _run(self, series: ArrivingSeries) -> None:
+        # Queued conversions are run on the same worker, so they can't be rejected by
+        # a pool that is being shut down
+        while True:
+            result = self.convert(series)
+            with self._lock:
+                queued = self._queued.pop(series.series_uid, None)
+                if queued is None:
+                    self._running.discard(series.series_uid)
+                    break
+            logger.info(
+                "Converting series %s again as more instances have arrived",
+                series.series_uid,
+            )
+            series = queued
+        self.on_result(result)
+
+
+@attrs.define
+class SeriesWatcher:
+    """Watches a landing directory, converting each series as soon as it is complete
+
+    Parameters
+    ----------
+    landing_dir : str or Path
+        the directory the DICOMs arrive in
+    out_root : str or Path
+        the directory to write the outputs of each series to, in a sub-directory named
+        by its SeriesInstanceUID
+    template : Dcm2Niix
+        the task providing the arguments of the conversions, the 'in_dir' and 'out_dir'
+        of which are ignored
+    quiet_period : float
+        the number of seconds without new instances after which a series is
+        considered complete, if its expected number of instances isn't known
+    expected_instances : Callable[[pydicom.Dataset], int | None], optional
+        returns the number of instances expected for a whole series from the header of
+        one of its instances, by default series are only completed by the quiet period
+    poll_interval : float
+        the number of seconds between checks for complete series (and between scans
+        of the landing directory if it is polled)
+    use_inotify : bool, optional
+        whether to follow the landing directory with inotify rather than polling it,
+        by default inotify is used where it is available
+    max_workers : int, optional
+        the maximum number of concurrent conversions, by default the number of CPUs
+    timeout : float, optional
+        the number of seconds after which a dcm2niix process is killed and its
+        conversion failed
+    scratch_dir : str or Path, optional
+        the directory to link the files of each series into to be converted, by
+        default the directory set by the 'PYDRA_DCM2NIIX_SCRATCH' environment
+        variable or $TMPDIR
+    metrics_file : str or Path, optional
+        a JSONL file to append the metrics of each conversion to, by default the file
+        set by the 'PYDRA_DCM2NIIX_METRICS' environment variable, if any
+    retain_period : float, optional
+        the number of seconds a series is tracked after it was last converted (and no
+        new instances have arrived for it), so that it can be converted again along
+        with any late instances. Instances arriving after that are treated as a new
+        series. None tracks series indefinitely
+    """
+
+    landing_dir: Path = attrs.field(converter=Path)
+    out_root: Path = attrs.field(converter=Path)
+    template: Dcm2Niix = attrs.field(factory=Dcm2Niix)
+    quiet_period: float = 30.0
+    expected_instances: Callable[[pydicom.Dataset], int | None] | None = None
+    poll_interval: float = 1.0
+    use_inotify: bool | None = None
+    max_workers: int | None = None
+    timeout: float | None = None
+    scratch_dir: Path | None = attrs.field(
+        default=None, converter=lambda p: Path(p) if p is not None else None
+    )
+    metrics_file: str | Path | None = None
+    retain_period: float | None = 3600.0
+    _tasks: TaskTemplate = attrs.field(
+        default=attrs.Factory(
+            lambda self: TaskTemplate(self.template), takes_self=True
+        ),
+        init=False,
+        repr=False,
+    )
+
+    def watch(self, stop: threading.Event | None = None) -> Iterator[SeriesResult]:
+        """Watches the landing directory, yielding the result of the conversion of
+        each series as it completes
+
+        Files already in the landing directory are picked up when the watch starts.
+
+        Parameters
+        ----------
+        stop : threading.Event, optional
+            an event to set to stop watching, after which the conversions in flight
+            are completed. Otherwise the watch continues until the iteration is
+            stopped
+
+        Yields
+        ------
+        SeriesResult
+            the result of the conversion of each complete series
+        """
+        tracker = SeriesTracker(self.quiet_period, self.expected_instances)
+        source = watch_files(self.landing_dir, self.poll_interval, self.use_inotify)
+        max_workers = self.max_workers or os.cpu_count() or 1
+        results: "queue.Queue[SeriesResult]" = queue.Queue()
+        # The monotonic times the last conversion of each series finished
+        converted: dict[str, float] = {}
+
+        def collect() -> Iterator[SeriesResult]:
+            while True:
+                try:
+                    result = results.get_nowait()
+                except queue.Empty:
+                    return
+                converted[result.series.series_uid] = time.monotonic()
+                yield result
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            conversions = SeriesConversions(pool, self.convert_series, results.put)
+            try:
+                while stop is None or not stop.is_set():
+                    for path in source.changes(self.poll_interval):
+                        tracker.add(path)
+                    for series in tracker.complete():
+                        # Copy the instances, which may be added to by late arrivals
+                        # while the series is converted
+                        conversions.submit(
+                            attrs.evolve(series, instances=dict(series.instances))
+                        )
+                    yield from collect()
+                    if self.retain_period is not None:
+                        self._forget_expired(tracker, conversions, converted)
+            finally:
+                source.close()
+        yield from collect()
+
+    def _forget_expired(
+        self,
+        tracker: SeriesTracker,
+        conversions: SeriesConversions,
+        converted: dict[str, float],
+    ) -> None:
+        """Stops tracking the series that were last converted more than the retention
+        period ago"""
+        now = time.monotonic()
+        pending = {s.series_uid for s in tracker.pending}
+        for series_uid, finished in list(converted.items()):
+            if (
+                series_uid in pending
+                or conversions.busy(series_uid)
+                or now - max(finished, tracker.series[series_uid].last_arrival)
+                < ty.cast(float, self.retain_period)
+            ):
+                continue
+            tracker.forget(series_uid)
+            del converted[series_uid]
+
+    def convert_series(self, series: ArrivingSeries) -> SeriesResult:
+        """Converts the instances of a series that have arrived
+
+        Parameters
+        ----------
+        series : ArrivingSeries
+            the series to convert
+
+        Returns
+        -------
+        SeriesResult
+            the result of the conversion
+        """
+        root = self.scratch_dir
+        if root is None:
+            root = default_scratch_root()
+        root.mkdir(parents=True, exist_ok=True)
+        work_dir = Path(tempfile.mkdtemp(prefix="dcm2niix-watch-", dir=root))
+        try:
+            paths = series.paths
+            width = len(str(len(paths) - 1))
+            for i, path in enumerate(paths):
+                (work_dir / f"{i:0{width}d}_{path.name}").symlink_to(path.absolute())
+            return convert_arrived(
+                series,
+                self._tasks.task(work_dir, self.out_root / series.series_uid),
+                timeout=self.timeout,
+                metrics_file=self.metrics_file,
+            )
+        except Exception as e:
+            logger.warning("Failed to stage series %s: %s", series.series_uid, e)
+            return SeriesResult(series, error=e)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def convert_arrived(
+    series: ArrivingSeries,
+    task: Dcm2Niix,
+    timeout: float | None = None,
+    metrics_file: str | Path | None = None,
+) -> SeriesResult:
+    """Runs the conversion of a series that has arrived, capturing any error it fails
+    with in the result
+
+    The series is converted into a staging directory beside the task's output
+    directory, which then replaces the output directory, so that the outputs of an
+    earlier conversion of the series (e.g. before late instances arrived) are replaced
+    rather than disambiguated from.
+
+    Parameters
+    ----------
+    series : ArrivingSeries
+        the series to convert
+    task : Dcm2Niix
+        the task converting the series, the 'in_dir' of which contains its instances
+    timeout : float, optional
+        the number of seconds after which to kill the dcm2niix process
+    metrics_file : str or Path, optional
+        a JSONL file to append the metrics of the conversion to, by default the file
+        set by the 'PYDRA_DCM2NIIX_METRICS' environment variable, if any
+
+    Returns
+    -------
+    SeriesResult
+        the result of the conversion
+    """
+    out_dir = Path(task.out_dir).absolute()
+    metrics = RunMetrics(in_dir=str(task.in_dir), out_dir=str(out_dir))
+    outputs = error = None
+    staging_dir = None
+    try:
+        out_dir.parent.mkdir(parents=True, exist_ok=True)
+        staging_dir = Path(
+            tempfile.mkdtemp(prefix=f".{out_dir.name}-", dir=out_dir.parent)
+        )
+        result = run(attrs.evolve(task, out_dir=staging_dir), timeout=timeout)
+        metrics = result.metrics
+        metrics.out_dir = str(out_dir)
+        with metrics.phase("commit"):
+            replace_dir(staging_dir, out_dir)
+        outputs = ConversionRun(
+            task,
+            OutputIndex(out_dir, result.names),
+            result.return_code,
+            result.stdout,
+            result.stderr,
+            metrics,
+        ).outputs()
+    except Exception as e:
+        logger.warning("Failed to convert series %s: %s", series.series_uid, e)
+        metrics.error = f"{type(e).__name__}: {e}"
+        error = e
+    finally:
+        if staging_dir is not None:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+    record_metrics(metrics, metrics_file)
+    return SeriesResult(
+        series,
+        outputs=outputs,
+        error=error,
+        latency=time.monotonic() - series.last_arrival,
+        metrics=metrics,
+    )
+
+
+def replace_dir(src: Path, dest: Path) -> None:
+    """Replaces a directory with another on the same file-system, removing the
+    directory it replaces
+
+    Where the platform supports it (Linux), the directories are exchanged atomically,
+    so the replaced directory exists until the replacement takes its place. Otherwise
+    the replaced directory is moved aside first, leaving a brief window in which
+    neither exists.
+
+    Parameters
+    ----------
+    src : Path
+        the directory to move into place
+    dest : Path
+        the directory to replace
+    """
+    if not dest.exists():
+        src.rename(dest)
+    elif _exchange(src, dest):
+        shutil.rmtree(src, ignore_errors=True)
+    else:
+        # Directories can't be renamed over non-empty ones
+        old_dir = Path(tempfile.mkdtemp(prefix=f".{dest.name}-old-", dir=dest.parent))
+        dest.rename(old_dir / dest.name)
+        src.rename(dest)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+@functools.lru_cache(maxsize=1)
+def _libc() -> ctypes.CDLL | None:
+    name = ctypes.util.find_library("c")
+    return ctypes.CDLL(name, use_errno=True) if name else None
+
+
+def _exchange(a: Path, b: Path) -> bool:
+    """Atomically exchanges two paths with renameat2, returning False if it isn't
+    supported by the platform or file-system"""
+    if sys.platform != "linux":
+        return False
+    libc = _libc()
+    renameat2 = getattr(libc, "renameat2", None)
+    if renameat2 is None:
+        return False
+    if not renameat2(
+        AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE
+    ):
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+        return False
+    raise OSError(error, os.strerror(error), str(b))
+
+
+class FileSource(ty.Protocol):
+    def changes(self, timeout: float) -> list[Path]: ...
+
+    def close(self) -> None: ...
+
+
+def watch_files(
+    root: Path, poll_interval: float = 1.0, use_inotify: bool | None = None
+) -> FileSource:
+    """Returns a source of the files written to a directory, which reports the files
+    already in it on its first call
+
+    Parameters
+    ----------
+    root : Path
+        the directory to watch
+    poll_interval : float
+        the number of seconds between scans of the directory, if it is polled
+    use_inotify : bool, optional
+        whether to use inotify rather than polling the directory, by default inotify
+        is used where it is available
+
+    Returns
+    -------
+    FileSource
+        the source, the 'changes' method of which returns the files that have been
+        written since it was last called, waiting up to a timeout for them
+    """
+    if use_inotify is None:
+        use_inotify = sys.platform == "linux"
+        if use_inotify:
+            try:
+                return InotifySource(root)
+            except OSError as e:
+                logger.info("Polling %s as inotify isn't available: %s", root, e)
+                use_inotify = False
+    if use_inotify:
+        return InotifySource(root)
+    return PollingSource(root, poll_interval)
+
+
+class PollingSource:
+    """Reports the files in a directory that have been written since the last scan.
+    A file is only reported once its size and modification time are the same in two
+    consecutive scans, so that files that are still being written are skipped
+
+    Parameters
+    ----------
+    root : Path
+        the directory to watch
+    poll_interval : float
+        the minimum number of seconds between scans
+    """
+
+    def __init__(self, root: Path, poll_interval: float = 1.0):
+        self.root = Path(root)
+        self.poll_interval = poll_interval
+        self._last_scan = float("-inf")
+        self._previous: dict[Path, tuple[int, int]] = {}
+        self._reported: dict[Path, tuple[int, int]] = {}
+
+    def changes(self, timeout: float) -> list[Path]:
+        wait = self._last_scan + self.poll_interval - time.monotonic()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            if wait > timeout:
+                return []
+        self._last_scan = time.monotonic()
+        current = {}
+        for path in iter_dicom_files(self.root):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            current[path] = (st.st_size, st.st_mtime_ns)
+        changed = [
+            p
+            for p, s in current.items()
+            if self._previous.get(p) == s and self._reported.get(p) != s
+        ]
+        self._reported.update((p, current[p]) for p in changed)
+        self._previous = current
+        return changed
+
+    def close(self) -> None:
+        pass
+
+
+class InotifySource:
+    """Reports the files written to (or moved into) a directory tree using inotify
+
+    Parameters
+    ----------
+    root : Path
+        the directory to watch
+
+    Raises
+    ------
+    OSError
+        if inotify isn't available
+    """
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify isn't supported by the C library")
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._dirs: dict[int, Path] = {}
+        # Files written before the watches were added are reported on the first call
+        self._initial = self._add_tree(self.root)
+
+    def _add_tree(self, root: Path) -> list[Path]:
+        """Watches a directory and its sub-directories, returning the files in them"""
+        files = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            self._add_watch(Path(dirpath))
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            files.extend(
+                Path(dirpath) / f for f in sorted(filenames) if not f.startswith(".")
+            )
+        return files
+
+    def _add_watch(self, path: Path) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(path))
+        self._dirs[wd] = path
+
+    def changes(self, timeout: float) -> list[Path]:
+        changed, self._initial = self._initial, []
+        if changed:
+            timeout = 0
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return changed
+        data = b""
+        try:
+            while chunk := os.read(self._fd, 65536):
+                data += chunk
+        except BlockingIOError:
+            pass
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed, rescanning %s", self.root)
+                changed.extend(self._add_tree(self.root))
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None or not name or name.startswith(b"."):
+                continue
+            path = directory / os.fsdecode(name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.extend(self._add_tree(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changed.append(path)
+        return changed
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1